@@ -0,0 +1,473 @@
+import os
+import sys
+import shutil
+import threading
+import time
+
+from tweepy import *
+from tweepy import oauth
+from tweepy.auth import OAuthSigner, NonceGenerator
+from tweepy.binder import bind_api
+from tweepy.testing import MemcachedServer, TwitterServer, samples, sample_payload, sample_status
+from tweepy.utils import import_simplejson
+json = import_simplejson()
+
+"""Benchmarks"""
+
+
+def sample_timeline(count=20):
+    return json.dumps([sample_status(i) for i in range(count)])
+
+
+class FakeMethod(object):
+    """Stands in for an APIMethod when driving a parser directly"""
+
+    def __init__(self, api, payload_type, payload_list=False):
+        self.api = api
+        self.payload_type = payload_type
+        self.payload_list = payload_list
+
+
+def timeit(func, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        func()
+    return (time.time() - start) / iterations
+
+
+def entries_size(cache):
+    # size of a FileCache's entry files, leaving out its index and lock files
+    return sum([os.path.getsize(path) for path in cache._list_entries()])
+
+
+def bench_cache_payloads(iterations=500):
+    """Cache hit latency and size: pickled models vs raw payloads"""
+    api = API()
+    method = FakeMethod(api, 'status', True)
+    payload = sample_timeline()
+    result = api.parser.parse(method, payload)
+    results = {}
+
+    def payload_hit(cache):
+        cached = cache.get('timeline')
+        parsed = api.parsed_cache.get('timeline')
+        if parsed and parsed[0] == cached:
+            return parsed[1]
+        return api.parser.parse(method, cached)
+
+    os.mkdir('bench_cache_dir')
+    try:
+        cache = FileCache('bench_cache_dir', timeout=0)
+
+        cache.store('timeline', result)
+        results['file_models_hit'] = timeit(lambda: cache.get('timeline'), iterations)
+        results['file_models_bytes'] = entries_size(cache)
+        cache.flush()
+
+        cache.store('timeline', payload)
+        results['file_payload_parse_hit'] = timeit(lambda: payload_hit(cache), iterations)
+        api.parsed_cache.store('timeline', (payload, result))
+        results['file_payload_lru_hit'] = timeit(lambda: payload_hit(cache), iterations)
+        results['file_payload_bytes'] = entries_size(cache)
+        cache.flush()
+    finally:
+        shutil.rmtree('bench_cache_dir')
+
+    return results
+
+
+def bench_cache_compression(iterations=500):
+    """FileCache hit latency and size by pickle protocol and compression"""
+    api = API()
+    payload = sample_timeline()
+    result = api.parser.parse(FakeMethod(api, 'status', True), payload)
+    results = {}
+
+    os.mkdir('bench_cache_dir')
+    try:
+        for protocol, level in ((0, 0), (2, 0), (2, 1), (2, 6)):
+            cache = FileCache('bench_cache_dir', 0, level, protocol)
+            for name, value in (('models', result), ('payload', payload)):
+                cache.store('timeline', value)
+                label = '%s_p%i_z%i' % (name, protocol, level)
+                results[label + '_hit'] = timeit(lambda: cache.get('timeline'), iterations)
+                results[label + '_bytes'] = entries_size(cache)
+                cache.flush()
+    finally:
+        shutil.rmtree('bench_cache_dir')
+
+    return results
+
+
+def bench_memcache(iterations=500):
+    """MemCacheCache against local stand-in servers: single vs multi-get"""
+    servers = [MemcachedServer(), MemcachedServer()]
+    cache = MemCacheCache([server.start() for server in servers], timeout=0)
+    payload = sample_timeline()
+    keys = ['timeline%i' % i for i in range(20)]
+    results = {}
+    try:
+        for key in keys:
+            cache.store(key, payload)
+        results['get_hit'] = timeit(lambda: cache.get(keys[0]), iterations)
+        results['get_20_keys'] = timeit(lambda: [cache.get(k) for k in keys], iterations / 10)
+        results['get_multi_20_keys'] = timeit(lambda: cache.get_multi(keys), iterations / 10)
+        cache.flush()
+        cache.disconnect()
+    finally:
+        for server in servers:
+            server.stop()
+    return results
+
+
+def bench_cache_sweep(entries=100000, expired=100):
+    """MemoryCache expiry of a few entries among many: full scan vs sweep"""
+
+    def full_scan(cache):
+        # how cleanup() used to work
+        for k, v in cache._entries.items():
+            if cache._is_expired(v[0], v[3]):
+                del cache._entries[k]
+
+    results = {}
+    for name, func in (('full_scan', full_scan), ('sweep', MemoryCache.sweep)):
+        cache = MemoryCache(timeout=60)
+        for i in xrange(expired):
+            cache.store('expired%i' % i, 'testvalue')
+        # backdate the first entries so only they are expired
+        cache._entries = dict([(k, (e[0] - 120, e[1], e[2], e[3] - 120))
+                               for k, e in cache._entries.items()])
+        cache._expiry = [(t - 120, k) for t, k in cache._expiry]
+        for i in xrange(entries):
+            cache.store('testkey%i' % i, 'testvalue')
+        start = time.time()
+        func(cache)
+        results[name] = time.time() - start
+        assert cache.count() == entries
+    return results
+
+
+def bench_filecache_index(entries=2000, iterations=200):
+    """FileCache with and without index: count, miss, expired get, cleanup"""
+    payload = sample_timeline()
+    results = {}
+    for use_index in (False, True):
+        label = use_index and 'index' or 'no_index'
+        os.mkdir('bench_cache_dir')
+        try:
+            cache = FileCache('bench_cache_dir', 60, use_index=use_index)
+            # entries keep their own expiry, so store them with a short
+            # one for cleanup() to have something to delete
+            for i in xrange(entries):
+                cache.store('timeline%i' % i, payload, 1)
+            expires = time.time() + 1
+            results[label + '_count'] = timeit(cache.count, iterations)
+            results[label + '_miss'] = timeit(lambda: cache.get('missing'), iterations)
+            results[label + '_expired_get'] = timeit(lambda: cache.get('timeline0', 0.000001), 1)
+            time.sleep(max(expires - time.time(), 0))
+            start = time.time()
+            cache.cleanup()
+            results[label + '_cleanup'] = time.time() - start
+            assert cache.count() == 0, 'cleanup() left expired entries behind'
+        finally:
+            shutil.rmtree('bench_cache_dir')
+    return results
+
+
+def bench_disk_cache_writes(iterations=2000):
+    """Disk cache write and hit latency: FileCache vs LogCache"""
+    payload = sample_timeline()
+    results = {}
+    for name, cache_class in (('file', FileCache), ('log', LogCache)):
+        try:
+            cache = cache_class('bench_cache_dir', 60)
+            keys = ['timeline%i' % (i % 500) for i in xrange(iterations)]
+            start = time.time()
+            for key in keys:
+                cache.store(key, payload)
+            results[name + '_store'] = (time.time() - start) / iterations
+            results[name + '_hit'] = timeit(lambda: cache.get('timeline1'), iterations)
+            if name == 'log':
+                start = time.time()
+                cache.compact()
+                results[name + '_compact'] = time.time() - start
+        finally:
+            shutil.rmtree('bench_cache_dir')
+    return results
+
+
+def bench_api_calls(iterations=500):
+    """API calls per second against the local mock server"""
+    server = TwitterServer()
+    host = server.start()
+    api = API(BasicAuthHandler('user1', 'password'), host=host, search_host=host)
+    results = {}
+    try:
+        for name, func in (('get_status', lambda: api.get_status(id=1)),
+                           ('home_timeline', api.home_timeline),
+                           ('search', lambda: api.search('tweepy'))):
+            results[name + '_per_sec'] = 1 / timeit(func, iterations)
+    finally:
+        server.stop()
+    return results
+
+
+def bench_parse(iterations=200):
+    """Parse time of a response by payload_type (lists of 20 items)"""
+    api = API()
+    results = {}
+    for payload_type in samples:
+        for payload_list in (False, True):
+            if payload_list and payload_type in ('friendship', 'json', 'ids'):
+                continue
+            method = FakeMethod(api, payload_type, payload_list)
+            payload = sample_payload(payload_type, payload_list)
+            label = payload_type + (payload_list and '_list' or '')
+            results[label] = timeit(lambda: api.parser.parse(method, payload), iterations)
+    return results
+
+
+def bench_cache_backends(iterations=1000):
+    """Cache hit latency of a parsed timeline for each Cache backend"""
+    api = API()
+    result = api.parser.parse(FakeMethod(api, 'status', True), sample_timeline())
+    memcached = MemcachedServer()
+    backends = (
+        ('memory', lambda: MemoryCache(timeout=60)),
+        ('lru', lambda: LRUCache(timeout=60)),
+        ('file', lambda: FileCache('bench_cache_dir', 60)),
+        ('log', lambda: LogCache('bench_cache_dir', 60)),
+        ('layered', lambda: LayeredCache(FileCache('bench_cache_dir', 60))),
+        ('memcache', lambda: MemCacheCache([memcached.start()], timeout=60)),
+    )
+    results = {}
+    for name, make_cache in backends:
+        try:
+            cache = make_cache()
+            cache.store('timeline', result)
+            results[name + '_hit'] = timeit(lambda: cache.get('timeline'), iterations)
+            cache.flush()
+            if name == 'memcache':
+                cache.disconnect()
+        finally:
+            if name == 'memcache':
+                memcached.stop()
+            if os.path.exists('bench_cache_dir'):
+                shutil.rmtree('bench_cache_dir')
+    return results
+
+
+def bench_cursor(pages=20, page_size=100):
+    """Cursor crawl throughput against the local mock server"""
+    server = TwitterServer(pages=pages, page_size=page_size)
+    host = server.start()
+    api = API(BasicAuthHandler('user1', 'password'), host=host)
+    results = {}
+    try:
+        for name, method in (('followers', api.followers), ('followers_ids', api.followers_ids),
+                             ('user_timeline', api.user_timeline)):
+            start = time.time()
+            count = len(list(Cursor(method).items()))
+            results[name + '_items_per_sec'] = count / (time.time() - start)
+    finally:
+        server.stop()
+    return results
+
+
+def bench_compression(iterations=200, messages=5000):
+    """gzip on vs off: REST calls/sec and bytes, stream messages/sec
+    (fixtures are repetitive so they compress better than real data)"""
+    server = TwitterServer(page_size=200)
+    host = server.start()
+    results = {}
+    try:
+        for compression in (False, True):
+            label = compression and 'gzip' or 'plain'
+            collector = MetricsCollector()
+            api = API(BasicAuthHandler('user1', 'password'), host=host,
+                      compression=compression, hooks=[collector])
+            results[label + '_timeline_per_sec'] = 1 / timeit(api.home_timeline, iterations)
+            metrics = collector.snapshot()['/statuses/home_timeline.json']
+            results[label + '_timeline_bytes'] = metrics.bytes_received / metrics.calls
+            if compression:
+                results['gzip_decompress'] = metrics.latency['decompress'].mean()
+
+            stream = Stream('user1', 'password', CountingListener(messages), compression=compression)
+            stream.host = host
+            start = time.time()
+            stream.sample()
+            results[label + '_stream_messages_per_sec'] = messages / (time.time() - start)
+    finally:
+        server.stop()
+    return results
+
+
+def bench_transports(iterations=500):
+    """API calls per second by transport against the local mock server"""
+    server = TwitterServer()
+    host = server.start()
+    results = {}
+    try:
+        recorder = RecordingTransport('bench_recording.gz')
+        transports = (('http', HTTPTransport()), ('pooled', PooledTransport()),
+                      ('recording', recorder))
+        for name, transport in transports:
+            api = API(BasicAuthHandler('user1', 'password'), host=host, transport=transport)
+            results[name + '_per_sec'] = 1 / timeit(lambda: api.get_status(id=1), iterations)
+        recorder.close()
+
+        replay = ReplayTransport('bench_recording.gz', speed=0)
+        api = API(BasicAuthHandler('user1', 'password'), host=host, transport=replay)
+        results['replay_per_sec'] = 1 / timeit(lambda: api.get_status(id=1), iterations)
+    finally:
+        server.stop()
+        os.remove('bench_recording.gz')
+    return results
+
+
+def bench_call_overhead(iterations=20000):
+    """Per call client overhead of bound methods, served from cache"""
+    api = API(BasicAuthHandler('user1', 'password'), cache=MemoryCache(timeout=0))
+    calls = (
+        ('get_status', api.get_status, (1,), '/1/statuses/show.json?id=1'),
+        ('get_list', api.get_list, ('user1', 'tweepy'), '/1/user1/lists/tweepy.json'),
+        ('lists', api.lists, (), '/1/user1/lists.json'),
+        ('is_list_member', api.is_list_member, ('user1', 'tweepy', 3), '/1/user1/tweepy/members/3.json'),
+    )
+    results = {}
+    for name, method, args, url in calls:
+        api.cache.store(url, (time.time(), 'cached'))
+        assert method(*args) == 'cached'
+        results[name] = timeit(lambda: method(*args), iterations)
+    results['bind_api'] = timeit(lambda: bind_api(path='/{user}/lists/{slug}.json'), iterations / 10)
+    return results
+
+
+def bench_oauth_sign(iterations=5000):
+    """OAuth signatures/sec: OAuthRequest vs OAuthSigner, nonces/sec"""
+    consumer = oauth.OAuthConsumer('consumer key', 'consumer secret')
+    token = oauth.OAuthToken('access key', 'access secret')
+    sigmethod = oauth.OAuthSignatureMethod_HMAC_SHA1()
+    url = 'http://api.twitter.com/1/statuses/home_timeline.json?count=200&since_id=12345'
+    parameters = {'count': '200', 'since_id': '12345'}
+
+    def oauth_request():
+        request = oauth.OAuthRequest.from_consumer_and_token(consumer,
+                token=token, http_url=url, parameters=dict(parameters))
+        request.sign_request(sigmethod, consumer, token)
+        return request.to_header()
+
+    signer = OAuthSigner(consumer, token)
+    nonce_generator = NonceGenerator()
+    return {
+        'generate_nonce_per_sec': 1 / timeit(oauth.generate_nonce, iterations * 10),
+        'nonce_generator_per_sec': 1 / timeit(nonce_generator, iterations * 10),
+        'oauth_request_per_sec': 1 / timeit(oauth_request, iterations),
+        'signer_per_sec': 1 / timeit(lambda: signer.sign('GET', url, parameters), iterations),
+        'signer_fixed_nonce_per_sec': 1 / timeit(
+                lambda: signer.sign('GET', url, parameters, 1280000000, '12345678'), iterations),
+    }
+
+
+class CountingListener(StreamListener):
+
+    def __init__(self, limit):
+        StreamListener.__init__(self)
+        self.limit = limit
+        self.count = 0
+
+    def on_status(self, status):
+        self.count += 1
+        if self.count >= self.limit:
+            return False
+
+
+def bench_stream(messages=5000):
+    """Stream messages per second from the local mock server"""
+    server = TwitterServer()
+    host = server.start()
+    try:
+        stream = Stream('user1', 'password', CountingListener(messages))
+        stream.host = host
+        start = time.time()
+        stream.sample()
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+    return {'messages_per_sec': stream.listener.count / elapsed}
+
+
+def bench_stream_manager(streams=100, duration=3.0):
+    """Many quiet streams: a thread per stream vs one StreamManager"""
+    server = TwitterServer()
+    server.stream_delay = 0.05
+    host = server.start()
+    results = {}
+    try:
+        for name in ('threads', 'manager'):
+            manager = None
+            if name == 'manager':
+                manager = StreamManager()
+                manager.start()
+            threads = threading.activeCount()
+            running = []
+            for i in range(streams):
+                stream = Stream('user%i' % i, 'password', CountingListener(10 ** 9), manager=manager)
+                stream.host = host
+                stream.sample(async=True)
+                running.append(stream)
+            # let every stream connect before counting
+            time.sleep(1)
+            count = sum([s.listener.count for s in running])
+            time.sleep(duration)
+            # server threads included, one per stream
+            results[name + '_new_threads'] = threading.activeCount() - threads
+            results[name + '_messages_per_sec'] = (sum([s.listener.count for s in running]) - count) / duration
+            for stream in running:
+                stream.disconnect()
+            if manager:
+                manager.stop()
+            time.sleep(0.5)
+    finally:
+        server.stop()
+    return results
+
+
+benchmarks = [
+    bench_cache_payloads,
+    bench_cache_compression,
+    bench_memcache,
+    bench_cache_sweep,
+    bench_filecache_index,
+    bench_disk_cache_writes,
+    bench_api_calls,
+    bench_parse,
+    bench_cache_backends,
+    bench_cursor,
+    bench_stream,
+    bench_stream_manager,
+    bench_transports,
+    bench_compression,
+    bench_call_overhead,
+    bench_oauth_sign,
+]
+
+
+if __name__ == '__main__':
+
+    # usage: bench.py [--json] [bench_name ...]
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    names = [arg for arg in args if arg != '--json']
+    selected = [b for b in benchmarks if not names or b.__name__ in names]
+
+    report = {}
+    for bench in selected:
+        results = bench()
+        report[bench.__name__] = results
+        if not as_json:
+            print '%s: %s' % (bench.__name__, bench.__doc__)
+            for name, value in sorted(results.items()):
+                print '    %-28s %s' % (name, value)
+    if as_json:
+        print json.dumps(report, indent=2, sort_keys=True)
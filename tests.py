@@ -1,9 +1,20 @@
 import unittest
 import random
-from time import sleep
+from time import sleep, time
+from threading import Thread
 import os
+import shutil
+import cgi
+import socket
+import cPickle as pickle
 
 from tweepy import *
+from tweepy import oauth
+from tweepy.utils import SingleFlight, MultipartBody
+from tweepy.auth import OAuthSigner, NonceGenerator
+from tweepy.streaming import ReconnectPolicy
+from tweepy.parsers import ModelParser
+from tweepy.testing import MemcachedServer, TwitterServer
 
 """Configurations"""
 # Must supply twitter account credentials for tests
@@ -300,6 +311,7 @@ class TweepyCursorTests(unittest.TestCase):
 
         pages = list(Cursor(self.api.followers, 'twitter').pages(5))
         self.assert_(len(pages) == 5)
+    """
 
 class TweepyAuthTests(unittest.TestCase):
 
@@ -334,7 +346,7 @@ class TweepyAuthTests(unittest.TestCase):
 class TweepyCacheTests(unittest.TestCase):
 
     timeout = 2.0
-    memcache_servers = ['127.0.0.1:11211']  # must be running for test to pass
+    memcache_servers = None  # ex: ['127.0.0.1:11211'], None uses local stand-in servers
 
     def _run_tests(self, do_cleanup=True):
         # test store and get
@@ -342,10 +354,13 @@ class TweepyCacheTests(unittest.TestCase):
         self.assertEqual(self.cache.get('testkey'), 'testvalue',
             'Stored value does not match retrieved value')
 
-        # test timeout
+        # test timeout, entries stored with their own timeout outlive it
+        self.cache.store('longkey', 'longvalue', self.timeout * 1.5)
         sleep(self.timeout)
         self.assertEqual(self.cache.get('testkey'), None,
             'Cache entry should have expired')
+        self.assertEqual(self.cache.get('longkey'), 'longvalue',
+            'Entry timeout was not used')
 
         # test cleanup
         if do_cleanup:
@@ -353,6 +368,10 @@ class TweepyCacheTests(unittest.TestCase):
             sleep(self.timeout)
             self.cache.cleanup()
             self.assertEqual(self.cache.count(), 0, 'Cache cleanup failed')
+        else:
+            sleep(self.timeout / 2)
+        self.assertEqual(self.cache.get('longkey'), None,
+            'Cache entry should have expired')
 
         # test count
         for i in range(0, 20):
@@ -363,16 +382,943 @@ class TweepyCacheTests(unittest.TestCase):
         self.cache.flush()
         self.assertEqual(self.cache.count(), 0, 'Cache failed to flush')
 
+    def _run_sweeper_tests(self):
+        for i in range(0, 20):
+            self.cache.store('testkey%i' % i, 'testvalue')
+        self.cache.store('longkey', 'longvalue', self.timeout * 3)
+        sweeper = CacheSweeper(self.cache, interval=0.1)
+        sweeper.start()
+        sleep(self.timeout / 2)
+        self.cache.store('testkey', 'testvalue')
+        sleep(self.timeout / 2 + 0.5)
+        sweeper.stop()
+        self.assertEqual(sweeper.swept, 20, 'Sweeper removed wrong number of entries')
+        self.assertEqual(self.cache.count(), 2, 'Sweeper removed unexpired entry')
+        self.assertEqual(self.cache.get('longkey'), 'longvalue')
+        self.cache.flush()
+
     def testmemorycache(self):
         self.cache = MemoryCache(timeout=self.timeout)
         self._run_tests()
+        self._run_sweeper_tests()
+
+    def testsweeperfallback(self):
+        # caches without their own sweep() are cleaned up in full, which
+        # may take longer than a batch without starting over right away
+        class SlowCache(MemoryCache):
+            cleanups = 0
+            def sweep(self, max_time=None):
+                return Cache.sweep(self, max_time)
+            def cleanup(self):
+                self.cleanups += 1
+                sleep(0.05)
+                MemoryCache.sweep(self)
+        self.cache = SlowCache(timeout=0.1)
+        for i in range(0, 20):
+            self.cache.store('testkey%i' % i, 'testvalue')
+        sleep(0.1)
+        sweeper = CacheSweeper(self.cache, interval=0.2)
+        sweeper.start()
+        sleep(0.5)
+        sweeper.stop()
+        self.assertEqual(sweeper.swept, 20, 'Sweeper removed wrong number of entries')
+        self.assert_(self.cache.cleanups <= 4, 'Sweeper did not wait between full scans')
+
+    def testcompressedmemorycache(self):
+        self.cache = MemoryCache(timeout=self.timeout, compress_level=6)
+        self._run_tests()
+
+        value = ['testvalue'] * 100
+        self.cache.store('testkey', value)
+        self.assertEqual(self.cache.get('testkey'), value,
+            'Stored value does not match retrieved value')
+        self.assert_(self.cache.stats()['bytes_saved'] > 0,
+            'Compression should have saved bytes')
+
+    def testmemorycachepickle(self):
+        # caches pickled by older versions hold (time, value) entries
+        # and no compression settings
+        self.cache = MemoryCache.__new__(MemoryCache)
+        self.cache.__setstate__({'entries': {'testkey': (time(), 'testvalue')},
+                                 'timeout': self.timeout})
+        self.assertEqual(self.cache.get('testkey'), 'testvalue')
+
+        self.cache.compress_level = 6
+        self.cache.store('testkey2', ['testvalue'] * 100)
+        other = pickle.loads(pickle.dumps(self.cache))
+        self.assertEqual(other.get('testkey'), 'testvalue')
+        self.assertEqual(other.get('testkey2'), ['testvalue'] * 100)
+
+    def testlrucache(self):
+        self.cache = LRUCache(timeout=self.timeout, max_entries=50)
+        self._run_tests()
+
+        # test eviction of least recently used entry
+        self.cache.max_entries = 3
+        for i in range(0, 3):
+            self.cache.store('testkey%i' % i, 'testvalue')
+        self.cache.get('testkey0')
+        self.cache.store('testkey3', 'testvalue')
+        self.assertEqual(self.cache.count(), 3, 'Count is wrong')
+        self.assertEqual(self.cache.get('testkey1'), None,
+            'Least recently used entry should have been evicted')
+        self.assertEqual(self.cache.get('testkey0'), 'testvalue',
+            'Recently used entry should not have been evicted')
 
     def testfilecache(self):
         os.mkdir('cache_test_dir')
         self.cache = FileCache('cache_test_dir', self.timeout)
         self._run_tests()
+        self._run_sweeper_tests()
+        self.cache.flush()
+        shutil.rmtree('cache_test_dir')
+
+    def testfilecacheindex(self):
+        os.mkdir('cache_test_dir')
+        self.cache = FileCache('cache_test_dir', self.timeout)
+
+        # expired entries are detected from the index alone
+        self.cache.store('testkey', 'testvalue')
+        open(self.cache._get_path('testkey'), 'wb').write('not a pickle')
+        sleep(self.timeout)
+        self.assertEqual(self.cache.get('testkey'), None,
+            'Cache entry should have expired')
+        self.assertEqual(self.cache.count(), 0, 'Count is wrong')
+
+        # index grows and is shared with other instances
+        for i in range(0, 2000):
+            self.cache.store('testkey%i' % i, 'testvalue')
+        other = FileCache('cache_test_dir', self.timeout)
+        self.assertEqual(other.count(), 2000, 'Count is wrong')
+        self.assertEqual(other.get('testkey1999'), 'testvalue')
+
+        self.cache.flush()
+        self.assertEqual(other.count(), 0, 'Cache failed to flush')
+        shutil.rmtree('cache_test_dir')
+
+    def testlogcache(self):
+        self.cache = LogCache('cache_test_dir', self.timeout, segment_size=1024)
+        self._run_tests()
+        self._run_sweeper_tests()
+
+        # test compaction of overwritten entries
+        for i in range(0, 200):
+            self.cache.store('testkey%i' % (i % 10), 'testvalue%i' % i)
+        self.assert_(self.cache.compact() > 0, 'Compaction reclaimed nothing')
+        self.assertEqual(self.cache.count(), 10, 'Count is wrong')
+        self.assertEqual(self.cache.get('testkey9'), 'testvalue199')
+
+        # test reopening replays the log
+        other = LogCache('cache_test_dir', self.timeout)
+        self.assertEqual(other.count(), 10, 'Count is wrong')
+        self.assertEqual(other.get('testkey3'), 'testvalue193')
+
+        self.cache.flush()
+        shutil.rmtree('cache_test_dir')
+
+    def testlogcachetornwrite(self):
+        self.cache = LogCache('cache_test_dir', 60)
+        self.cache.store('a', 'testvalue')
+        self.cache.store('b', 'testvalue')
+        segment = self.cache._segment_path(self.cache._active)
+        self.cache._active_file.close()
+
+        # a write cut short in the middle of a record header
+        f = open(segment, 'ab')
+        f.write('\x01' * 10)
+        f.close()
+
+        self.cache = LogCache('cache_test_dir', 60)
+        self.assertEqual(self.cache.count(), 2, 'Count is wrong')
+        self.cache.store('c', 'testvalue c')
+        self.cache.store('d', 'testvalue d')
+        self.cache._active_file.close()
+
+        self.cache = LogCache('cache_test_dir', 60)
+        self.assertEqual(self.cache.count(), 4, 'Records after a torn write were lost')
+        self.assertEqual(self.cache.get('c'), 'testvalue c')
+        self.assertEqual(self.cache.get('d'), 'testvalue d')
         self.cache.flush()
-        os.rmdir('cache_test_dir')
+        shutil.rmtree('cache_test_dir')
+
+    def testlayeredcache(self):
+        os.mkdir('cache_test_dir')
+        back = FileCache('cache_test_dir', self.timeout)
+        self.cache = LayeredCache(back, LRUCache(self.timeout, 10))
+        self._run_tests()
+
+        # test promotion from the back tier
+        back_hits = self.cache.stats()['back_hits']
+        back.store('testkey', 'testvalue')
+        self.assertEqual(self.cache.get('testkey'), 'testvalue')
+        self.assertEqual(self.cache.get('testkey'), 'testvalue')
+        stats = self.cache.stats()
+        self.assertEqual(stats['back_hits'], back_hits + 1)
+        self.assert_(stats['front_hits'] >= 2)
+
+        self.cache.flush()
+        shutil.rmtree('cache_test_dir')
+
+    def testmemcache(self):
+        servers = self.memcache_servers
+        local = []
+        if servers is None:
+            local = [MemcachedServer(), MemcachedServer()]
+            servers = [server.start() for server in local]
+        try:
+            self.cache = MemCacheCache(servers, timeout=self.timeout)
+            self._run_tests()
+
+            # test multi-get across servers
+            for i in range(0, 20):
+                self.cache.store('testkey%i' % i, 'testvalue%i' % i)
+            keys = ['testkey%i' % i for i in range(0, 25)]
+            values = self.cache.get_multi(keys)
+            self.assertEqual(len(values), 20, 'Multi-get count is wrong')
+            self.assertEqual(values['testkey7'], 'testvalue7')
+            for server in local:
+                self.assert_(server.live_count() > 0, 'Keys not spread across servers')
+
+            # values refused by the server are left uncached
+            self.cache.store('testkey', os.urandom(2 * 1024 * 1024))
+            self.assertEqual(self.cache.get('testkey'), None)
+            self.assertEqual(self.cache.stats()['errors'], 1)
+            self.cache.store('testkey', 'testvalue')
+            self.assertEqual(self.cache.get('testkey'), 'testvalue')
+            self.cache.flush()
+            self.cache.disconnect()
+
+            # servers which are down miss
+            cache = MemCacheCache(['127.0.0.1:1'], timeout=self.timeout, socket_timeout=0.5)
+            cache.store('testkey', 'testvalue')
+            self.assertEqual(cache.get('testkey'), None)
+            self.assertEqual(cache.stats()['errors'], 2)
+
+            # and are not waited on again until dead_retry has passed
+            hung = socket.socket()
+            hung.bind(('127.0.0.1', 0))
+            hung.listen(5)
+            try:
+                cache = MemCacheCache(['127.0.0.1:%i' % hung.getsockname()[1]],
+                        timeout=self.timeout, socket_timeout=0.5, dead_retry=1)
+                start = time()
+                self.assertEqual(cache.get('testkey'), None)
+                self.assert_(time() - start >= 0.5)
+                start = time()
+                cache.store('testkey', 'testvalue')
+                self.assertEqual(cache.get('testkey'), None)
+                self.assert_(time() - start < 0.1, 'Server marked down was waited on')
+                sleep(1)
+                start = time()
+                self.assertEqual(cache.get('testkey'), None)
+                self.assert_(time() - start >= 0.5, 'Server was not retried')
+                self.assertEqual(cache.stats()['errors'], 4)
+            finally:
+                hung.close()
+        finally:
+            for server in local:
+                server.stop()
+
+    def testcompressedfilecache(self):
+        os.mkdir('cache_test_dir')
+        self.cache = FileCache('cache_test_dir', self.timeout,
+                compress_level=6, pickle_protocol=2)
+        self._run_tests()
+        self.cache.flush()
+        shutil.rmtree('cache_test_dir')
+
+    def testcompressedfilecachetext(self):
+        # compressed values are written as binary pickles even when
+        # the cache uses the text protocol
+        os.mkdir('cache_test_dir')
+        self.cache = FileCache('cache_test_dir', self.timeout, compress_level=6)
+        value = [{'text': 'testvalue %i' % i, 'id': i} for i in range(100)]
+        self.cache.store('testkey', value)
+        self.assertEqual(self.cache.get('testkey'), value)
+        size = os.path.getsize(self.cache._get_path('testkey'))
+        stats = self.cache.stats()
+        self.assert_(size < stats['bytes_in'], 'Compressed entry is larger than its value')
+        self.assertEqual(stats['bytes_stored'], size)
+        self.cache.flush()
+        shutil.rmtree('cache_test_dir')
+
+
+class TweepyUtilsTests(unittest.TestCase):
+
+    def testsingleflight(self):
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            sleep(0.5)
+            return 'result'
+
+        threads = [Thread(target=lambda: results.append(flights.do('key', work)))
+                    for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1, 'Concurrent calls were not coalesced')
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(flights.do('key', lambda: 'again'), 'again')
+
+        # background calls are started once and shared with do()
+        self.assert_(flights.do_async('key', work))
+        self.assertFalse(flights.do_async('key', work))
+        self.assertEqual(flights.do('key', work), 'result')
+        self.assertEqual(len(calls), 2)
+
+    def testrequesthooks(self):
+        events = []
+        class Hook(RequestHook):
+            def pre_request(self, info):
+                events.append(('pre', info.path, info.cache))
+            def post_request(self, info):
+                events.append(('post', info.path, info.cache))
+                self.info = info
+        hook = Hook()
+
+        api = API(cache=MemoryCache(timeout=60), hooks=[hook])
+        api.cache.store('/1/users/show.json?id=twitter', (time(), 'cached'))
+        self.assertEqual(api.get_user('twitter'), 'cached')
+        self.assertEqual(events, [('pre', '/users/show.json', None),
+                                  ('post', '/users/show.json', 'hit')])
+        self.assert_('cache_lookup' in hook.info.timings)
+        self.assert_('total' in hook.info.timings)
+        self.assertEqual(hook.info.status, None)
+
+    def testhistogram(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.min, 0.001)
+        self.assertEqual(histogram.max, 1.0)
+        for percent, expected in ((50, 0.5), (90, 0.9), (99, 0.99), (100, 1.0)):
+            value = histogram.percentile(percent)
+            self.assert_(abs(value - expected) / expected < 0.02, (percent, value))
+
+    def testmetricscollector(self):
+        collector = MetricsCollector()
+        api = API(cache=MemoryCache(timeout=60), hooks=[collector])
+        api.cache.store('/1/users/show.json?id=twitter', (time(), 'cached'))
+        for i in range(3):
+            api.get_user('twitter')
+        info = RequestInfo('/users/show.json', 'GET', 'api.twitter.com')
+        info.status = 404
+        info.error = TweepError('Not found')
+        info.timings['total'] = 0.25
+        collector.post_request(info)
+
+        metrics = collector.snapshot()['/users/show.json']
+        self.assertEqual(metrics.calls, 4)
+        self.assertEqual(metrics.cache, {'hit': 3})
+        self.assertEqual(metrics.errors, {404: 1})
+        self.assertEqual(metrics.latency['total'].count, 4)
+        text = collector.exposition()
+        self.assert_('tweepy_requests_total{path="/users/show.json"} 4' in text)
+        self.assert_('tweepy_errors_total{path="/users/show.json",status="404"} 1' in text)
+
+        self.assertEqual(len(collector.snapshot(reset=True)), 1)
+        self.assertEqual(collector.snapshot(), {})
+
+    def testmultipartbody(self):
+        image = os.urandom(20000)
+        f = open('test_image.png', 'wb')
+        f.write(image)
+        f.close()
+        try:
+            body = MultipartBody('image', 'test_image.png', 'image/png', 'Tw3ePy')
+            expected = '\r\n'.join(['--Tw3ePy',
+                    'Content-Disposition: form-data; name="image"; filename="test_image.png"',
+                    'Content-Type: image/png', '', image, '--Tw3ePy--', ''])
+            self.assertEqual(len(body), len(expected))
+            chunks = []
+            while True:
+                chunk = body.read(4096)
+                if not chunk:
+                    break
+                self.assert_(len(chunk) <= 4096)
+                chunks.append(chunk)
+            self.assertEqual(''.join(chunks), expected)
+            body.seek(0)
+            self.assertEqual(body.read(), expected)
+        finally:
+            os.remove('test_image.png')
+
+    def testreconnectpolicy(self):
+        policy = ReconnectPolicy(network_delay=0.25, network_max_delay=1,
+                http_delay=5, http_max_delay=100, rate_limit_delay=60)
+        self.assertEqual([policy.delay('network') for i in range(4)], [0.25, 0.5, 1, 1])
+        self.assertEqual(policy.delay('stall'), 1)
+        self.assertEqual([policy.delay(503) for i in range(4)], [5, 10, 20, 40])
+        self.assertEqual(policy.delay('closed'), 0)
+        policy.connected()
+        self.assertEqual(policy.delay('timeout'), 0.25)
+        self.assertEqual([policy.delay(420) for i in range(2)], [60, 100])
+        self.assertEqual(policy.counts,
+                {'network': 4, 'stall': 1, 503: 4, 'closed': 1, 'timeout': 1, 420: 2})
+
+        # the default policy of a stream starts from its configured delays
+        policy = Stream('user1', 'password', StreamListener()).reconnect_policy
+        self.assertEqual((policy.delay('network'), policy.delay(503)), (5.0, 10.0))
+        policy = Stream('user1', 'password', StreamListener(),
+                snooze_time=60, retry_time=600).reconnect_policy
+        self.assertEqual((policy.delay('network'), policy.delay(503)), (60, 600))
+        self.assertEqual((policy.network_max_delay, policy.http_max_delay), (60, 600))
+
+    def testoauthsigner(self):
+        consumer = oauth.OAuthConsumer('consumer', 'consumer secret')
+        token = oauth.OAuthToken('token', 'token/secret')
+        url = 'http://api.twitter.com:80/1/statuses/update.json?status=caf%C3%A9'
+        parameters = {'status': u'caf\xe9 & co'.encode('utf-8')}
+
+        request = oauth.OAuthRequest.from_consumer_and_token(consumer,
+                token=token, http_method='POST', http_url=url, parameters=dict(parameters))
+        request.set_parameter('oauth_timestamp', 1280000000)
+        request.set_parameter('oauth_nonce', '12345678')
+        request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
+        expected = request.to_header()['Authorization']
+
+        signer = OAuthSigner(consumer, token)
+        for i in range(2):
+            header = signer.sign('POST', url, parameters, 1280000000, '12345678')
+            self.assertEqual(sorted(header.split(', ')), sorted(expected.split(', ')))
+
+    def testnoncegenerator(self):
+        generator = NonceGenerator(size=8, batch_size=4)
+        nonces = []
+
+        def work():
+            for i in range(50):
+                nonces.append(generator())
+        threads = [Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(nonces)), 200)
+        for nonce in nonces:
+            self.assertEqual(len(nonce), 16)
+            int(nonce, 16)
+
+        auth = OAuthHandler('consumer', 'secret', nonce_generator=lambda: 'fixed')
+        auth.set_access_token('token', 'token secret')
+        headers = {}
+        auth.apply_auth('http://api.twitter.com/1/help/test.json', 'GET', headers, {})
+        self.assert_('oauth_nonce="fixed"' in headers['Authorization'])
+
+
+class TweepyMockServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TwitterServer(pages=3, page_size=10)
+        self.host = self.server.start()
+        self.api = API(BasicAuthHandler('user1', 'password'), host=self.host, search_host=self.host)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testapi(self):
+        self.assertEqual(self.api.get_status(id=1).id, 10000)
+        self.assertEqual(len(self.api.home_timeline()), 10)
+        self.assertEqual(len(list(Cursor(self.api.followers).items())), 30)
+        self.assertEqual(len(list(Cursor(self.api.search, q='tweepy').pages())), 3)
+        self.server.fixtures['/statuses/show.json'] = (404, '{"error": "Not found"}')
+        self.assertRaises(TweepError, self.api.get_status, id=1)
+
+    def testcachepayloads(self):
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host,
+                  cache=MemoryCache(timeout=60), cache_payloads=True, parsed_cache_size=1)
+        status = api.get_status(id=1)
+        payload = api.cache.get('/1/statuses/show.json?id=1')[1]
+        self.assert_(isinstance(payload, str), 'Raw payload should be cached')
+        self.assert_('Status update number' in payload)
+
+        # hits reuse the parsed result while it is in the LRU
+        self.assert_(api.get_status(id=1) is status)
+        self.assertEqual(self.server.request_count, 1)
+
+        # and re-parse the cached payload once it has been evicted
+        api.get_status(id=2)
+        again = api.get_status(id=1)
+        self.assert_(again is not status)
+        self.assertEqual(again.id, status.id)
+        self.assertEqual(again._api, api)
+        self.assertEqual(self.server.request_count, 2)
+
+    def testoldcacheentries(self):
+        # entries which are not (stored_at, value[, meta]) tuples, such as
+        # bare models cached by earlier releases, are refetched
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host,
+                  cache=MemoryCache(timeout=0))
+        url = '/1/statuses/show.json?id=1'
+        for entry in ('payload', api.get_status(id=2), (1,), ('old', 'value'),
+                      (time(), 'value', 'meta')):
+            api.cache.store(url, entry)
+            self.assertEqual(api.get_status(id=1).id, 10000)
+            self.assertEqual(api.cache.get(url)[1].id, 10000)
+        self.assertEqual(self.server.request_count, 6)
+
+    def testcoalescing(self):
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host,
+                  cache=MemoryCache(timeout=60))
+        self.server.response_delay = 0.5
+        results = []
+        threads = [Thread(target=lambda: results.append(api.get_status(id=1)))
+                    for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.request_count, 1, 'Concurrent calls were not coalesced')
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assert_(result is results[0])
+
+    def teststalewhilerevalidate(self):
+        states = []
+        infos = []
+        class Hook(RequestHook):
+            def post_request(self, info):
+                states.append(info.cache)
+                infos.append(info)
+        class SlowParser(ModelParser):
+            # keeps each stale hit parsing while the refresh starts
+            def parse(self, method, payload):
+                sleep(0.05)
+                return ModelParser.parse(self, method, payload)
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host, hooks=[Hook()],
+                  parser=SlowParser(), cache_payloads=True, parsed_cache_size=0,
+                  cache=MemoryCache(timeout=60), stale_while_revalidate=60,
+                  cache_policy={'/statuses/show.json': {'cache_timeout': 1}})
+        api.get_status(id=1)
+        sleep(1.1)
+
+        # stale hits return at once while a single refresh runs
+        self.server.response_delay = 0.5
+        start = time()
+        for i in range(5):
+            self.assertEqual(api.get_status(id=1).id, 10000)
+        self.assert_(time() - start < 0.5, 'Stale entry was not served')
+        sleep(1)
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(states, ['miss'] + ['stale'] * 5 + ['revalidated'])
+        for info in infos:
+            # timings land on the request they belong to
+            self.assert_('parse' in info.timings, info.cache)
+
+        api.get_status(id=1)
+        self.assertEqual(states[-1], 'hit')
+        self.assertEqual(self.server.request_count, 2)
+
+    def testcachepolicy(self):
+        # endpoints marked cacheable = False are always requested
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host,
+                  cache=MemoryCache(timeout=60))
+        api.rate_limit_status()
+        api.rate_limit_status()
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(api.cache.count(), 0)
+
+        # get_user remembers missing users
+        self.server.fixtures['/users/show.json'] = (404, '{"error": "Not found"}')
+        self.assertRaises(TweepError, api.get_user, 'missing')
+        self.assertRaises(TweepError, api.get_user, 'missing')
+        self.assertEqual(self.server.request_count, 3)
+
+        # endpoint timeouts longer than the cache wide timeout are kept
+        # by every backend, including stale-while-revalidate
+        class Hook(RequestHook):
+            def __init__(self):
+                self.states = []
+            def post_request(self, info):
+                self.states.append(info.cache)
+        os.mkdir('cache_test_dir')
+        try:
+            for cache in (MemoryCache(timeout=0.2), FileCache('cache_test_dir', 0.2),
+                          LogCache('cache_test_log', 0.2)):
+                hook = Hook()
+                api = API(BasicAuthHandler('user1', 'password'), host=self.host,
+                          cache=cache, hooks=[hook], stale_while_revalidate=2,
+                          cache_policy={'/statuses/show.json': {'cache_timeout': 0.6}})
+                sweeper = CacheSweeper(cache, interval=0.05)
+                sweeper.start()
+                api.get_status(id=1)
+                sleep(0.3)
+                api.get_status(id=1)
+                sleep(0.6)
+                api.get_status(id=1)
+                sweeper.stop()
+                self.assertEqual(hook.states[:3], ['miss', 'hit', 'stale'], cache)
+        finally:
+            shutil.rmtree('cache_test_dir')
+            shutil.rmtree('cache_test_log')
+
+    def testboundpaths(self):
+        calls = []
+        class Hook(RequestHook):
+            def post_request(self, info):
+                path, query = (info.url.split('?', 1) + [''])[:2]
+                calls.append((info.method, path, dict(cgi.parse_qsl(query)), info.status))
+        self.api.hooks.append(Hook())
+
+        self.api.create_list('tweepy', 'private', 'Test list')
+        self.api.update_list('tweepy', 'tweepy two', description='Renamed')
+        self.api.destroy_list('tweepy')
+        self.api.add_list_member('tweepy', 12)
+        self.api.remove_list_member('tweepy', id=12)
+        self.assert_(self.api.is_list_member('owner', 'tweepy', 12))
+        self.assert_(self.api.is_subscribed_list('owner', 'tweepy', 12))
+        self.assert_(self.api.exists_block('twitter'))
+        self.assert_(self.api.test())
+        self.assertEqual(calls, [
+            ('POST', '/1/user1/lists.json',
+             {'name': 'tweepy', 'mode': 'private', 'description': 'Test list'}, 200),
+            ('POST', '/1/user1/lists/tweepy.json',
+             {'name': 'tweepy two', 'description': 'Renamed'}, 200),
+            ('DELETE', '/1/user1/lists/tweepy.json', {}, 200),
+            ('POST', '/1/user1/tweepy/members.json', {'id': '12'}, 200),
+            ('DELETE', '/1/user1/tweepy/members.json', {'id': '12'}, 200),
+            ('GET', '/1/owner/tweepy/members/12.json', {}, 200),
+            ('GET', '/1/owner/tweepy/subscribers/12.json', {}, 200),
+            ('GET', '/1/blocks/exists.json', {'id': 'twitter'}, 200),
+            ('GET', '/1/help/test.json', {}, 200),
+        ])
+
+    def teststream(self):
+        statuses = []
+        class Listener(StreamListener):
+            def on_status(self, status):
+                statuses.append(status)
+                if len(statuses) == 50:
+                    return False
+        stream = Stream('user1', 'password', Listener())
+        stream.host = self.host
+        stream.sample()
+        self.assertEqual(len(statuses), 50)
+
+    def teststreammanager(self):
+        class Listener(StreamListener):
+            def __init__(self, limit):
+                StreamListener.__init__(self)
+                self.limit = limit
+                self.statuses = []
+                self.errors = []
+            def on_status(self, status):
+                self.statuses.append(status)
+                if len(self.statuses) == self.limit:
+                    return False
+            def on_error(self, status_code):
+                self.errors.append(status_code)
+                return False
+
+        self.server.stream_chunked = True
+        manager = StreamManager()
+        manager.start()
+        try:
+            streams = []
+            for i in range(6):
+                stream = Stream('user%i' % i, 'password', Listener(100 + i),
+                        manager=manager, compression=i % 2 == 0)
+                stream.host = self.host
+                if i % 3 == 0:
+                    stream.sample()
+                else:
+                    stream.filter(track=['tweepy%i' % i])
+                streams.append(stream)
+            failing = Stream('user1', 'password', Listener(1), manager=manager)
+            failing.host = self.host
+            failing.url = '/1/statuses/missing.json'
+            failing._start(False)
+
+            start = time()
+            while [s for s in streams + [failing] if s.running] and time() - start < 10:
+                sleep(0.05)
+        finally:
+            manager.stop()
+
+        for i, stream in enumerate(streams):
+            self.assertEqual(len(stream.listener.statuses), 100 + i)
+            self.assertEqual(stream.stats.messages, 100 + i)
+            self.assertEqual(stream.stats.connects, 1)
+        self.assertEqual(failing.listener.errors, [404])
+        self.assertEqual(failing.stats.errors, {404: 1})
+
+        # hosts which do not resolve fail like other network errors
+        manager = StreamManager()
+        manager.start()
+        try:
+            policy = ReconnectPolicy(network_delay=0.05)
+            unknown = Stream('user1', 'password', Listener(1), manager=manager,
+                    retry_count=1, reconnect_policy=policy)
+            unknown.host = 'host.invalid'
+            unknown.sample()
+            start = time()
+            while unknown.running and time() - start < 5:
+                sleep(0.05)
+            self.failIf(unknown.running)
+            self.assertEqual(unknown.stats.errors, {'network': 2})
+
+            # streams not yet picked up when the manager stops are finished
+            sleep(0.1)
+            late = Stream('user1', 'password', Listener(1), manager=manager)
+            late.host = self.host
+            late.sample()
+        finally:
+            manager.stop()
+        self.failIf(late.running)
+
+    def teststreamreconnect(self):
+        class Listener(StreamListener):
+            def on_error(self, status_code):
+                return True
+        policy = ReconnectPolicy(http_delay=0.05, http_max_delay=0.2)
+        stream = Stream('user1', 'password', Listener(), reconnect_policy=policy)
+        stream.host = self.host
+        stream.url = '/1/statuses/missing.json'
+        thread = Thread(target=stream._start, args=(False,))
+        thread.start()
+        sleep(0.6)
+        stream.disconnect()
+        thread.join(1)
+        self.failIf(thread.isAlive())
+        self.assert_(3 <= policy.counts[404] <= 6)
+
+    def teststreamexception(self):
+        class Listener(StreamListener):
+            def __init__(self):
+                StreamListener.__init__(self)
+                self.exceptions = []
+            def on_status(self, status):
+                raise ValueError('bad status')
+            def on_exception(self, exception):
+                self.exceptions.append(exception)
+        collector = MetricsCollector()
+        stream = Stream('user1', 'password', Listener(), metrics=collector)
+        stream.host = self.host
+        self.assertRaises(ValueError, stream.sample)
+        self.failIf(stream.running)
+        self.assertEqual(len(stream.listener.exceptions), 1)
+        self.assertEqual(stream.reconnect_policy.counts, {'exception': 1})
+        self.assertEqual(collector.snapshot()['/1/statuses/sample.json'].errors,
+                         {'exception': 1})
+
+        # managed streams report it the same way
+        manager = StreamManager()
+        manager.start()
+        try:
+            stream = Stream('user1', 'password', Listener(), manager=manager)
+            stream.host = self.host
+            stream.sample()
+            start = time()
+            while stream.running and time() - start < 5:
+                sleep(0.05)
+        finally:
+            manager.stop()
+        self.assertEqual(len(stream.listener.exceptions), 1)
+        self.assertEqual(stream.stats.errors, {'exception': 1})
+        self.assertEqual(stream.reconnect_policy.counts, {'exception': 1})
+
+    def testtimeouts(self):
+        collector = MetricsCollector()
+        self.api.hooks.append(collector)
+        self.server.response_delay = 0.5
+        self.assertRaises(TweepError, self.api.get_status, id=1, read_timeout=0.1)
+        self.assertRaises(TweepError, self.api.get_status, id=1, request_timeout=0.1)
+        self.assertEqual(self.api.get_status(id=1, read_timeout=2).id, 10000)
+
+        # callers sharing a request in progress keep their own deadline
+        self.api.cache = MemoryCache(timeout=60)
+        self.server.response_delay = 1
+        t = Thread(target=self.api.get_status, kwargs={'id': 1})
+        t.start()
+        sleep(0.1)
+        start = time()
+        self.assertRaises(TweepError, self.api.get_status, id=1, request_timeout=0.2)
+        self.assert_(time() - start < 0.5, 'Deadline was not applied while waiting')
+        t.join()
+        self.api.cache = None
+        self.assertEqual(collector.snapshot()['/statuses/show.json'].errors, {'timeout': 3})
+
+        self.server.response_delay = 0.1
+        pages = []
+        def crawl():
+            for page in Cursor(self.api.followers).pages(time_budget=0.15):
+                pages.append(page)
+        self.assertRaises(TweepError, crawl)
+        self.assert_(len(pages) < 3)
+
+    def testpooledtransport(self):
+        transport = PooledTransport()
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host, transport=transport)
+        for i in range(5):
+            api.get_status(id=1)
+        self.assertEqual(len(self.server._client_threads), 1)
+        self.assertEqual(transport.idle_count(), 1)
+        transport.close()
+
+    def testoauthtransport(self):
+        auth = OAuthHandler('consumer_key', 'consumer_secret', transport=PooledTransport())
+        auth.OAUTH_HOST = self.host
+        self.assert_('oauth_token=request_token' in auth.get_authorization_url())
+        self.assertEqual(auth.get_access_token('verifier').key, 'access_token')
+
+    def testcredentialpool(self):
+        self.server.rate_limit = 10
+        handlers = [BasicAuthHandler('user%i' % i, 'password') for i in range(3)]
+        pool = CredentialPool(handlers)
+        api = API(pool, host=self.host, search_host=self.host)
+        credential = lambda i: 'Basic %s' % handlers[i]._b64up
+
+        # public reads spread over every credential, within their limits
+        for i in range(20):
+            api.get_status(id=1)
+        calls = [self.server.calls_made.get(credential(i), 0) for i in range(3)]
+        self.assertEqual(sum(calls), 20)
+        self.assert_(max(calls) <= 10)
+        self.assertEqual(sorted(pool.remaining), [10 - c for c in sorted(calls, reverse=True)])
+
+        # calls on behalf of the user stick to the first credential
+        first = calls[0]
+        api.home_timeline()
+        api.update_status('hello')
+        self.assertEqual(self.server.calls_made[credential(0)], first + 2)
+        self.assertEqual(pool.get_username(), 'user0')
+
+    def testuploadimage(self):
+        f = open('test_image.png', 'wb')
+        f.write(os.urandom(200 * 1024))
+        f.close()
+        urls = []
+        class Hook(RequestHook):
+            def post_request(self, info):
+                urls.append(info.url)
+        self.api.hooks.append(Hook())
+        try:
+            self.assertEqual(self.api.update_profile_image('test_image.png').screen_name, 'user0')
+            user = self.api.update_profile_background_image('test_image.png', tile='true')
+            self.assertEqual(user.screen_name, 'user0')
+            self.api.update_profile_background_image('test_image.png', 'false')
+        finally:
+            os.remove('test_image.png')
+        self.assertEqual(urls, ['/1/account/update_profile_image.json',
+                '/1/account/update_profile_background_image.json?tile=true',
+                '/1/account/update_profile_background_image.json?tile=false'])
+
+    def testidentitycache(self):
+        server_host = self.host
+        class LocalTransport(HTTPTransport):
+            def connection(self, host, secure=False, timeout=None):
+                return HTTPTransport.connection(self, server_host, False, timeout)
+
+        cache = MemoryCache(timeout=0)
+        auth = OAuthHandler('consumer', 'secret', transport=LocalTransport(),
+                identity_cache=cache)
+        auth.set_access_token('token', 'token secret')
+        self.server.response_delay = 0.2
+        names = []
+        threads = [Thread(target=lambda: names.append(auth.get_username())) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(names, ['user0'] * 5)
+        self.assertEqual(self.server.request_count, 1)
+
+        # the identity cache answers for other handlers with the same token
+        auth = OAuthHandler('consumer', 'secret', transport=LocalTransport(),
+                identity_cache=cache)
+        auth.set_access_token('token', 'token secret')
+        self.assertEqual(auth.get_username(), 'user0')
+        auth.set_access_token('seeded', 'token secret')
+        auth.set_username('seeded_user')
+        self.assertEqual(cache.get('username:seeded'), 'seeded_user')
+        self.assertEqual(self.server.request_count, 1)
+
+        # failed lookups are not repeated right away
+        self.server.fixtures['/account/verify_credentials.json'] = (401, '{"error": "no"}')
+        auth = OAuthHandler('consumer', 'secret', transport=LocalTransport())
+        auth.set_access_token('invalid', 'token secret')
+        self.assertRaises(TweepError, auth.get_username)
+        self.assertRaises(TweepError, auth.get_username)
+        self.assertEqual(self.server.request_count, 2)
+
+    def testcompression(self):
+        collector = MetricsCollector()
+        self.api.hooks.append(collector)
+        plain = [s.id for s in self.api.home_timeline()]
+        self.api.compression = False
+        self.assertEqual([s.id for s in self.api.home_timeline()], plain)
+        self.api.compression = True
+        self.assert_('decompress' in collector.snapshot()['/statuses/home_timeline.json'].latency)
+
+        statuses = []
+        class Listener(StreamListener):
+            def on_status(self, status):
+                statuses.append(status)
+                if len(statuses) == 50:
+                    return False
+        stream = Stream('user1', 'password', Listener(), compression=True, buffer_size=64)
+        stream.host = self.host
+        stream.sample()
+        self.assertEqual(len(statuses), 50)
+
+        # messages on quiet streams are delivered as they arrive
+        self.server.stream_delay = 0.1
+        for compression in (False, True):
+            statuses = []
+            stream = Stream('user1', 'password', Listener(), compression=compression)
+            stream.host = self.host
+            thread = Thread(target=stream.sample)
+            start = time()
+            thread.start()
+            while len(statuses) < 5 and time() - start < 5:
+                sleep(0.05)
+            stream.disconnect()
+            thread.join(1)
+            self.assert_(len(statuses) >= 5)
+
+    def testconditionalget(self):
+        states = []
+        class Hook(RequestHook):
+            def post_request(self, info):
+                states.append(info.cache)
+        api = API(BasicAuthHandler('user1', 'password'), host=self.host, hooks=[Hook()],
+                  cache=MemoryCache(timeout=60), revalidate_window=60,
+                  cache_policy={'/users/show.json': {'cache_timeout': 0.1}})
+        api.get_user('twitter')
+        sleep(0.2)
+        self.assertEqual(api.get_user('twitter').screen_name, 'user0')
+        self.assertEqual(states, ['miss', 'revalidated'])
+
+        # revalidated models are stored again by pickling caches
+        api.cache = MemoryCache(timeout=60, compress_level=6)
+        for i in range(3):
+            api.get_user('twitter')
+            sleep(0.2)
+        self.assertEqual(states[2:], ['miss', 'revalidated', 'revalidated'])
+
+    def testrecordreplay(self):
+        recorder = RecordingTransport('test_recording.gz')
+        try:
+            self.api.transport = recorder
+            ids = [s.id for s in self.api.home_timeline()]
+            recorder.close()
+
+            self.server.stop()
+            replay = ReplayTransport('test_recording.gz', speed=0)
+            api = API(BasicAuthHandler('user1', 'password'), host='localhost:1', transport=replay)
+            self.assertEqual([s.id for s in api.home_timeline()], ids)
+            self.assertRaises(TweepError, api.home_timeline)
+            replay.rewind()
+            self.assertEqual([s.id for s in api.home_timeline()], ids)
+        finally:
+            os.remove('test_recording.gz')
 
 
 if __name__ == '__main__':
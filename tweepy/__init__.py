@@ -12,9 +12,12 @@ __license__ = 'MIT'
 from tweepy.models import Status, User, DirectMessage, Friendship, SavedSearch, SearchResult, ModelFactory
 from tweepy.error import TweepError
 from tweepy.api import API
-from tweepy.cache import Cache, MemoryCache, FileCache
-from tweepy.auth import BasicAuthHandler, OAuthHandler
-from tweepy.streaming import Stream, StreamListener
+from tweepy.cache import Cache, MemoryCache, LRUCache, FileCache, LogCache, LayeredCache, MemCacheCache, CacheSweeper
+from tweepy.hooks import RequestHook, RequestInfo
+from tweepy.metrics import MetricsCollector, Histogram
+from tweepy.transport import HTTPTransport, PooledTransport, RecordingTransport, ReplayTransport
+from tweepy.auth import BasicAuthHandler, OAuthHandler, CredentialPool
+from tweepy.streaming import Stream, StreamListener, StreamManager, ReconnectPolicy
 from tweepy.cursor import Cursor
 
 # Global, unauthenticated instance of API
@@ -6,8 +6,11 @@ import os
 import mimetypes
 
 from tweepy.binder import bind_api
+from tweepy.cache import LRUCache
+from tweepy.utils import SingleFlight, MultipartBody
 from tweepy.error import TweepError
 from tweepy.parsers import ModelParser
+from tweepy.transport import HTTPTransport
 
 
 class API(object):
@@ -17,7 +20,10 @@ class API(object):
             host='api.twitter.com', search_host='search.twitter.com',
              cache=None, secure=False, api_root='/1', search_root='',
             retry_count=0, retry_delay=0, retry_errors=None,
-            parser=None):
+            parser=None, cache_payloads=False, parsed_cache_size=64,
+            stale_while_revalidate=0, cache_policy=None, hooks=None,
+            transport=None, connect_timeout=None, read_timeout=None,
+            request_timeout=None, compression=True, revalidate_window=0):
         self.auth = auth_handler
         self.host = host
         self.search_host = search_host
@@ -30,6 +36,50 @@ class API(object):
         self.retry_errors = retry_errors
         self.parser = parser or ModelParser()
 
+        # When cache_payloads is enabled the cache holds raw response
+        # bodies which are re-parsed on a hit. The most recently parsed
+        # results are kept in a small in-process LRU so hot entries
+        # skip parsing entirely.
+        self.cache_payloads = cache_payloads
+        self.parsed_cache = LRUCache(timeout=0, max_entries=parsed_cache_size)
+
+        # Number of seconds an expired cache entry may still be served
+        # while a single background request refreshes it.
+        self.stale_while_revalidate = stale_while_revalidate
+        self.flights = SingleFlight()
+
+        # Number of seconds, past the stale-while-revalidate window, that
+        # expired entries are kept when the response had an ETag or
+        # Last-Modified header. Refreshing them sends a conditional
+        # request and a 304 Not Modified response renews the entry
+        # without transferring or parsing the body again.
+        self.revalidate_window = revalidate_window
+
+        # Per endpoint cache settings keyed by path, for example
+        # {'/users/show.json': {'cache_timeout': 3600}}. Overrides the
+        # cacheable, cache_timeout and negative_cache_timeout options
+        # given to bind_api.
+        self.cache_policy = cache_policy or {}
+
+        # RequestHook instances called before and after every API
+        # method call with a RequestInfo describing the request.
+        self.hooks = list(hooks or [])
+
+        # Opens the HTTP connections, see tweepy.transport
+        self.transport = transport or HTTPTransport()
+
+        # Seconds to wait for a connection, for each socket read and for
+        # a whole call including retries. None waits forever. All three
+        # can be overridden per call, which also accepts an absolute
+        # deadline (a time.time() value).
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.request_timeout = request_timeout
+
+        # Ask for gzip compressed responses, which are decoded before
+        # being parsed or cached.
+        self.compression = compression
+
     """ statuses/public_timeline """
     public_timeline = bind_api(
         path = '/statuses/public_timeline.json',
@@ -139,7 +189,8 @@ class API(object):
     get_user = bind_api(
         path = '/users/show.json',
         payload_type = 'user',
-        allowed_param = ['id', 'user_id', 'screen_name']
+        allowed_param = ['id', 'user_id', 'screen_name'],
+        negative_cache_timeout = 30
     )
 
     """ Get the authenticated user """
@@ -250,20 +301,24 @@ class API(object):
     )
 
     """ account/verify_credentials """
+    _verify_credentials = bind_api(
+        path = '/account/verify_credentials.json',
+        payload_type = 'user',
+        require_auth = True,
+        cacheable = False
+    )
+
     def verify_credentials(self):
         try:
-            return bind_api(
-                path = '/account/verify_credentials.json',
-                payload_type = 'user',
-                require_auth = True
-            )(self)
+            return self._verify_credentials()
         except TweepError:
             return False
 
     """ account/rate_limit_status """
     rate_limit_status = bind_api(
         path = '/account/rate_limit_status.json',
-        payload_type = 'json'
+        payload_type = 'json',
+        cacheable = False
     )
 
     """ account/update_delivery_device """
@@ -287,25 +342,30 @@ class API(object):
     )
 
     """ account/update_profile_image """
+    _update_profile_image = bind_api(
+        path = '/account/update_profile_image.json',
+        method = 'POST',
+        payload_type = 'user',
+        require_auth = True
+    )
+
     def update_profile_image(self, filename):
         headers, post_data = API._pack_image(filename, 700)
-        return bind_api(
-            path = '/account/update_profile_image.json',
-            method = 'POST',
-            payload_type = 'user',
-            require_auth = True
-        )(self, post_data=post_data, headers=headers)
+        return self._update_profile_image(post_data=post_data, headers=headers)
 
     """ account/update_profile_background_image """
+    _update_profile_background_image = bind_api(
+        path = '/account/update_profile_background_image.json',
+        method = 'POST',
+        payload_type = 'user',
+        allowed_param = ['tile'],
+        require_auth = True
+    )
+
     def update_profile_background_image(self, filename, *args, **kargs):
         headers, post_data = API._pack_image(filename, 800)
-        bind_api(
-            path = '/account/update_profile_background_image.json',
-            method = 'POST',
-            payload_type = 'user',
-            allowed_param = ['tile'],
-            require_auth = True
-        )(self, post_data=post_data, headers=headers)
+        return self._update_profile_background_image(post_data=post_data,
+                headers=headers, *args, **kargs)
 
     """ account/update_profile """
     update_profile = bind_api(
@@ -378,13 +438,15 @@ class API(object):
     )
 
     """ blocks/exists """
+    _exists_block = bind_api(
+        path = '/blocks/exists.json',
+        allowed_param = ['id', 'user_id', 'screen_name'],
+        require_auth = True
+    )
+
     def exists_block(self, *args, **kargs):
         try:
-            bind_api(
-                path = '/blocks/exists.json',
-                allowed_param = ['id', 'user_id', 'screen_name'],
-                require_auth = True
-            )(self, *args, **kargs)
+            self._exists_block(*args, **kargs)
         except TweepError:
             return False
         return True
@@ -447,40 +509,40 @@ class API(object):
     )
 
     """ help/test """
+    _test = bind_api(
+        path = '/help/test.json',
+    )
+
     def test(self):
         try:
-            bind_api(
-                path = '/help/test.json',
-            )(self)
+            self._test()
         except TweepError:
             return False
         return True
 
-    def create_list(self, *args, **kargs):
-        return bind_api(
-            path = '/%s/lists.json' % self.auth.get_username(),
-            method = 'POST',
-            payload_type = 'list',
-            allowed_param = ['name', 'mode', 'description'],
-            require_auth = True
-        )(self, *args, **kargs)
-
-    def destroy_list(self, slug):
-        return bind_api(
-            path = '/%s/lists/%s.json' % (self.auth.get_username(), slug),
-            method = 'DELETE',
-            payload_type = 'list',
-            require_auth = True
-        )(self)
-
-    def update_list(self, slug, *args, **kargs):
-        return bind_api(
-            path = '/%s/lists/%s.json' % (self.auth.get_username(), slug),
-            method = 'POST',
-            payload_type = 'list',
-            allowed_param = ['name', 'mode', 'description'],
-            require_auth = True
-        )(self, *args, **kargs)
+    create_list = bind_api(
+        path = '/{user}/lists.json',
+        method = 'POST',
+        payload_type = 'list',
+        allowed_param = ['name', 'mode', 'description'],
+        require_auth = True
+    )
+
+    destroy_list = bind_api(
+        path = '/{user}/lists/{slug}.json',
+        method = 'DELETE',
+        payload_type = 'list',
+        allowed_param = ['slug'],
+        require_auth = True
+    )
+
+    update_list = bind_api(
+        path = '/{user}/lists/{slug}.json',
+        method = 'POST',
+        payload_type = 'list',
+        allowed_param = ['slug', 'name', 'mode', 'description'],
+        require_auth = True
+    )
 
     lists = bind_api(
         path = '/{user}/lists.json',
@@ -515,23 +577,21 @@ class API(object):
         allowed_param = ['owner', 'slug']
     )
 
-    def add_list_member(self, slug, *args, **kargs):
-        return bind_api(
-            path = '/%s/%s/members.json' % (self.auth.get_username(), slug),
-            method = 'POST',
-            payload_type = 'list',
-            allowed_param = ['id'],
-            require_auth = True
-        )(self, *args, **kargs)
-
-    def remove_list_member(self, slug, *args, **kargs):
-        return bind_api(
-            path = '/%s/%s/members.json' % (self.auth.get_username(), slug),
-            method = 'DELETE',
-            payload_type = 'list',
-            allowed_param = ['id'],
-            require_auth = True
-        )(self, *args, **kargs)
+    add_list_member = bind_api(
+        path = '/{user}/{slug}/members.json',
+        method = 'POST',
+        payload_type = 'list',
+        allowed_param = ['slug', 'id'],
+        require_auth = True
+    )
+
+    remove_list_member = bind_api(
+        path = '/{user}/{slug}/members.json',
+        method = 'DELETE',
+        payload_type = 'list',
+        allowed_param = ['slug', 'id'],
+        require_auth = True
+    )
 
     list_members = bind_api(
         path = '/{owner}/{slug}/members.json',
@@ -539,12 +599,15 @@ class API(object):
         allowed_param = ['owner', 'slug', 'cursor']
     )
 
+    _is_list_member = bind_api(
+        path = '/{owner}/{slug}/members/{id}.json',
+        payload_type = 'user',
+        allowed_param = ['owner', 'slug', 'id']
+    )
+
     def is_list_member(self, owner, slug, user_id):
         try:
-            return bind_api(
-                path = '/%s/%s/members/%s.json' % (owner, slug, user_id),
-                payload_type = 'user'
-            )(self)
+            return self._is_list_member(owner, slug, user_id)
         except TweepError:
             return False
 
@@ -570,12 +633,15 @@ class API(object):
         allowed_param = ['owner', 'slug', 'cursor']
     )
 
+    _is_subscribed_list = bind_api(
+        path = '/{owner}/{slug}/subscribers/{id}.json',
+        payload_type = 'user',
+        allowed_param = ['owner', 'slug', 'id']
+    )
+
     def is_subscribed_list(self, owner, slug, user_id):
         try:
-            return bind_api(
-                path = '/%s/%s/subscribers/%s.json' % (owner, slug, user_id),
-                payload_type = 'user'
-            )(self)
+            return self._is_subscribed_list(owner, slug, user_id)
         except TweepError:
             return False
 
@@ -583,7 +649,8 @@ class API(object):
     trends_available = bind_api(
         path = '/trends/available.json',
         payload_type = 'json',
-        allowed_param = ['lat', 'long']
+        allowed_param = ['lat', 'long'],
+        cache_timeout = 3600
     )
 
     """ trends/location """
@@ -622,7 +689,8 @@ class API(object):
         search_api = True,
         path = '/trends/daily.json',
         payload_type = 'json',
-        allowed_param = ['date', 'exclude']
+        allowed_param = ['date', 'exclude'],
+        cache_timeout = 3600
     )
 
     """ trends/weekly """
@@ -630,7 +698,8 @@ class API(object):
         search_api = True,
         path = '/trends/weekly.json',
         payload_type = 'json',
-        allowed_param = ['date', 'exclude']
+        allowed_param = ['date', 'exclude'],
+        cache_timeout = 3600
     )
 
     """ Internal use only """
@@ -652,24 +721,15 @@ class API(object):
         if file_type not in ['image/gif', 'image/jpeg', 'image/png']:
             raise TweepError('Invalid file type for image: %s' % file_type)
 
-        # build the mulitpart-formdata body
-        fp = open(filename, 'rb')
+        # build the mulitpart-formdata body, the file is streamed
+        # from disk while the request is sent
         BOUNDARY = 'Tw3ePy'
-        body = []
-        body.append('--' + BOUNDARY)
-        body.append('Content-Disposition: form-data; name="image"; filename="%s"' % filename)
-        body.append('Content-Type: %s' % file_type)
-        body.append('')
-        body.append(fp.read())
-        body.append('--' + BOUNDARY + '--')
-        body.append('')
-        fp.close()
-        body = '\r\n'.join(body)
+        body = MultipartBody('image', filename, file_type, BOUNDARY)
 
         # build headers
         headers = {
             'Content-Type': 'multipart/form-data; boundary=Tw3ePy',
-            'Content-Length': len(body)
+            'Content-Length': str(len(body))
         }
 
         return headers, body
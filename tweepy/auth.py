@@ -2,12 +2,24 @@
 # Copyright 2009-2010 Joshua Roesslein
 # See LICENSE for details.
 
-from urllib2 import Request, urlopen
 import base64
+import binascii
+import hmac
+import os
+import re
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    import sha as sha1 # python 2.4
 
 from tweepy import oauth
 from tweepy.error import TweepError
 from tweepy.api import API
+from tweepy.transport import HTTPTransport
+from tweepy.utils import SingleFlight
 
 
 class AuthHandler(object):
@@ -20,6 +32,10 @@ class AuthHandler(object):
         """Return the username of the authenticated user"""
         raise NotImplementedError
 
+    def handle_response(self, resp):
+        """Called with the response to a request authenticated by apply_auth"""
+        pass
+
 
 class BasicAuthHandler(AuthHandler):
 
@@ -34,13 +50,121 @@ class BasicAuthHandler(AuthHandler):
         return self.username
 
 
+class NonceGenerator(object):
+    """Generates OAuth nonces from os.urandom.
+
+    Each nonce is size random bytes, hex encoded. Random bytes are read
+    for batch_size nonces at once and sliced per nonce. Safe to share
+    between threads.
+    """
+
+    def __init__(self, size=16, batch_size=256):
+        self.size = size
+        self.batch_size = batch_size
+        self._buffer = ''
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        size = self.size
+        self._lock.acquire()
+        try:
+            pos = self._pos
+            if pos + size > len(self._buffer):
+                self._buffer = os.urandom(size * self.batch_size)
+                pos = 0
+            self._pos = pos + size
+            nonce = self._buffer[pos:pos + size]
+        finally:
+            self._lock.release()
+        return binascii.hexlify(nonce)
+
+
+class OAuthSigner(object):
+    """Signs API requests with HMAC-SHA1 for one consumer and token.
+
+    Produces the same signatures as oauth.OAuthRequest.sign_request,
+    but the signing key and the oauth parameters which do not change
+    between requests are escaped once, the HMAC is keyed once and copied
+    for each signature, and normalized request urls are cached.
+    nonce_generator is called for the nonce of each signature.
+    """
+
+    max_urls = 1000
+
+    def __init__(self, consumer, token=None, nonce_generator=None):
+        self.consumer = consumer
+        self.token = token
+        self.nonce_generator = nonce_generator or NonceGenerator()
+
+        key = oauth.escape(consumer.secret) + '&'
+        params = [
+            ('oauth_consumer_key', consumer.key),
+            ('oauth_signature_method', 'HMAC-SHA1'),
+            ('oauth_version', oauth.VERSION),
+        ]
+        if token:
+            key += oauth.escape(token.secret)
+            params.append(('oauth_token', token.key))
+            if token.callback:
+                params.append(('oauth_callback', token.callback))
+        self._hmac = hmac.new(key, digestmod=sha1)
+        self._params = [(k, oauth.escape(oauth._utf8_str(v))) for k, v in params]
+        self._header = 'OAuth realm=""' + ''.join([', %s="%s"' % kv for kv in self._params])
+        self._urls = {}
+
+    def normalized_url(self, url):
+        """Return the escaped scheme://host/path of url"""
+        base = url.split('?', 1)[0]
+        normalized = self._urls.get(base)
+        if normalized is None:
+            if len(self._urls) >= self.max_urls:
+                self._urls.clear()
+            request = oauth.OAuthRequest(http_url=base)
+            normalized = self._urls[base] = oauth.escape(request.get_normalized_http_url())
+        return normalized
+
+    def sign(self, method, url, parameters=None, timestamp=None, nonce=None):
+        """Return the Authorization header value for a request"""
+        if timestamp is None:
+            timestamp = oauth.generate_timestamp()
+        if nonce is None:
+            nonce = self.nonce_generator()
+        timestamp = str(timestamp)
+        nonce = oauth.escape(str(nonce))
+
+        pairs = self._params + [('oauth_nonce', nonce), ('oauth_timestamp', timestamp)]
+        if parameters:
+            escape, utf8 = oauth.escape, oauth._utf8_str
+            pairs.extend([(escape(utf8(k)), escape(utf8(v))) for k, v in parameters.iteritems()])
+        pairs.sort()
+        raw = '%s&%s&%s' % (method.upper(), self.normalized_url(url),
+                oauth.escape('&'.join(['%s=%s' % kv for kv in pairs])))
+
+        hashed = self._hmac.copy()
+        hashed.update(raw)
+        signature = binascii.b2a_base64(hashed.digest())[:-1]
+        return '%s, oauth_nonce="%s", oauth_timestamp="%s", oauth_signature="%s"' % (
+                self._header, nonce, timestamp, oauth.escape(signature))
+
+
 class OAuthHandler(AuthHandler):
-    """OAuth authentication handler"""
+    """OAuth authentication handler
+
+    get_username() looks the username up with verify_credentials once,
+    concurrent callers share that call. A failed lookup is remembered for
+    identity_error_timeout seconds. Usernames are also kept in
+    identity_cache (any tweepy Cache, keyed by access token) if given,
+    which lets a persistent cache answer across restarts. set_username()
+    seeds the username when it is already known.
+    """
 
     OAUTH_HOST = 'twitter.com'
     OAUTH_ROOT = '/oauth/'
+    identity_error_timeout = 30
 
-    def __init__(self, consumer_key, consumer_secret, callback=None, secure=False):
+    def __init__(self, consumer_key, consumer_secret, callback=None, secure=False,
+            transport=None, nonce_generator=None, identity_cache=None):
         self._consumer = oauth.OAuthConsumer(consumer_key, consumer_secret)
         self._sigmethod = oauth.OAuthSignatureMethod_HMAC_SHA1()
         self.request_token = None
@@ -48,6 +172,13 @@ class OAuthHandler(AuthHandler):
         self.callback = callback
         self.username = None
         self.secure = secure
+        self.transport = transport or HTTPTransport()
+        # called for the oauth_nonce of each request, see NonceGenerator
+        self.nonce_generator = nonce_generator or NonceGenerator()
+        self.identity_cache = identity_cache
+        self._signer = None
+        self._identity_flight = SingleFlight()
+        self._identity_error = None
 
     def _get_oauth_url(self, endpoint):
         if self.secure:
@@ -57,13 +188,29 @@ class OAuthHandler(AuthHandler):
 
         return prefix + self.OAUTH_HOST + self.OAUTH_ROOT + endpoint
 
+    def _fetch_token(self, endpoint, request):
+        conn = self.transport.connection(self.OAUTH_HOST, self.secure)
+        try:
+            conn.request('GET', self.OAUTH_ROOT + endpoint, headers=request.to_header())
+            resp = conn.getresponse()
+            body = resp.read()
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise TweepError('OAuth token request failed: status code = %s' % resp.status)
+        return oauth.OAuthToken.from_string(body)
+
+    def get_signer(self):
+        """Return the OAuthSigner for the current consumer and access token"""
+        signer = self._signer
+        if signer is None or signer.token is not self.access_token \
+                or signer.consumer is not self._consumer:
+            signer = self._signer = OAuthSigner(self._consumer, self.access_token,
+                    self.nonce_generator)
+        return signer
+
     def apply_auth(self, url, method, headers, parameters):
-        request = oauth.OAuthRequest.from_consumer_and_token(
-            self._consumer, http_url=url, http_method=method,
-            token=self.access_token, parameters=parameters
-        )
-        request.sign_request(self._sigmethod, self._consumer, self.access_token)
-        headers.update(request.to_header())
+        headers['Authorization'] = self.get_signer().sign(method, url, parameters)
 
     def _get_request_token(self):
         try:
@@ -71,9 +218,9 @@ class OAuthHandler(AuthHandler):
             request = oauth.OAuthRequest.from_consumer_and_token(
                 self._consumer, http_url=url, callback=self.callback
             )
+            request.set_parameter('oauth_nonce', self.nonce_generator())
             request.sign_request(self._sigmethod, self._consumer, None)
-            resp = urlopen(Request(url, headers=request.to_header()))
-            return oauth.OAuthToken.from_string(resp.read())
+            return self._fetch_token('request_token', request)
         except Exception, e:
             raise TweepError(e)
 
@@ -116,22 +263,140 @@ class OAuthHandler(AuthHandler):
                 token=self.request_token, http_url=url,
                 verifier=str(verifier)
             )
+            request.set_parameter('oauth_nonce', self.nonce_generator())
             request.sign_request(self._sigmethod, self._consumer, self.request_token)
 
             # send request
-            resp = urlopen(Request(url, headers=request.to_header()))
-            self.access_token = oauth.OAuthToken.from_string(resp.read())
+            self.access_token = self._fetch_token('access_token', request)
             return self.access_token
         except Exception, e:
             raise TweepError(e)
 
+    def _identity_key(self):
+        if self.access_token:
+            return 'username:%s' % self.access_token.key
+
+    def set_username(self, username):
+        """Set the username of the access token owner"""
+        self.username = username
+        key = self._identity_key()
+        if self.identity_cache and key:
+            self.identity_cache.store(key, username)
+
     def get_username(self):
         if self.username is None:
-            api = API(self)
-            user = api.verify_credentials()
-            if user:
-                self.username = user.screen_name
-            else:
-                raise TweepError("Unable to get username, invalid oauth token!")
+            self.username = self._identity_flight.do('username', self._lookup_username)
         return self.username
 
+    def _lookup_username(self):
+        if self.username is not None:
+            # found by the lookup we were waiting on
+            return self.username
+
+        key = self._identity_key()
+        if self.identity_cache and key:
+            username = self.identity_cache.get(key)
+            if username:
+                return username
+
+        error = self._identity_error
+        if error and error[0] == key and time.time() - error[1] < self.identity_error_timeout:
+            raise TweepError(error[2])
+
+        api = API(self, transport=self.transport)
+        user = api.verify_credentials()
+        if not user:
+            message = "Unable to get username, invalid oauth token!"
+            self._identity_error = (key, time.time(), message)
+            raise TweepError(message)
+        self._identity_error = None
+        if self.identity_cache and key:
+            self.identity_cache.store(key, user.screen_name)
+        return user.screen_name
+
+
+class CredentialPool(AuthHandler):
+    """Spreads requests over several auth handlers.
+
+    The rate limit of each handler is tracked from the X-RateLimit-Remaining
+    and X-RateLimit-Reset headers of its responses. Requests go to the
+    handler with the most calls remaining, handlers with no known limit
+    (not used yet, or past their reset time) are used first, in turn.
+    Requests made on behalf of the authenticated user always use the first
+    handler, which get_username() answers for: anything but GET, and GET
+    requests to endpoints that require authentication.
+    """
+
+    def __init__(self, handlers):
+        if not handlers:
+            raise TweepError('CredentialPool needs at least one auth handler')
+        self.handlers = list(handlers)
+        self.remaining = [None] * len(self.handlers)
+        self.reset = [None] * len(self.handlers)
+        self._next = 0
+        self._lock = threading.Lock()
+        # index of the handler which authenticated this thread's last request
+        self._local = threading.local()
+
+        patterns = []
+        for func in API.__dict__.values():
+            method = getattr(func, 'api_method', None)
+            if method and method.require_auth and method.method == 'GET':
+                patterns.append('[^/]+'.join([re.escape(segment) for segment in method.path_segments]))
+        self._user_paths = re.compile('(%s)$' % '|'.join(patterns))
+
+    def is_user_request(self, url, method):
+        if method != 'GET' or url is None:
+            return True
+        return self._user_paths.search(url.split('?', 1)[0]) is not None
+
+    def choose(self):
+        """Return the index of the handler for the next request"""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            count = len(self.handlers)
+            best = None
+            for i in range(count):
+                idx = (self._next + i) % count
+                if self.reset[idx] is not None and self.reset[idx] <= now:
+                    self.remaining[idx] = self.reset[idx] = None
+                if self.remaining[idx] is None:
+                    best = idx
+                    break
+                if best is None or self.remaining[idx] > self.remaining[best]:
+                    best = idx
+            self._next = (best + 1) % count
+
+            # count the call until its response reports the limit
+            if self.remaining[best]:
+                self.remaining[best] -= 1
+            return best
+        finally:
+            self._lock.release()
+
+    def apply_auth(self, url, method, headers, parameters):
+        if self.is_user_request(url, method):
+            idx = 0
+        else:
+            idx = self.choose()
+        self._local.index = idx
+        self.handlers[idx].apply_auth(url, method, headers, parameters)
+
+    def handle_response(self, resp):
+        idx = getattr(self._local, 'index', None)
+        if idx is None:
+            return
+        self.handlers[idx].handle_response(resp)
+        try:
+            remaining = int(resp.getheader('X-RateLimit-Remaining'))
+            reset = int(resp.getheader('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return
+        self._lock.acquire()
+        self.remaining[idx] = remaining
+        self.reset[idx] = reset
+        self._lock.release()
+
+    def get_username(self):
+        return self.handlers[0].get_username()
@@ -2,13 +2,18 @@
 # Copyright 2009-2010 Joshua Roesslein
 # See LICENSE for details.
 
-import httplib
 import urllib
+import socket
+import copy
 import time
 import re
+import zlib
 
 from tweepy.error import TweepError
-from tweepy.utils import convert_to_utf8_str
+from tweepy.hooks import RequestInfo
+from tweepy.transport import set_read_timeout
+from tweepy.models import Model
+from tweepy.utils import convert_to_utf8_str, decompress_body
 
 re_path_template = re.compile('{\w+}')
 
@@ -18,12 +23,19 @@ def bind_api(**config):
     class APIMethod(object):
 
         path = config['path']
+        # The path template is split once here, calls only fill in the
+        # variables: path_segments holds the literal text around them.
+        path_segments = tuple(re_path_template.split(path))
+        path_variables = tuple(v[1:-1] for v in re_path_template.findall(path))
         payload_type = config.get('payload_type', None)
         payload_list = config.get('payload_list', False)
         allowed_param = config.get('allowed_param', [])
         method = config.get('method', 'GET')
         require_auth = config.get('require_auth', False)
         search_api = config.get('search_api', False)
+        cacheable = config.get('cacheable', method == 'GET')
+        cache_timeout = config.get('cache_timeout', None)
+        negative_cache_timeout = config.get('negative_cache_timeout', 0)
 
         def __init__(self, api, args, kargs):
             # If authentication is required and no credentials
@@ -37,7 +49,24 @@ def bind_api(**config):
             self.retry_delay = kargs.pop('retry_delay', api.retry_delay)
             self.retry_errors = kargs.pop('retry_errors', api.retry_errors)
             self.headers = kargs.pop('headers', {})
+            self.connect_timeout = kargs.pop('connect_timeout', api.connect_timeout)
+            self.read_timeout = kargs.pop('read_timeout', api.read_timeout)
+            request_timeout = kargs.pop('request_timeout', api.request_timeout)
+            self.deadline = kargs.pop('deadline', None)
+            if request_timeout is not None:
+                expires = time.time() + request_timeout
+                if self.deadline is None or expires < self.deadline:
+                    self.deadline = expires
             self.build_parameters(args, kargs)
+            self.info = RequestInfo(self.path, self.method, None)
+
+            # Cache policy set on the API overrides the endpoint defaults
+            policy = api.cache_policy.get(self.path)
+            if policy:
+                self.cacheable = policy.get('cacheable', self.cacheable)
+                self.cache_timeout = policy.get('cache_timeout', self.cache_timeout)
+                self.negative_cache_timeout = policy.get(
+                        'negative_cache_timeout', self.negative_cache_timeout)
 
             # Pick correct URL root to use
             if self.search_api:
@@ -63,6 +92,10 @@ def bind_api(**config):
             # This causes Twitter to issue 301 redirect.
             # See Issue http://github.com/joshthecoder/tweepy/issues/#issue/12
             self.headers['Host'] = self.host
+            self.info.host = self.host
+
+            if api.compression:
+                self.headers['Accept-Encoding'] = 'gzip'
 
         def build_parameters(self, args, kargs):
             self.parameters = {}
@@ -82,19 +115,23 @@ def bind_api(**config):
                 self.parameters[k] = convert_to_utf8_str(arg)
 
         def build_path(self):
-            for variable in re_path_template.findall(self.path):
-                name = variable.strip('{}')
+            if not self.path_variables:
+                return
 
+            segments = self.path_segments
+            path = [segments[0]]
+            for idx, name in enumerate(self.path_variables):
                 if name == 'user' and self.api.auth:
                     value = self.api.auth.get_username()
                 else:
                     try:
-                        value = urllib.quote(self.parameters[name])
+                        value = urllib.quote(self.parameters.pop(name))
                     except KeyError:
                         raise TweepError('No parameter value found for path variable: %s' % name)
-                    del self.parameters[name]
 
-                self.path = self.path.replace(variable, value)
+                path.append(value)
+                path.append(segments[idx + 1])
+            self.path = ''.join(path)
 
         def execute(self):
             # Build the request URL
@@ -102,30 +139,163 @@ def bind_api(**config):
             if len(self.parameters):
                 url = '%s?%s' % (url, urllib.urlencode(self.parameters))
 
-            # Query the cache if one is available
-            # and this request uses a GET method.
-            if self.api.cache and self.method == 'GET':
-                cache_result = self.api.cache.get(url)
-                # if cache result found and not expired, return it
-                if cache_result:
-                    # must restore api reference
-                    if isinstance(cache_result, list):
-                        for result in cache_result:
-                            result._api = self.api
-                    else:
-                        cache_result._api = self.api
-                    return cache_result
+            if not self.api.hooks:
+                return self.lookup(url)
+
+            info = self.info
+            info.url = url
+            self.run_hooks('pre_request', info)
+            start = time.time()
+            try:
+                try:
+                    return self.lookup(url)
+                except Exception, e:
+                    info.error = e
+                    raise
+            finally:
+                info.mark('total', start)
+                self.run_hooks('post_request', info)
+
+        def run_hooks(self, event, info):
+            for hook in self.api.hooks:
+                getattr(hook, event)(info)
+
+        def lookup(self, url):
+            # Only cacheable requests using the GET method are cached.
+            if not (self.api.cache and self.cacheable and self.method == 'GET'):
+                return self.fetch(url)
+
+            # Query the cache. Entries are stored for their retention
+            # time: the endpoint timeout plus the stale-while-revalidate
+            # and revalidate windows, if configured. Entries are (stored_at, value[, meta]) where meta
+            # holds the error of a cached 404 or the response validators.
+            start = time.time()
+            cache_entry = self.api.cache.get(url, self.cache_retention())
+            self.info.mark('cache_lookup', start)
+            validated = None
+            if cache_entry is not None and not self.is_cache_entry(cache_entry):
+                # stored by an earlier release (ex: a bare model), refetch
+                # so it gets replaced
+                cache_entry = None
+            if cache_entry:
+                stored_at, value = cache_entry[:2]
+                meta = len(cache_entry) > 2 and cache_entry[2] or {}
+                if 'error' in meta:
+                    # cached error response
+                    if time.time() - stored_at < self.negative_cache_timeout:
+                        self.info.cache = 'negative'
+                        raise TweepError(meta['error'])
+                elif self.is_fresh(stored_at):
+                    self.info.cache = 'hit'
+                    return self.from_cache(url, value)
+                elif self.is_fresh(stored_at, self.api.stale_while_revalidate):
+                    # serve the stale entry while it gets refreshed
+                    self.info.cache = 'stale'
+                    self.revalidate(url, cache_entry)
+                    return self.from_cache(url, value)
+                elif meta:
+                    # too old to serve, but the server can confirm it
+                    validated = cache_entry
+
+            # Concurrent identical requests share a single round trip.
+            # Only the caller making the request sees its cache state
+            # change from coalesced to miss.
+            self.info.cache = 'coalesced'
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(self.deadline - time.time(), 0)
+            try:
+                return self.api.flights.do(url, self.fetch, (url, 'miss', validated), timeout)
+            except TweepError:
+                if self.deadline is not None and time.time() >= self.deadline:
+                    # gave up waiting on a request in flight
+                    self.info.timed_out = True
+                raise
+
+        def is_cache_entry(self, entry):
+            return (isinstance(entry, tuple) and len(entry) in (2, 3)
+                    and isinstance(entry[0], (int, long, float))
+                    and (len(entry) == 2 or isinstance(entry[2], dict)))
+
+        def get_cache_timeout(self):
+            if self.cache_timeout is None:
+                return self.api.cache.timeout
+            return self.cache_timeout
+
+        def cache_retention(self):
+            timeout = self.get_cache_timeout()
+            if timeout <= 0:
+                return timeout
+            timeout = max(timeout, self.negative_cache_timeout)
+            return timeout + self.api.stale_while_revalidate + self.api.revalidate_window
+
+        def is_fresh(self, stored_at, grace=0):
+            timeout = self.get_cache_timeout()
+            return timeout <= 0 or (time.time() - stored_at) < timeout + grace
+
+        def revalidate(self, url, cache_entry):
+            # Refresh in the background unless a request
+            # for this url is already in flight. The refresh is reported
+            # to hooks as its own request, so it runs on a copy of this
+            # method with its own info and headers.
+            method = copy.copy(self)
+            method.headers = dict(self.headers)
+            info = method.info = RequestInfo(self.info.path, self.method, self.host)
+            info.url = url
+            def refresh():
+                method.run_hooks('pre_request', info)
+                start = time.time()
+                try:
+                    try:
+                        return method.fetch(url, 'refresh', cache_entry)
+                    except TweepError, e:
+                        info.error = e
+                finally:
+                    info.mark('total', start)
+                    method.run_hooks('post_request', info)
+            self.api.flights.do_async(url, refresh)
+
+        def from_cache(self, url, value):
+            if self.api.cache_payloads:
+                start = time.time()
+                result = self.parse_cached(url, value)
+                self.info.mark('parse', start)
+                return result
+
+            # must restore api reference
+            results = value
+            if isinstance(results, tuple):
+                # cursored result
+                results = results[0]
+            if not isinstance(results, list):
+                results = [results]
+            for result in results:
+                if isinstance(result, Model):
+                    result._api = self.api
+            return value
+
+        def fetch(self, url, cache_status=None, cache_entry=None):
+            info = self.info
+            if cache_status:
+                info.cache = cache_status
+
+            # Make the request conditional if the cached entry has validators
+            validators = cache_entry and len(cache_entry) > 2 and cache_entry[2] or {}
+            if 'etag' in validators:
+                self.headers['If-None-Match'] = validators['etag']
+            if 'last_modified' in validators:
+                self.headers['If-Modified-Since'] = validators['last_modified']
+            if self.post_data:
+                info.bytes_sent = len(self.post_data)
 
             # Continue attempting request until successful
             # or maximum number of retries is reached.
+            # Timed out attempts are retried as well.
             retries_performed = 0
-            while retries_performed < self.retry_count + 1:
+            while True:
                 # Open connection
-                # FIXME: add timeout
-                if self.api.secure:
-                    conn = httplib.HTTPSConnection(self.host)
-                else:
-                    conn = httplib.HTTPConnection(self.host)
+                connect_timeout, read_timeout = self.get_timeouts()
+                conn = self.api.transport.connection(self.host, self.api.secure, connect_timeout)
 
                 # Apply authentication
                 if self.api.auth:
@@ -136,41 +306,142 @@ def bind_api(**config):
 
                 # Execute request
                 try:
+                    t = time.time()
+                    conn.connect()
+                    t = info.mark('connect', t)
+                    set_read_timeout(conn, read_timeout)
+                    if hasattr(self.post_data, 'seek'):
+                        # rewind streamed bodies sent by a previous attempt
+                        self.post_data.seek(0)
                     conn.request(self.method, url, headers=self.headers, body=self.post_data)
+                    t = info.mark('send', t)
                     resp = conn.getresponse()
+                    t = info.mark('first_byte', t)
+                    info.status = resp.status
+                    if self.api.auth:
+                        self.api.auth.handle_response(resp)
+
+                    # Read the body unless the request will be retried
+                    if not (self.should_retry(resp.status) and retries_performed < self.retry_count):
+                        payload = resp.read()
+                        info.mark('read', t)
+                        break
+                    conn.close()
+                except socket.timeout:
+                    conn.close()
+                    if retries_performed >= self.retry_count:
+                        info.timed_out = True
+                        raise TweepError('Request timed out: %s' % url)
                 except Exception, e:
                     raise TweepError('Failed to send request: %s' % e)
 
-                # Exit request loop if non-retry error code
-                if self.retry_errors:
-                    if resp.status not in self.retry_errors: break
-                else:
-                    if resp.status == 200: break
-
                 # Sleep before retrying request again
-                time.sleep(self.retry_delay)
+                self.sleep(self.retry_delay)
                 retries_performed += 1
+                info.retries = retries_performed
+
+            conn.close()
+            info.bytes_received = len(payload)
+
+            # Decode compressed responses
+            encoding = resp.getheader('content-encoding')
+            if encoding:
+                t = time.time()
+                try:
+                    payload = decompress_body(payload, encoding)
+                except zlib.error, e:
+                    raise TweepError('Failed to decompress response: %s' % e)
+                info.mark('decompress', t)
 
-            # If an error was returned, throw an exception
             self.api.last_response = resp
+            if resp.status == 304 and cache_entry:
+                # Not modified, keep the cached value for another period
+                info.cache = 'revalidated'
+                self.api.cache.store(url, (time.time(), cache_entry[1],
+                                           self.get_validators(resp, validators)),
+                                     self.cache_retention())
+                return self.from_cache(url, cache_entry[1])
+
+            # If an error was returned, throw an exception
             if resp.status != 200:
                 try:
-                    error_msg = self.api.parser.parse_error(self, resp.read())
+                    error_msg = self.api.parser.parse_error(self, payload)
                 except Exception:
                     error_msg = "Twitter error response: status code = %s" % resp.status
+
+                # Remember missing resources for a short while
+                if resp.status == 404 and self.negative_cache_timeout > 0 \
+                        and self.api.cache and self.cacheable and self.method == 'GET':
+                    self.api.cache.store(url, (time.time(), None, {'error': error_msg}),
+                                         self.cache_retention())
                 raise TweepError(error_msg)
 
             # Parse the response payload
-            result = self.api.parser.parse(self, resp.read())
-
-            conn.close()
+            t = time.time()
+            result = self.api.parser.parse(self, payload)
+            info.mark('parse', t)
 
             # Store result into cache if one is available.
-            if self.api.cache and self.method == 'GET' and result:
-                self.api.cache.store(url, result)
+            if self.api.cache and self.cacheable and self.method == 'GET' and result:
+                if self.api.cache_payloads:
+                    value = payload
+                    self.api.parsed_cache.store(url, (payload, result))
+                else:
+                    value = result
+                validators = self.get_validators(resp)
+                if validators:
+                    entry = (time.time(), value, validators)
+                else:
+                    entry = (time.time(), value)
+                self.api.cache.store(url, entry, self.cache_retention())
 
             return result
 
+        def get_validators(self, resp, previous={}):
+            validators = dict(previous)
+            etag = resp.getheader('etag')
+            if etag:
+                validators['etag'] = etag
+            last_modified = resp.getheader('last-modified')
+            if last_modified:
+                validators['last_modified'] = last_modified
+            return validators
+
+        def should_retry(self, status):
+            if self.retry_errors:
+                return status in self.retry_errors
+            return status not in (200, 304)
+
+        def get_timeouts(self):
+            """Return the (connect, read) timeouts for the next attempt"""
+            connect, read = self.connect_timeout, self.read_timeout
+            if self.deadline is not None:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    self.info.timed_out = True
+                    raise TweepError('Request deadline exceeded')
+                if connect is None or connect > remaining:
+                    connect = remaining
+                if read is None or read > remaining:
+                    read = remaining
+            return connect, read
+
+        def sleep(self, seconds):
+            # never sleep past the deadline
+            if self.deadline is not None:
+                seconds = min(seconds, max(self.deadline - time.time(), 0))
+            time.sleep(seconds)
+
+        def parse_cached(self, url, payload):
+            # Reuse the parsed result if the in-process LRU holds
+            # one built from this same payload, otherwise re-parse.
+            parsed = self.api.parsed_cache.get(url)
+            if parsed and parsed[0] == payload:
+                return parsed[1]
+            result = self.api.parser.parse(self, payload)
+            self.api.parsed_cache.store(url, (payload, result))
+            return result
+
 
     def _call(api, *args, **kargs):
 
@@ -178,6 +449,9 @@ def bind_api(**config):
         return method.execute()
 
 
+    # Expose the endpoint description (path, payload_type, ...)
+    _call.api_method = APIMethod
+
     # Set pagination mode
     if 'cursor' in APIMethod.allowed_param:
         _call.pagination_mode = 'cursor'
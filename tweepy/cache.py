@@ -5,6 +5,15 @@
 import time
 import threading
 import os
+import zlib
+import math
+import bisect
+import socket
+import heapq
+import mmap
+import struct
+import binascii
+import cStringIO
 import cPickle as pickle
 
 try:
@@ -24,23 +33,33 @@ except ImportError:
 class Cache(object):
     """Cache interface"""
 
-    def __init__(self, timeout=60):
+    def __init__(self, timeout=60, compress_level=0, pickle_protocol=0):
         """Initialize the cache
             timeout: number of seconds to keep a cached entry
+            compress_level: zlib level (1-9) used to compress values,
+                            0 disables compression
+            pickle_protocol: protocol used when pickling values
         """
         self.timeout = timeout
+        self.compress_level = compress_level
+        self.pickle_protocol = pickle_protocol
+        self._stats_lock = threading.Lock()
+        self._bytes_in = 0
+        self._bytes_stored = 0
 
-    def store(self, key, value):
+    def store(self, key, value, timeout=None):
         """Add new record to cache
             key: entry key
             value: data of entry
+            timeout: keep this entry for this many seconds instead
+                     of the cache wide timeout [optional]
         """
         raise NotImplementedError
 
     def get(self, key, timeout=None):
         """Get cached entry if exists and not expired
             key: which entry to get
-            timeout: override timeout with this value [optional]
+            timeout: override the entry's timeout with this value [optional]
         """
         raise NotImplementedError
 
@@ -52,35 +71,118 @@ class Cache(object):
         """Delete any expired entries in cache."""
         raise NotImplementedError
 
+    def sweep(self, max_time=None):
+        """Delete expired entries in small batches
+            max_time: stop after about this many seconds [optional]
+        Returns the number of entries deleted. Caches which keep their
+        entries ordered by expiry only visit expired entries, the
+        default falls back to a full cleanup.
+        """
+        before = self.count()
+        self.cleanup()
+        return max(before - self.count(), 0)
+
     def flush(self):
         """Delete all cached entries"""
         raise NotImplementedError
 
+    def stats(self):
+        """Get a dict of statistics about stored data
+            bytes_in: serialized size of values before compression
+            bytes_stored: size of values as held by the cache
+            bytes_saved: bytes saved by compression
+        """
+        self._stats_lock.acquire()
+        try:
+            return {
+                'bytes_in': self._bytes_in,
+                'bytes_stored': self._bytes_stored,
+                'bytes_saved': self._bytes_in - self._bytes_stored
+            }
+        finally:
+            self._stats_lock.release()
+
+    def _record_bytes(self, bytes_in, bytes_stored):
+        self._stats_lock.acquire()
+        self._bytes_in += bytes_in
+        self._bytes_stored += bytes_stored
+        self._stats_lock.release()
+
+    def _get_expires(self, created_time, timeout=None):
+        """Return the time an entry created at created_time
+        expires, 0 if it never does.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout <= 0:
+            return 0
+        return created_time + timeout
+
+    def _is_expired(self, created_time, expires, timeout=None):
+        """Check an entry against timeout if given, else its own expiry"""
+        if timeout is not None:
+            return timeout > 0 and (time.time() - created_time) >= timeout
+        return expires > 0 and time.time() >= expires
+
+    def _pack(self, value):
+        """Compress value if compression is enabled.
+        Returns a (compressed, data) tuple.
+        """
+        if self.compress_level <= 0:
+            return False, value
+        raw = pickle.dumps(value, self.pickle_protocol)
+        data = zlib.compress(raw, self.compress_level)
+        self._record_bytes(len(raw), len(data))
+        return True, data
+
+    def _unpack(self, compressed, data):
+        """Reverse of _pack"""
+        if compressed:
+            return pickle.loads(zlib.decompress(data))
+        return data
+
 
 class MemoryCache(Cache):
     """In-memory cache"""
 
-    def __init__(self, timeout=60):
-        Cache.__init__(self, timeout)
+    def __init__(self, timeout=60, compress_level=0,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        Cache.__init__(self, timeout, compress_level, pickle_protocol)
         self._entries = {}
+        self._expiry = []
         self.lock = threading.Lock()
 
     def __getstate__(self):
         # pickle
-        return {'entries': self._entries, 'timeout': self.timeout}
+        return {'entries': self._entries, 'timeout': self.timeout,
+                'compress_level': self.compress_level,
+                'pickle_protocol': self.pickle_protocol}
 
     def __setstate__(self, state):
         # unpickle
+        Cache.__init__(self, state['timeout'],
+                state.get('compress_level', 0),
+                state.get('pickle_protocol', pickle.HIGHEST_PROTOCOL))
         self.lock = threading.Lock()
-        self._entries = state['entries']
-        self.timeout = state['timeout']
-
-    def _is_expired(self, entry, timeout):
-        return timeout > 0 and (time.time() - entry[0]) >= timeout
+        self._entries = {}
+        for key, entry in state['entries'].items():
+            if len(entry) == 2:
+                # pickled before compression support, (time, value)
+                entry = (entry[0], entry[1], False)
+            if len(entry) == 3:
+                # pickled before per entry timeouts
+                entry = entry + (self._get_expires(entry[0]),)
+            self._entries[key] = entry
+        self._expiry = [(e[3], k) for k, e in self._entries.items() if e[3] > 0]
+        heapq.heapify(self._expiry)
 
-    def store(self, key, value):
+    def store(self, key, value, timeout=None):
+        compressed, data = self._pack(value)
         self.lock.acquire()
-        self._entries[key] = (time.time(), value)
+        created_time = time.time()
+        expires = self._get_expires(created_time, timeout)
+        self._entries[key] = (created_time, data, compressed, expires)
+        self._push_expiry(expires, key)
         self.lock.release()
 
     def get(self, key, timeout=None):
@@ -92,48 +194,187 @@ class MemoryCache(Cache):
                 # no hit, return nothing
                 return None
 
-            # use provided timeout in arguments if provided
-            # otherwise use the one provided during init.
-            if timeout is None:
-                timeout = self.timeout
-
-            # make sure entry is not expired
-            if self._is_expired(entry, timeout):
+            # make sure entry is not expired, using the provided
+            # timeout if any, otherwise the entry's own.
+            if self._is_expired(entry[0], entry[3], timeout):
                 # entry expired, delete and return nothing
                 del self._entries[key]
                 return None
 
             # entry found and not expired, return it
-            return entry[1]
+            compressed, data = entry[2], entry[1]
         finally:
             self.lock.release()
+        return self._unpack(compressed, data)
 
     def count(self):
         return len(self._entries)
 
+    def _remove(self, key):
+        # caller must hold lock
+        del self._entries[key]
+
+    def _push_expiry(self, expires, key):
+        # caller must hold lock
+        if expires <= 0:
+            return
+        heapq.heappush(self._expiry, (expires, key))
+        if len(self._expiry) > 2 * len(self._entries) + 64:
+            # mostly pairs of overwritten entries, rebuild
+            self._expiry = [(e[3], k) for k, e in self._entries.items() if e[3] > 0]
+            heapq.heapify(self._expiry)
+
+    # number of entries visited per lock acquisition when sweeping
+    sweep_batch = 64
+
+    def sweep(self, max_time=None):
+        # self._expiry is a heap of (expires, key) pairs of every entry
+        # which expires, so the first to expire is on top. Pairs left
+        # behind by overwritten or already deleted entries are dropped
+        # as they reach the top.
+        removed = 0
+        start = time.time()
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                for i in xrange(self.sweep_batch):
+                    if not self._expiry:
+                        return removed
+                    expires, key = self._expiry[0]
+                    if now < expires:
+                        return removed
+                    heapq.heappop(self._expiry)
+                    entry = self._entries.get(key)
+                    if entry and entry[3] == expires:
+                        self._remove(key)
+                        removed += 1
+            finally:
+                self.lock.release()
+            if max_time is not None and time.time() - start >= max_time:
+                return removed
+
     def cleanup(self):
+        self.sweep()
+
+    def flush(self):
+        self.lock.acquire()
+        self._entries.clear()
+        self._expiry = []
+        self.lock.release()
+
+
+class LRUCache(MemoryCache):
+    """In-memory cache bounded to max_entries, evicting least recently used"""
+
+    def __init__(self, timeout=60, max_entries=128, compress_level=0,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        MemoryCache.__init__(self, timeout, compress_level, pickle_protocol)
+        self.max_entries = max_entries
+        self._init_order()
+
+    def __getstate__(self):
+        # pickle
+        state = MemoryCache.__getstate__(self)
+        state['max_entries'] = self.max_entries
+        return state
+
+    def __setstate__(self, state):
+        # unpickle
+        MemoryCache.__setstate__(self, state)
+        self.max_entries = state['max_entries']
+        self._init_order()
+        for key in self._entries.keys():
+            self._link(key)
+
+    def _init_order(self):
+        # circular doubly linked list of [prev, next, key] nodes,
+        # most recently used entry is right after the root node.
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._nodes = {}
+
+    def _link(self, key):
+        root = self._root
+        node = [root, root[1], key]
+        root[1][0] = node
+        root[1] = node
+        self._nodes[key] = node
+
+    def _unlink(self, key):
+        node = self._nodes.pop(key, None)
+        if node:
+            node[0][1] = node[1]
+            node[1][0] = node[0]
+
+    def store(self, key, value, timeout=None):
+        compressed, data = self._pack(value)
+        self.lock.acquire()
+        try:
+            self._unlink(key)
+            created_time = time.time()
+            expires = self._get_expires(created_time, timeout)
+            self._entries[key] = (created_time, data, compressed, expires)
+            self._push_expiry(expires, key)
+            self._link(key)
+
+            # evict least recently used entries if over capacity
+            while len(self._entries) > self.max_entries:
+                oldest = self._root[0][2]
+                self._unlink(oldest)
+                del self._entries[oldest]
+        finally:
+            self.lock.release()
+
+    def get(self, key, timeout=None):
         self.lock.acquire()
         try:
-            for k, v in self._entries.items():
-                if self._is_expired(v, self.timeout):
-                    del self._entries[k]
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+
+            self._unlink(key)
+            if self._is_expired(entry[0], entry[3], timeout):
+                del self._entries[key]
+                return None
+
+            # mark as most recently used
+            self._link(key)
+            compressed, data = entry[2], entry[1]
         finally:
             self.lock.release()
+        return self._unpack(compressed, data)
+
+    def _remove(self, key):
+        self._unlink(key)
+        del self._entries[key]
 
     def flush(self):
         self.lock.acquire()
         self._entries.clear()
+        self._expiry = []
+        self._init_order()
         self.lock.release()
 
 
 class FileCache(Cache):
-    """File-based cache"""
+    """File-based cache
+
+    Besides one file per entry, the cache directory holds a memory
+    mapped index of every entry's creation time, expiry and size. Expiry checks,
+    count() and cleanup() only read the index. All FileCache instances
+    sharing a directory must agree on use_index.
+    """
 
     # locks used to make cache thread-safe
     cache_locks = {}
 
-    def __init__(self, cache_dir, timeout=60):
-        Cache.__init__(self, timeout)
+    # name of the index file inside the cache directory
+    index_name = 'index'
+
+    def __init__(self, cache_dir, timeout=60, compress_level=0, pickle_protocol=0,
+            use_index=True):
+        Cache.__init__(self, timeout, compress_level, pickle_protocol)
         if os.path.exists(cache_dir) is False:
             os.mkdir(cache_dir)
         self.cache_dir = cache_dir
@@ -154,6 +395,45 @@ class FileCache(Cache):
             self._lock_file = self._lock_file_dummy
             self._unlock_file = self._unlock_file_dummy
 
+        # heap of (expires, path) for sweep(), loaded on first use
+        self._expiry = None
+        self._expiry_lock = threading.Lock()
+
+        self._index = None
+        if use_index:
+            self.lock.acquire()
+            try:
+                self._index = _FileCacheIndex(
+                        os.path.join(cache_dir, self.index_name),
+                        self._lock_file, self._unlock_file)
+                if self._index.created:
+                    self._build_index()
+            finally:
+                self.lock.release()
+
+    def _list_entries(self):
+        """List paths of all entry files"""
+        paths = []
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith('.lock') or entry == self.index_name:
+                continue
+            paths.append(os.path.join(self.cache_dir, entry))
+        return paths
+
+    def _get_digest(self, path):
+        return binascii.unhexlify(os.path.basename(path))
+
+    def _build_index(self):
+        # index entries written before the index existed,
+        # use the modified time rather than unpickling them.
+        for path in self._list_entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self._index.put(self._get_digest(path), st.st_mtime,
+                    self._get_expires(st.st_mtime), st.st_size)
+
     def _get_path(self, key):
         md5 = hashlib.md5()
         md5.update(key)
@@ -193,26 +473,66 @@ class FileCache(Cache):
         os.remove(path)
         if os.path.exists(path + '.lock'):
             os.remove(path + '.lock')
+        if self._index:
+            self._index.remove(self._get_digest(path))
 
-    def store(self, key, value):
+    def store(self, key, value, timeout=None):
         path = self._get_path(key)
+        compressed, data = self._pack(value)
+        created_time = time.time()
+        record = (created_time, data, compressed, self._get_expires(created_time, timeout))
         self.lock.acquire()
         try:
             # acquire lock and open file
             f_lock = self._lock_file(path)
             datafile = open(path, 'wb')
 
-            # write data
-            pickle.dump((time.time(), value), datafile)
+            # write data, compressed bytes get a binary pickle so
+            # they are not escaped into something larger
+            protocol = self.pickle_protocol
+            if compressed:
+                protocol = pickle.HIGHEST_PROTOCOL
+            pickle.dump(record, datafile, protocol)
+            size = datafile.tell()
 
             # close and unlock file
             datafile.close()
+            if self._index:
+                self._index.put(self._get_digest(path), created_time, record[3], size)
             self._unlock_file(f_lock)
         finally:
             self.lock.release()
+        if compressed:
+            # count the bytes written rather than the compressed value
+            self._record_bytes(0, size - len(data))
+
+        self._expiry_lock.acquire()
+        if self._expiry is not None and record[3] > 0:
+            heapq.heappush(self._expiry, (record[3], path))
+        self._expiry_lock.release()
 
     def get(self, key, timeout=None):
-        return self._get(self._get_path(key), timeout)
+        path = self._get_path(key)
+        if self._index:
+            # check the index first so missing and expired
+            # entries never need their file opened.
+            self.lock.acquire()
+            try:
+                entry = self._index.get(self._get_digest(path))
+                if entry is None:
+                    return None
+                if self._is_expired(entry[0], entry[1], timeout):
+                    f_lock = self._lock_file(path)
+                    try:
+                        self._delete_file(path)
+                    except OSError:
+                        self._index.remove(self._get_digest(path))
+                    if f_lock:
+                        self._unlock_file(f_lock)
+                    return None
+            finally:
+                self.lock.release()
+        return self._get(path, timeout)
 
     def _get(self, path, timeout):
         if os.path.exists(path) is False:
@@ -225,40 +545,1013 @@ class FileCache(Cache):
             datafile = open(path, 'rb')
 
             # read pickled object
-            created_time, value = pickle.load(datafile)
+            record = pickle.load(datafile)
             datafile.close()
+            created_time, value = record[0], record[1]
 
             # check if value is expired
-            if timeout is None:
-                timeout = self.timeout
-            if timeout > 0 and (time.time() - created_time) >= timeout:
+            if self._is_expired(created_time, self._record_expires(record), timeout):
                 # expired! delete from cache
                 value = None
                 self._delete_file(path)
 
             # unlock and return result
             self._unlock_file(f_lock)
-            return value
         finally:
             self.lock.release()
+        if value is not None and len(record) > 2:
+            value = self._unpack(record[2], value)
+        return value
+
+    def _record_expires(self, record):
+        if len(record) > 3:
+            return record[3]
+        # written before per entry timeouts
+        return self._get_expires(record[0])
 
     def count(self):
-        c = 0
+        if self._index:
+            self.lock.acquire()
+            try:
+                return self._index.count()
+            finally:
+                self.lock.release()
+        return len(self._list_entries())
+
+    def _index_items(self):
+        self.lock.acquire()
+        try:
+            return self._index.items()
+        finally:
+            self.lock.release()
+
+    def cleanup(self):
+        if self._index is None:
+            for path in self._list_entries():
+                self._get(path, None)
+            return
+        now = time.time()
+        for digest, created_time, expires, size in self._index_items():
+            if expires > 0 and now >= expires:
+                self._delete_expired(os.path.join(self.cache_dir, binascii.hexlify(digest)))
+
+    def _load_expiry(self):
+        # caller must hold _expiry_lock
+        self._expiry = []
+        if self._index:
+            for digest, created_time, expires, size in self._index_items():
+                if expires > 0:
+                    path = os.path.join(self.cache_dir, binascii.hexlify(digest))
+                    self._expiry.append((expires, path))
+        else:
+            # the expiry is only known once the file is read, check
+            # each file once and reschedule it by its real expiry.
+            for path in self._list_entries():
+                try:
+                    self._expiry.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        heapq.heapify(self._expiry)
+
+    def sweep(self, max_time=None):
+        # Entries are ordered by expiry, which is checked again before
+        # deleting so a file rewritten by another process is rescheduled
+        # instead of deleted. Files written by other processes after the
+        # first sweep are left to their own sweeper or to cleanup().
+        removed = 0
+        start = time.time()
+        self._expiry_lock.acquire()
+        try:
+            if self._expiry is None:
+                self._load_expiry()
+            while self._expiry:
+                now = time.time()
+                if max_time is not None and now - start >= max_time:
+                    break
+                expires, path = self._expiry[0]
+                if now < expires:
+                    break
+                heapq.heappop(self._expiry)
+                if not os.path.exists(path):
+                    # already deleted
+                    continue
+                expires = self._delete_expired(path)
+                if expires is None:
+                    removed += 1
+                elif expires > 0:
+                    heapq.heappush(self._expiry, (expires, path))
+        finally:
+            self._expiry_lock.release()
+        return removed
+
+    def _delete_expired(self, path):
+        """Delete the entry file at path if it has expired.
+        Returns None if it was deleted, otherwise its expiry
+        (0 if it never expires or the file is gone).
+        """
+        self.lock.acquire()
+        try:
+            f_lock = self._lock_file(path)
+            try:
+                # check again now that we hold the lock
+                expires = self._get_file_expires(path)
+                if expires <= 0 or time.time() < expires:
+                    return expires
+                self._delete_file(path)
+                return None
+            finally:
+                if f_lock:
+                    self._unlock_file(f_lock)
+        except (OSError, IOError):
+            if self._index:
+                # file is gone, drop its stale index slot
+                self._index.remove(self._get_digest(path))
+            return 0
+        finally:
+            self.lock.release()
+
+    def _get_file_expires(self, path):
+        """Return the expiry of the entry file at path"""
+        # caller must hold lock
+        if self._index:
+            if not os.path.exists(path):
+                raise OSError('No such entry: %s' % path)
+            entry = self._index.get(self._get_digest(path))
+            if entry is not None:
+                return entry[1]
+        datafile = open(path, 'rb')
+        try:
+            return self._record_expires(pickle.load(datafile))
+        finally:
+            datafile.close()
+
+    def flush(self):
+        for path in self._list_entries():
+            self._delete_file(path)
+        if self._index:
+            self.lock.acquire()
+            self._index.clear()
+            self.lock.release()
+
+
+class _FileCacheIndex(object):
+    """Memory mapped hash table used by FileCache
+
+    Maps the md5 digest of a key to the entry's creation time, expiry
+    (0 for never) and file size. Slots are found by linear probing, removed entries leave a
+    tombstone. The table doubles in size once three quarters of the
+    slots are in use. The caller must hold the FileCache thread lock,
+    the index file itself is locked against other processes.
+    """
+
+    magic = 'TWPYIDX2'
+    header = struct.Struct('<8sIII')  # magic, capacity, count, used slots
+    header_size = 32
+    slot = struct.Struct('<16sddI')   # digest, created time, expires, size
+    empty = '\0' * 16
+
+    def __init__(self, path, lock_file, unlock_file, capacity=1024):
+        self.path = path
+        self._lock_file = lock_file
+        self._unlock_file = unlock_file
+        self._map = None
+        self.capacity = 0
+
+        f_lock = self._lock_file(path)
+        try:
+            self.created = not os.path.exists(path) \
+                    or os.path.getsize(path) < self.header_size \
+                    or open(path, 'rb').read(len(self.magic)) != self.magic
+            if self.created:
+                # new or written by another version, rebuild it
+                f = open(path, 'wb')
+                f.write(self.header.pack(self.magic, capacity, 0, 0))
+                f.write('\0' * (self.header_size - self.header.size))
+                f.write('\0' * (capacity * self.slot.size))
+                f.close()
+            self._fp = open(path, 'r+b')
+        finally:
+            self._unlock_file(f_lock)
+
+    def _remap(self):
+        # the table may have been grown by another process
+        size = os.fstat(self._fp.fileno()).st_size
+        if self._map is not None and len(self._map) == size:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fp.fileno(), size)
+        magic, self.capacity, count, used = self.header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            raise IOError('Invalid FileCache index: %s' % self.path)
+
+    def _begin(self, exclusive):
+        f_lock = self._lock_file(self.path, exclusive)
+        self._remap()
+        return f_lock
+
+    def _end(self, f_lock):
+        self._unlock_file(f_lock)
+
+    def _read_header(self):
+        return self.header.unpack_from(self._map, 0)
+
+    def _write_header(self, count, used):
+        self.header.pack_into(self._map, 0, self.magic, self.capacity, count, used)
+
+    def _slot_offset(self, i):
+        return self.header_size + i * self.slot.size
+
+    def _probe(self, digest):
+        """Returns (slot of digest or None, first free slot)"""
+        free = None
+        i = struct.unpack('<I', digest[:4])[0] % self.capacity
+        for n in xrange(self.capacity):
+            d, created_time, expires, size = self.slot.unpack_from(self._map, self._slot_offset(i))
+            if created_time == 0 and d == self.empty:
+                if free is None:
+                    free = i
+                return None, free
+            if created_time < 0:
+                # tombstone
+                if free is None:
+                    free = i
+            elif d == digest:
+                return i, i
+            i = (i + 1) % self.capacity
+        return None, free
+
+    def _write_slot(self, i, digest, created_time, expires, size):
+        self.slot.pack_into(self._map, self._slot_offset(i), digest, created_time,
+                expires, size)
+
+    def get(self, digest):
+        """Returns (created time, expires, size) or None"""
+        f_lock = self._begin(False)
+        try:
+            i, free = self._probe(digest)
+            if i is None:
+                return None
+            return self.slot.unpack_from(self._map, self._slot_offset(i))[1:]
+        finally:
+            self._end(f_lock)
+
+    def put(self, digest, created_time, expires, size):
+        f_lock = self._begin(True)
+        try:
+            magic, capacity, count, used = self._read_header()
+            i, free = self._probe(digest)
+            if i is None:
+                if (used + 1) * 4 > self.capacity * 3:
+                    self._grow()
+                    magic, capacity, count, used = self._read_header()
+                    i, free = self._probe(digest)
+                if self.slot.unpack_from(self._map, self._slot_offset(free))[1] == 0:
+                    # taking an empty slot rather than a tombstone
+                    used += 1
+                count += 1
+                i = free
+            self._write_slot(i, digest, created_time, expires, size)
+            self._write_header(count, used)
+        finally:
+            self._end(f_lock)
+
+    def remove(self, digest):
+        f_lock = self._begin(True)
+        try:
+            i, free = self._probe(digest)
+            if i is not None:
+                magic, capacity, count, used = self._read_header()
+                self._write_slot(i, digest, -1.0, 0, 0)
+                self._write_header(count - 1, used)
+        finally:
+            self._end(f_lock)
+
+    def count(self):
+        f_lock = self._begin(False)
+        try:
+            return self._read_header()[2]
+        finally:
+            self._end(f_lock)
+
+    def items(self):
+        """Returns a list of (digest, created time, expires, size) of all entries"""
+        f_lock = self._begin(False)
+        try:
+            return self._items()
+        finally:
+            self._end(f_lock)
+
+    def _items(self):
+        items = []
+        for i in xrange(self.capacity):
+            item = self.slot.unpack_from(self._map, self._slot_offset(i))
+            if item[1] > 0:
+                items.append(item)
+        return items
+
+    def _resize(self, capacity):
+        # caller must hold the exclusive lock
+        size = self._slot_offset(capacity)
+        self._map.close()
+        self._fp.truncate(size)
+        self._map = mmap.mmap(self._fp.fileno(), size)
+        self._map[self.header_size:] = '\0' * (size - self.header_size)
+        self.capacity = capacity
+        self._write_header(0, 0)
+
+    def clear(self):
+        f_lock = self._begin(True)
+        try:
+            self._resize(self.capacity)
+        finally:
+            self._end(f_lock)
+
+    def _grow(self):
+        # caller must hold the exclusive lock
+        items = self._items()
+        self._resize(self.capacity * 2)
+        for digest, created_time, expires, size in items:
+            i, free = self._probe(digest)
+            self._write_slot(free, digest, created_time, expires, size)
+        self._write_header(len(items), len(items))
+
+
+class LogCache(Cache):
+    """Append-only log structured disk cache
+
+    Entries are appended to segment files and located through an
+    in-memory index of key -> (segment, offset, length). Reads go
+    through a memory map of the segment. sweep() expires entries in
+    order through a heap of their expiry times. Overwritten and expired
+    entries are dropped when their segment is compacted, either by
+    calling compact() or by a background thread when compact_interval
+    is given. The index is rebuilt by replaying the segments when the
+    cache is opened, so only one process may use a directory at a time.
+    """
+
+    # created time, expires, key length, value length, compressed flag
+    record = struct.Struct('<ddIIB')
+
+    def __init__(self, cache_dir, timeout=60, compress_level=0,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL, segment_size=4 * 1024 * 1024,
+            compact_ratio=0.5, compact_interval=None):
+        """Initialize the cache
+            cache_dir: directory holding the segment files
+            segment_size: bytes written to a segment before starting a new one
+            compact_ratio: compact segments with less than this share of live data
+            compact_interval: seconds between background compactions [optional]
+        """
+        Cache.__init__(self, timeout, compress_level, pickle_protocol)
+        if os.path.exists(cache_dir) is False:
+            os.mkdir(cache_dir)
+        self.cache_dir = cache_dir
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.lock = threading.RLock()
+
+        self._index = {}      # key -> (segment, offset, length, created time, expires, compressed)
+        self._live = {}       # segment -> bytes of live records
+        self._maps = {}       # segment -> mmap
+        self._expiry = []     # heap of (expires, key)
+        self._active = None
+        self._active_file = None
+        self._load()
+        self._rebuild_expiry()
+
+        self._compactor = None
+        if compact_interval:
+            self._compactor = threading.Thread(target=self._compact_loop,
+                    args=(compact_interval,))
+            self._compactor.setDaemon(True)
+            self._compactor.start()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.cache_dir, '%08i.log' % segment)
+
+    def _segments(self):
+        segments = []
         for entry in os.listdir(self.cache_dir):
-            if entry.endswith('.lock'):
+            if entry.endswith('.log'):
+                segments.append(int(entry[:-4]))
+        segments.sort()
+        return segments
+
+    def _load(self):
+        # replay segments oldest first so later records win
+        segments = self._segments()
+        offset = 0
+        for segment in segments:
+            self._live[segment] = 0
+            data = self._map(segment)
+            offset = 0
+            while offset + self.record.size <= len(data):
+                created_time, expires, key_len, value_len, compressed = \
+                        self.record.unpack_from(data, offset)
+                end = offset + self.record.size + key_len + value_len
+                if end > len(data):
+                    # torn write at the end of the log
+                    break
+                key = data[offset + self.record.size:offset + self.record.size + key_len]
+                self._set_index(key, (segment, offset, end - offset, created_time,
+                        expires, compressed))
+                offset = end
+        if segments:
+            if offset < os.path.getsize(self._segment_path(segments[-1])):
+                # cut off the torn record so new records follow the last good one
+                self._truncate(segments[-1], offset)
+            self._open_active(segments[-1])
+        else:
+            self._open_active(0)
+
+    def _truncate(self, segment, size):
+        data = self._maps.pop(segment, None)
+        if data:
+            data.close()
+        f = open(self._segment_path(segment), 'r+b')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+    def _open_active(self, segment):
+        if self._active_file:
+            self._active_file.close()
+        self._active = segment
+        self._active_file = open(self._segment_path(segment), 'ab')
+        self._live.setdefault(segment, 0)
+
+    def _map(self, segment, end=None):
+        """Get a read only map of segment covering all written records,
+        or at least its first end bytes if given.
+        """
+        data = self._maps.get(segment)
+        if data is not None and end is not None and end <= len(data):
+            # covers the record, no need to look at the file
+            return data
+        size = os.path.getsize(self._segment_path(segment))
+        if data is None or len(data) < size:
+            if data is not None:
+                data.close()
+            if size == 0:
+                return ''
+            f = open(self._segment_path(segment), 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._maps[segment] = data
+        return data
+
+    def _set_index(self, key, location):
+        # caller must hold lock
+        old = self._index.get(key)
+        if old:
+            self._live[old[0]] -= old[2]
+        self._index[key] = location
+        self._live[location[0]] += location[2]
+
+    def _remove(self, key):
+        # caller must hold lock
+        location = self._index.pop(key)
+        self._live[location[0]] -= location[2]
+
+    def _rebuild_expiry(self):
+        # caller must hold lock
+        self._expiry = [(l[4], k) for k, l in self._index.items() if l[4] > 0]
+        heapq.heapify(self._expiry)
+
+    def _push_expiry(self, expires, key):
+        # caller must hold lock
+        if expires <= 0:
+            return
+        heapq.heappush(self._expiry, (expires, key))
+        if len(self._expiry) > 2 * len(self._index) + 64:
+            # mostly pairs of overwritten entries, rebuild
+            self._rebuild_expiry()
+
+    def _append(self, key, created_time, expires, data, compressed):
+        # caller must hold lock
+        if self._active_file.tell() >= self.segment_size:
+            self._open_active(self._active + 1)
+        f = self._active_file
+        offset = f.tell()
+        f.write(self.record.pack(created_time, expires, len(key), len(data), compressed))
+        f.write(key)
+        f.write(data)
+        f.flush()
+        self._set_index(key, (self._active, offset, f.tell() - offset,
+                created_time, expires, compressed))
+
+    def store(self, key, value, timeout=None):
+        compressed, data = self._pack(value)
+        if not compressed:
+            data = pickle.dumps(value, self.pickle_protocol)
+        self.lock.acquire()
+        try:
+            created_time = time.time()
+            expires = self._get_expires(created_time, timeout)
+            self._append(key, created_time, expires, data, compressed)
+            self._push_expiry(expires, key)
+        finally:
+            self.lock.release()
+
+    def get(self, key, timeout=None):
+        self.lock.acquire()
+        try:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment, offset, length, created_time, expires, compressed = location
+
+            if self._is_expired(created_time, expires, timeout):
+                self._remove(key)
+                return None
+
+            start = offset + self.record.size + len(key)
+            value = buffer(self._map(segment, offset + length), start, offset + length - start)
+            if compressed:
+                # decompress straight out of the map
+                return pickle.loads(zlib.decompress(value))
+            # unpickle straight out of the map
+            return pickle.load(cStringIO.StringIO(value))
+        finally:
+            self.lock.release()
+
+    def count(self):
+        return len(self._index)
+
+    # number of entries visited per lock acquisition when sweeping
+    sweep_batch = 64
+
+    def sweep(self, max_time=None):
+        # Same as MemoryCache.sweep(), compaction keeps each entry's
+        # expiry so its heap pair still matches the moved entry.
+        removed = 0
+        start = time.time()
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                for i in xrange(self.sweep_batch):
+                    if not self._expiry:
+                        return removed
+                    expires, key = self._expiry[0]
+                    if now < expires:
+                        return removed
+                    heapq.heappop(self._expiry)
+                    location = self._index.get(key)
+                    if location and location[4] == expires:
+                        self._remove(key)
+                        removed += 1
+            finally:
+                self.lock.release()
+            if max_time is not None and time.time() - start >= max_time:
+                return removed
+
+    def cleanup(self):
+        self.sweep()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._active_file.close()
+            self._active_file = None
+            for data in self._maps.values():
+                if data:
+                    data.close()
+            self._maps.clear()
+            for segment in self._segments():
+                os.remove(self._segment_path(segment))
+            self._index.clear()
+            self._live.clear()
+            self._expiry = []
+            self._open_active(0)
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        """Rewrite sealed segments whose live data is below compact_ratio.
+        Returns the number of bytes reclaimed.
+        """
+        self.cleanup()
+        reclaimed = 0
+        for segment in self._segments():
+            self.lock.acquire()
+            try:
+                if segment == self._active:
+                    continue
+                size = os.path.getsize(self._segment_path(segment))
+                if size and float(self._live.get(segment, 0)) / size >= self.compact_ratio:
+                    continue
+
+                # copy live records to the active segment
+                data = self._map(segment)
+                for key, location in self._index.items():
+                    if location[0] != segment:
+                        continue
+                    start = location[1] + self.record.size + len(key)
+                    self._append(key, location[3], location[4],
+                            data[start:location[1] + location[2]], location[5])
+
+                data = self._maps.pop(segment, None)
+                if data:
+                    data.close()
+                del self._live[segment]
+                os.remove(self._segment_path(segment))
+                reclaimed += size
+            finally:
+                self.lock.release()
+        return reclaimed
+
+    def _compact_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except (IOError, OSError):
+                # try again next time around
+                pass
+
+
+class LayeredCache(Cache):
+    """Two tier cache
+
+    Lookups check a small in-process front cache first and fall back to
+    a (possibly shared) back cache such as a FileCache. Back hits are
+    promoted into the front and stores are written through to both.
+    Entries promoted into the front tier may be served for up to the
+    front's own timeout, so keep it short when the back tier is shared
+    between processes.
+    """
+
+    def __init__(self, back, front=None):
+        """Initialize the cache
+            back: persistent cache, any Cache instance
+            front: in-process cache [optional]
+                   defaults to an LRUCache of 256 entries
+        """
+        Cache.__init__(self, back.timeout)
+        self.back = back
+        self.front = front or LRUCache(timeout=min(back.timeout, 10), max_entries=256)
+        self._front_hits = 0
+        self._back_hits = 0
+        self._misses = 0
+
+    def _front_timeout(self, timeout):
+        if timeout is None or timeout <= 0:
+            return self.front.timeout
+        if self.front.timeout <= 0:
+            return timeout
+        return min(timeout, self.front.timeout)
+
+    def store(self, key, value, timeout=None):
+        self.back.store(key, value, timeout)
+        self.front.store(key, value, self._front_timeout(timeout))
+
+    def get(self, key, timeout=None):
+        value = self.front.get(key, self._front_timeout(timeout))
+        if value is not None:
+            self._count_hit('_front_hits')
+            return value
+
+        value = self.back.get(key, timeout)
+        if value is not None:
+            self._count_hit('_back_hits')
+            self.front.store(key, value)
+        else:
+            self._count_hit('_misses')
+        return value
+
+    def _count_hit(self, counter):
+        self._stats_lock.acquire()
+        setattr(self, counter, getattr(self, counter) + 1)
+        self._stats_lock.release()
+
+    def count(self):
+        return self.back.count()
+
+    def cleanup(self):
+        self.front.cleanup()
+        self.back.cleanup()
+
+    def sweep(self, max_time=None):
+        start = time.time()
+        removed = self.front.sweep(max_time)
+        if max_time is not None:
+            max_time = max(max_time - (time.time() - start), 0)
+        return removed + self.back.sweep(max_time)
+
+    def flush(self):
+        self.front.flush()
+        self.back.flush()
+
+    def stats(self):
+        """Get a dict of statistics
+            front_hits: lookups served by the front tier
+            back_hits: lookups served by the back tier
+            misses: lookups neither tier could serve
+            front, back: stats() of each tier
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = {
+                'front_hits': self._front_hits,
+                'back_hits': self._back_hits,
+                'misses': self._misses
+            }
+        finally:
+            self._stats_lock.release()
+        stats['front'] = self.front.stats()
+        stats['back'] = self.back.stats()
+        return stats
+
+
+class MemCacheCache(Cache):
+    """Cache backed by memcached servers
+
+    Speaks the memcached text protocol. Keys are spread across servers
+    with consistent hashing so adding or removing a server only moves a
+    small share of the keys. Sockets to each server are pooled and
+    reused between calls. A server which is down or refuses a value
+    turns gets into misses and stores into no-ops, stats() counts them
+    as errors. A server which could not be reached is marked down for
+    dead_retry seconds, its keys miss without waiting on it meanwhile.
+    """
+
+    def __init__(self, servers, timeout=60, compress_level=0,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL, pool_size=4,
+            socket_timeout=3.0, replicas=100, dead_retry=30):
+        """Initialize the cache
+            servers: list of 'host:port' strings
+            pool_size: max number of idle connections kept per server
+            socket_timeout: seconds to wait on a server before giving up
+            replicas: points per server on the hash ring
+            dead_retry: seconds before trying a server which failed again
+        """
+        Cache.__init__(self, timeout, compress_level, pickle_protocol)
+        self.servers = [_MemCacheServer(s, pool_size, socket_timeout, dead_retry)
+                for s in servers]
+        self._ring = []
+        for server in self.servers:
+            for i in range(replicas):
+                self._ring.append((self._hash('%s-%i' % (server.address, i)), server))
+        self._ring.sort()
+        self._ring_points = [point for point, server in self._ring]
+        self._errors = 0
+
+    def _hash(self, key):
+        return long(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def _get_key(self, key):
+        # memcached keys are limited in length and may not contain
+        # whitespace, so use the hash of our key.
+        return hashlib.md5(key).hexdigest()
+
+    def _get_server(self, mc_key):
+        i = bisect.bisect(self._ring_points, self._hash(mc_key))
+        if i == len(self._ring):
+            i = 0
+        return self._ring[i][1]
+
+    def store(self, key, value, timeout=None):
+        mc_key = self._get_key(key)
+        compressed, data = self._pack(value)
+        created_time = time.time()
+        expires = self._get_expires(created_time, timeout)
+        data = pickle.dumps((created_time, data, compressed, expires), self.pickle_protocol)
+        exptime = 0
+        if expires > 0:
+            exptime = int(math.ceil(expires - created_time))
+            if exptime > 2592000:
+                # memcached treats more than 30 days as a unix timestamp
+                exptime += int(time.time())
+        try:
+            self._get_server(mc_key).call(
+                'set %s 0 %i %i\r\n%s\r\n' % (mc_key, exptime, len(data), data),
+                _read_line)
+        except (socket.error, IOError):
+            # ex: server down or value too large, leave it uncached
+            self._count_error()
+
+    def get(self, key, timeout=None):
+        return self.get_multi([key], timeout).get(key)
+
+    def get_multi(self, keys, timeout=None):
+        """Get many entries with one request per server
+            keys: which entries to get
+            timeout: override timeout with this value [optional]
+        Returns a dict of the found entries which have not expired.
+        """
+        # group keys by the server holding them
+        by_server = {}
+        mc_keys = {}
+        for key in keys:
+            mc_key = self._get_key(key)
+            mc_keys[mc_key] = key
+            by_server.setdefault(self._get_server(mc_key), []).append(mc_key)
+
+        results = {}
+        for server, server_keys in by_server.items():
+            try:
+                values = server.call('get %s\r\n' % ' '.join(server_keys), _read_values)
+            except (socket.error, IOError):
+                # treat the keys of an unreachable server as missing
+                self._count_error()
                 continue
-            c += 1
+            for mc_key, data in values.items():
+                created_time, data, compressed, expires = pickle.loads(data)
+                if self._is_expired(created_time, expires, timeout):
+                    continue
+                results[mc_keys[mc_key]] = self._unpack(compressed, data)
+        return results
+
+    def _count_error(self):
+        self._stats_lock.acquire()
+        self._errors += 1
+        self._stats_lock.release()
+
+    def stats(self):
+        """Get a dict of statistics
+            errors: gets and stores which failed on a server
+            and the byte counts of Cache.stats()
+        """
+        stats = Cache.stats(self)
+        self._stats_lock.acquire()
+        stats['errors'] = self._errors
+        self._stats_lock.release()
+        return stats
+
+    def count(self):
+        c = 0
+        for server in self.servers:
+            c += int(server.call('stats\r\n', _read_stats).get('curr_items', 0))
         return c
 
     def cleanup(self):
-        for entry in os.listdir(self.cache_dir):
-            if entry.endswith('.lock'):
-                continue
-            self._get(os.path.join(self.cache_dir, entry), None)
+        # memcached expires entries on its own
+        return
+
+    def sweep(self, max_time=None):
+        return 0
 
     def flush(self):
-        for entry in os.listdir(self.cache_dir):
-            if entry.endswith('.lock'):
-                continue
-            self._delete_file(os.path.join(self.cache_dir, entry))
+        for server in self.servers:
+            server.call('flush_all\r\n', _read_line)
+
+    def disconnect(self):
+        """Close all pooled server connections"""
+        for server in self.servers:
+            server.disconnect()
+
+
+class _MemCacheServer(object):
+    """Pool of connections to a single memcached server"""
+
+    def __init__(self, address, pool_size, socket_timeout, dead_retry):
+        self.address = address
+        host, port = address.split(':')
+        self._addr = (host, int(port))
+        self.pool_size = pool_size
+        self.socket_timeout = socket_timeout
+        self.dead_retry = dead_retry
+        self._dead_until = 0
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        self._lock.acquire()
+        try:
+            if self._pool:
+                return self._pool.pop()
+        finally:
+            self._lock.release()
+        sock = socket.create_connection(self._addr, self.socket_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _release(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn[1].close()
+        conn[0].close()
+
+    def disconnect(self):
+        self._lock.acquire()
+        pool, self._pool = self._pool, []
+        self._lock.release()
+        for conn in pool:
+            conn[1].close()
+            conn[0].close()
+
+    def _mark_dead(self):
+        self._dead_until = time.time() + self.dead_retry
+        self.disconnect()
+
+    def call(self, command, read_reply):
+        """Send command and return read_reply(fp) on the reply"""
+        if self._dead_until:
+            if time.time() < self._dead_until:
+                raise socket.error('memcached server %s is marked down' % self.address)
+            self._dead_until = 0
+        try:
+            conn = self._acquire()
+        except socket.error:
+            self._mark_dead()
+            raise
+        try:
+            conn[0].sendall(command)
+            reply = read_reply(conn[1])
+        except _MemCacheReplyError:
+            # the server answered, but do not reuse a connection
+            # in an unknown state
+            conn[1].close()
+            conn[0].close()
+            raise
+        except (socket.error, IOError):
+            conn[1].close()
+            conn[0].close()
+            self._mark_dead()
+            raise
+        except:
+            conn[1].close()
+            conn[0].close()
+            raise
+        self._release(conn)
+        return reply
+
+
+class _MemCacheReplyError(IOError):
+    """Error reply from a memcached server"""
+
+
+def _read_line(fp):
+    line = fp.readline()
+    if not line:
+        raise IOError('memcached connection closed')
+    line = line.rstrip('\r\n')
+    if line.startswith('ERROR') or line.startswith('CLIENT_ERROR') \
+            or line.startswith('SERVER_ERROR'):
+        raise _MemCacheReplyError('memcached error: %s' % line)
+    return line
+
+
+def _read_values(fp):
+    values = {}
+    while True:
+        line = _read_line(fp)
+        if line == 'END':
+            return values
+        cmd, key, flags, length = line.split(' ')[:4]
+        values[key] = fp.read(int(length))
+        fp.read(2)  # trailing \r\n
+
+
+def _read_stats(fp):
+    stats = {}
+    while True:
+        line = _read_line(fp)
+        if line == 'END':
+            return stats
+        cmd, name, value = line.split(' ', 2)
+        stats[name] = value
+
+
+class CacheSweeper(threading.Thread):
+    """Background thread which expires cache entries
+
+    Calls cache.sweep() in batches of at most batch_time seconds,
+    waiting interval seconds unless a batch used all of its time
+    expiring entries.
+    """
+
+    def __init__(self, cache, interval=1.0, batch_time=0.005):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cache = cache
+        self.interval = interval
+        self.batch_time = batch_time
+        self.swept = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.isSet():
+            start = time.time()
+            removed = self.cache.sweep(self.batch_time)
+            self.swept += removed
+            if removed and time.time() - start >= self.batch_time:
+                # more work left, let other threads at the cache first
+                time.sleep(0)
+            else:
+                # caught up (or a full scan found nothing), wait for
+                # more entries to expire
+                self._stopped.wait(self.interval)
 
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -2,6 +2,8 @@
 # Copyright 2009-2010 Joshua Roesslein
 # See LICENSE for details.
 
+import time
+
 from tweepy.error import TweepError
 
 class Cursor(object):
@@ -16,14 +18,16 @@ class Cursor(object):
         else:
             raise TweepError('This method does not perform pagination')
 
-    def pages(self, limit=0):
+    def pages(self, limit=0, time_budget=None):
         """Return iterator for pages"""
         if limit > 0:
             self.iterator.limit = limit
+        self.iterator.set_time_budget(time_budget)
         return self.iterator
 
-    def items(self, limit=0):
+    def items(self, limit=0, time_budget=None):
         """Return iterator for items in each page"""
+        self.iterator.set_time_budget(time_budget)
         i = ItemIterator(self.iterator)
         i.limit = limit
         return i
@@ -35,6 +39,23 @@ class BaseIterator(object):
         self.args = args
         self.kargs = kargs
         self.limit = 0
+        self.deadline = None
+
+    def set_time_budget(self, seconds):
+        """Limit the whole crawl to seconds, passed to each call as its deadline"""
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + seconds
+
+    def call(self, **kargs):
+        params = dict(self.kargs)
+        params.update(kargs)
+        if self.deadline is not None:
+            if time.time() >= self.deadline:
+                raise TweepError('Cursor time budget exceeded')
+            params['deadline'] = self.deadline
+        return self.method(*self.args, **params)
 
     def next(self):
         raise NotImplementedError
@@ -56,9 +77,7 @@ class CursorIterator(BaseIterator):
     def next(self):
         if self.next_cursor == 0 or (self.limit and self.count == self.limit):
             raise StopIteration
-        data, cursors = self.method(
-                cursor=self.next_cursor, *self.args, **self.kargs
-        )
+        data, cursors = self.call(cursor=self.next_cursor)
         self.prev_cursor, self.next_cursor = cursors
         if len(data) == 0:
             raise StopIteration
@@ -68,9 +87,7 @@ class CursorIterator(BaseIterator):
     def prev(self):
         if self.prev_cursor == 0:
             raise TweepError('Can not page back more, at first page')
-        data, self.next_cursor, self.prev_cursor = self.method(
-                cursor=self.prev_cursor, *self.args, **self.kargs
-        )
+        data, self.next_cursor, self.prev_cursor = self.call(cursor=self.prev_cursor)
         self.count -= 1
         return data
 
@@ -82,7 +99,7 @@ class PageIterator(BaseIterator):
 
     def next(self):
         self.current_page += 1
-        items = self.method(page=self.current_page, *self.args, **self.kargs)
+        items = self.call(page=self.current_page)
         if len(items) == 0 or (self.limit > 0 and self.current_page > self.limit):
             raise StopIteration
         return items
@@ -91,7 +108,7 @@ class PageIterator(BaseIterator):
         if (self.current_page == 1):
             raise TweepError('Can not page back more, at first page')
         self.current_page -= 1
-        return self.method(page=self.current_page, *self.args, **self.kargs)
+        return self.call(page=self.current_page)
 
 class ItemIterator(BaseIterator):
 
@@ -0,0 +1,59 @@
+# Tweepy
+# Copyright 2009-2010 Joshua Roesslein
+# See LICENSE for details.
+
+import time
+
+
+class RequestInfo(object):
+    """Describes one API method call as seen by request hooks.
+
+    timings maps a phase to seconds spent in it: cache_lookup, connect,
+    send, first_byte (waiting for the response headers), read, decompress
+    (compressed responses only) and parse. bytes_received counts the
+    body as received, before decompression.
+    Phases repeated by retries are summed, total covers the whole call.
+    cache is None if the request was not cached, otherwise one of 'hit',
+    'stale' (expired entry served while it is refreshed), 'negative'
+    (cached 404), 'miss', 'coalesced' (shared another caller's request),
+    'refresh' (background refresh of a stale entry) or 'revalidated'
+    (the server answered 304 Not Modified to a conditional request).
+    timed_out is set when the call failed because no response arrived
+    within the read timeout or the deadline.
+    """
+
+    def __init__(self, path, method, host):
+        self.path = path
+        self.method = method
+        self.host = host
+        self.url = None
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.cache = None
+        self.error = None
+        self.timed_out = False
+        self.timings = {}
+
+    def mark(self, phase, start):
+        """Add the time since start to phase and return the current time"""
+        now = time.time()
+        self.timings[phase] = self.timings.get(phase, 0) + (now - start)
+        return now
+
+
+class RequestHook(object):
+    """Request hook interface.
+
+    Hooks are passed to API(hooks=[...]) and called for every API method
+    call with its RequestInfo. post_request is called once the call
+    returns or fails, info.error holds the exception on failure.
+    """
+
+    def pre_request(self, info):
+        pass
+
+    def post_request(self, info):
+        pass
+
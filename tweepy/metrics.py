@@ -0,0 +1,250 @@
+# Tweepy
+# Copyright 2009-2010 Joshua Roesslein
+# See LICENSE for details.
+
+from math import frexp, ceil
+import threading
+
+from tweepy.hooks import RequestHook
+
+
+class Histogram(object):
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are recorded in microseconds into buckets whose width grows
+    with their magnitude. Each power of two is split into
+    2 ** (significant_bits - 1) buckets, which bounds the relative error
+    of reported percentiles (under 1.6% with the default of 7 bits).
+    """
+
+    def __init__(self, significant_bits=7):
+        self.significant_bits = significant_bits
+        self._half = 1 << (significant_bits - 1)
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self._half << 1:
+            return value
+        shift = frexp(value)[1] - self.significant_bits
+        return shift * self._half + (value >> shift)
+
+    def _highest(self, index):
+        # highest value falling in the bucket
+        if index < self._half << 1:
+            return index
+        shift = index // self._half - 1
+        return ((index - shift * self._half + 1) << shift) - 1
+
+    def record(self, seconds):
+        index = self._index(int(seconds * 1000000))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """Return the value (in seconds) below which percent of values fall"""
+        if not self.count:
+            return 0.0
+        target = max(1, int(ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest(index) / 1000000.0, self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def copy(self):
+        histogram = Histogram(self.significant_bits)
+        histogram.merge(self)
+        return histogram
+
+
+class EndpointMetrics(object):
+    """Counters and latency histograms for one endpoint path.
+
+    calls counts API method calls (or stream connections), errors counts
+    failures by status code, or 'network' / 'timeout' when no response
+    was received, 'stall' for streams which stopped sending data and
+    'exception' for streams stopped by an unexpected exception.
+    latency maps a phase name to its Histogram, see RequestInfo.timings
+    for the phases recorded for API calls. Streams record the 'connect'
+    phase (until response headers) only.
+    """
+
+    def __init__(self, significant_bits=7):
+        self.significant_bits = significant_bits
+        self.calls = 0
+        self.errors = {}
+        self.retries = 0
+        self.cache = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages = 0
+        self.latency = {}
+
+    def record_latency(self, phase, seconds):
+        histogram = self.latency.get(phase)
+        if histogram is None:
+            histogram = self.latency[phase] = Histogram(self.significant_bits)
+        histogram.record(seconds)
+
+    def record_error(self, key):
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def copy(self):
+        metrics = EndpointMetrics(self.significant_bits)
+        metrics.__dict__.update(self.__dict__)
+        metrics.errors = self.errors.copy()
+        metrics.cache = self.cache.copy()
+        metrics.latency = dict([(k, v.copy()) for k, v in self.latency.items()])
+        return metrics
+
+
+class MetricsCollector(RequestHook):
+    """Collects per endpoint metrics from API and Stream.
+
+    Attach with API(hooks=[collector]) and Stream(..., metrics=collector).
+    Metrics are keyed by the bind_api path (ex: /statuses/show/{id}.json)
+    or the stream path. Safe to share between threads.
+    """
+
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, significant_bits=7):
+        self.significant_bits = significant_bits
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _endpoint(self, path):
+        metrics = self._endpoints.get(path)
+        if metrics is None:
+            metrics = self._endpoints[path] = EndpointMetrics(self.significant_bits)
+        return metrics
+
+    def post_request(self, info):
+        self._lock.acquire()
+        try:
+            metrics = self._endpoint(info.path)
+            metrics.calls += 1
+            metrics.retries += info.retries
+            metrics.bytes_sent += info.bytes_sent
+            metrics.bytes_received += info.bytes_received
+            if info.cache:
+                metrics.cache[info.cache] = metrics.cache.get(info.cache, 0) + 1
+            if info.error:
+                if info.cache == 'negative':
+                    metrics.record_error(404)
+                elif info.timed_out:
+                    metrics.record_error('timeout')
+                else:
+                    metrics.record_error(info.status or 'network')
+            for phase, seconds in info.timings.items():
+                metrics.record_latency(phase, seconds)
+        finally:
+            self._lock.release()
+
+    def stream_connected(self, path, status, seconds):
+        """Record a stream connection attempt which got a response"""
+        self._lock.acquire()
+        try:
+            metrics = self._endpoint(path)
+            metrics.calls += 1
+            metrics.record_latency('connect', seconds)
+            if status != 200:
+                metrics.record_error(status)
+        finally:
+            self._lock.release()
+
+    def stream_message(self, path, size):
+        self._lock.acquire()
+        try:
+            metrics = self._endpoint(path)
+            metrics.messages += 1
+            metrics.bytes_received += size
+        finally:
+            self._lock.release()
+
+    def stream_error(self, path, cause):
+        """Record a stream failure without a response
+            cause: 'timeout', 'network', 'stall' or 'exception'
+        """
+        self._lock.acquire()
+        try:
+            self._endpoint(path).record_error(cause)
+        finally:
+            self._lock.release()
+
+    def snapshot(self, reset=False):
+        """Return a dict of path to a copy of its EndpointMetrics"""
+        self._lock.acquire()
+        try:
+            if reset:
+                snapshot = self._endpoints
+                self._endpoints = {}
+            else:
+                snapshot = dict([(k, v.copy()) for k, v in self._endpoints.items()])
+        finally:
+            self._lock.release()
+        return snapshot
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def exposition(self, prefix='tweepy', snapshot=None):
+        """Return the metrics in the Prometheus text exposition format"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        counters = (
+            ('requests_total', lambda m: [('', m.calls)]),
+            ('errors_total', lambda m: [(',status="%s"' % k, v) for k, v in sorted(m.errors.items())]),
+            ('retries_total', lambda m: [('', m.retries)]),
+            ('cache_total', lambda m: [(',state="%s"' % k, v) for k, v in sorted(m.cache.items())]),
+            ('bytes_sent_total', lambda m: [('', m.bytes_sent)]),
+            ('bytes_received_total', lambda m: [('', m.bytes_received)]),
+            ('stream_messages_total', lambda m: [('', m.messages)]),
+        )
+        paths = sorted(snapshot)
+        lines = []
+        for name, samples in counters:
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for path in paths:
+                for labels, value in samples(snapshot[path]):
+                    lines.append('%s_%s{path="%s"%s} %s' % (prefix, name, path, labels, value))
+
+        lines.append('# TYPE %s_request_seconds summary' % prefix)
+        for path in paths:
+            for phase, histogram in sorted(snapshot[path].latency.items()):
+                labels = 'path="%s",phase="%s"' % (path, phase)
+                for q in self.quantiles:
+                    lines.append('%s_request_seconds{%s,quantile="%s"} %.6f' % (
+                            prefix, labels, q, histogram.percentile(q * 100)))
+                lines.append('%s_request_seconds_sum{%s} %.6f' % (prefix, labels, histogram.total))
+                lines.append('%s_request_seconds_count{%s} %i' % (prefix, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
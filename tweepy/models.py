@@ -19,7 +19,7 @@ class Model(object):
     def __getstate__(self):
         # pickle
         pickle = dict(self.__dict__)
-        del pickle['_api']  # do not pickle the API reference
+        pickle.pop('_api', None)  # do not pickle the API reference
         return pickle
 
     @classmethod
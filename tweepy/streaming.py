@@ -2,18 +2,24 @@
 # Copyright 2009-2010 Joshua Roesslein
 # See LICENSE for details.
 
-import httplib
 from socket import timeout
-from threading import Thread
-from time import sleep
+from threading import Thread, Lock, currentThread
+from time import sleep, time
 import urllib
+import httplib
+import socket
+import select
+import errno
+import os
+import sys
 
 from tweepy.auth import BasicAuthHandler
 from tweepy.models import Status
 from tweepy.api import API
 from tweepy.error import TweepError
+from tweepy.transport import HTTPTransport, read_available
 
-from tweepy.utils import import_simplejson
+from tweepy.utils import import_simplejson, decompressor
 json = import_simplejson()
 
 STREAM_VERSION = 1
@@ -63,13 +69,121 @@ class StreamListener(object):
         """Called when stream connection times out"""
         return
 
+    def on_exception(self, exception):
+        """Called when an unexpected exception stops the stream"""
+        return
+
+
+class ReadBuffer(object):
+    """Splits a stream body into lines and length delimited messages.
+
+    source(size) is called for more data whenever the buffer runs short,
+    with the number of bytes still needed, and returns '' at the end of
+    the stream.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._buffer = ''
+        self._pos = 0
+
+    def _fill(self, size):
+        data = self._source(size)
+        if not data:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def read_line(self):
+        """Return the next line without its newline, None at end of stream"""
+        while True:
+            end = self._buffer.find('\n', self._pos)
+            if end >= 0:
+                line = self._buffer[self._pos:end]
+                self._pos = end + 1
+                return line
+            if not self._fill(1):
+                return None
+
+    def read(self, size):
+        """Return the next size bytes, None at end of stream"""
+        while len(self._buffer) - self._pos < size:
+            if not self._fill(size - len(self._buffer) + self._pos):
+                return None
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += size
+        return data
+
+
+class ReconnectPolicy(object):
+    """Decides how long a stream waits before reconnecting.
+
+    Network errors and timeouts back off exponentially from network_delay
+    up to network_max_delay, HTTP error responses from http_delay up to
+    http_max_delay, starting from rate_limit_delay for 420 responses. The
+    two curves are kept separately and both start over once a connection
+    succeeds. A stream ending normally is reconnected at once.
+
+    A connected stream receiving no message or keep-alive newline for
+    stall_timeout seconds is considered stalled and reconnected.
+    counts holds the number of reconnects by cause: 'network', 'timeout',
+    'stall', 'closed' (the server ended the stream) or an HTTP status code,
+    and of streams stopped by an 'exception'.
+    """
+
+    def __init__(self, network_delay=0.25, network_max_delay=16.0,
+            http_delay=5.0, http_max_delay=320.0, rate_limit_delay=60.0,
+            stall_timeout=90.0):
+        self.network_delay = network_delay
+        self.network_max_delay = network_max_delay
+        self.http_delay = http_delay
+        self.http_max_delay = http_max_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.stall_timeout = stall_timeout
+        self.counts = {}
+        self.connected()
+
+    def connected(self):
+        """Reset the backoff after a successful connection"""
+        self.network_failures = 0
+        self.http_failures = 0
+
+    def delay(self, cause):
+        """Record a reconnect and return the seconds to wait before it"""
+        self.counts[cause] = self.counts.get(cause, 0) + 1
+        if cause == 'closed':
+            return 0
+        if isinstance(cause, int):
+            if cause == 420:
+                delay = self.rate_limit_delay
+            else:
+                delay = self.http_delay
+            delay, max_delay = delay * 2 ** self.http_failures, self.http_max_delay
+            self.http_failures += 1
+        else:
+            delay = self.network_delay * 2 ** self.network_failures
+            max_delay = self.network_max_delay
+            self.network_failures += 1
+        return min(delay, max_delay)
+
+    def stopped(self, cause):
+        """Record a failure which stops the stream instead of reconnecting"""
+        self.counts[cause] = self.counts.get(cause, 0) + 1
+
+
+class _StreamStalled(Exception):
+    pass
+
 
 class Stream(object):
 
     host = 'stream.twitter.com'
 
     def __init__(self, username, password, listener, timeout=5.0, retry_count = None,
-                    retry_time = 10.0, snooze_time = 5.0, buffer_size=1500, headers=None):
+                    retry_time = 10.0, snooze_time = 5.0, buffer_size=1500, headers=None,
+                    metrics=None, transport=None, compression=False, manager=None,
+                    reconnect_policy=None):
         self.auth = BasicAuthHandler(username, password)
         self.running = False
         self.timeout = timeout
@@ -81,75 +195,166 @@ class Stream(object):
         self.api = API()
         self.headers = headers or {}
         self.body = None
+        self.metrics = metrics
+        self.transport = transport or HTTPTransport()
+        self.compression = compression
+        # StreamManager running this stream instead of a thread of its own,
+        # the manager keeps the stream's StreamStats in stats
+        self.manager = manager
+        self.stats = None
+        # the first reconnect waits retry_time after an HTTP error and
+        # snooze_time after a network error or timeout, longer configured
+        # delays raise the caps so they are not cut down
+        if reconnect_policy is None:
+            reconnect_policy = ReconnectPolicy(network_delay=snooze_time,
+                    http_delay=retry_time)
+            reconnect_policy.network_max_delay = \
+                    max(reconnect_policy.network_max_delay, snooze_time)
+            reconnect_policy.http_max_delay = \
+                    max(reconnect_policy.http_max_delay, retry_time)
+        self.reconnect_policy = reconnect_policy
+        if compression:
+            self.headers['Accept-Encoding'] = 'gzip'
 
     def _run(self):
         # setup
         self.auth.apply_auth(None, None, self.headers, None)
 
         # enter loop
+        policy = self.reconnect_policy
         error_counter = 0
         conn = None
+        exc_info = None
         while self.running:
             if self.retry_count and error_counter > self.retry_count:
                 # quit if error count greater than retry count
                 break
             try:
-                conn = httplib.HTTPConnection(self.host)
+                start = time()
+                conn = self.transport.connection(self.host, timeout=self.timeout)
                 conn.connect()
-                conn.sock.settimeout(self.timeout)
                 conn.request('POST', self.url, self.body, headers=self.headers)
                 resp = conn.getresponse()
+                if self.metrics:
+                    self.metrics.stream_connected(self.path(), resp.status, time() - start)
                 if resp.status != 200:
                     if self.listener.on_error(resp.status) is False:
                         break
                     error_counter += 1
-                    sleep(self.retry_time)
+                    cause = resp.status
                 else:
                     error_counter = 0
-                    self._read_loop(resp)
+                    policy.connected()
+                    cause = self._read_loop(resp)
+                    if cause == 'stall' and self.metrics:
+                        self.metrics.stream_error(self.path(), 'stall')
             except timeout:
+                if self.metrics:
+                    self.metrics.stream_error(self.path(), 'timeout')
                 if self.listener.on_timeout() == False:
                     break
-                if self.running is False:
-                    break
-                conn.close()
-                sleep(self.snooze_time)
-            except Exception:
-                # any other exception is fatal, so kill loop
+                cause = 'timeout'
+            except (socket.error, httplib.HTTPException):
+                if self.metrics:
+                    self.metrics.stream_error(self.path(), 'network')
+                error_counter += 1
+                cause = 'network'
+            except Exception, e:
+                # any other exception is fatal, so kill loop and
+                # raise it once the connection is cleaned up
+                exc_info = sys.exc_info()
+                policy.stopped('exception')
+                if self.metrics:
+                    self.metrics.stream_error(self.path(), 'exception')
+                self.listener.on_exception(e)
                 break
+            if conn:
+                conn.close()
+            if self.running:
+                self._wait(policy.delay(cause))
 
         # cleanup
         self.running = False
         if conn:
             conn.close()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-    def _read_loop(self, resp):
-        data = ''
+    def _wait(self, seconds):
+        # sleep in steps so disconnect() is not held up by a long backoff
+        end = time() + seconds
         while self.running:
-            if resp.isclosed():
+            remaining = end - time()
+            if remaining <= 0:
                 break
-
-            # read length
-            length = ''
+            sleep(min(remaining, 0.5))
+
+    def _body_source(self, resp):
+        # Each read returns what the socket has (up to buffer_size bytes)
+        # instead of waiting for a full buffer, so quiet streams are not
+        # delayed and lines are not read one byte at a time.
+        decoder = decompressor(resp.getheader('content-encoding'))
+        if decoder is None:
+            def read(size):
+                return read_available(resp, max(size, self.buffer_size))
+            return read
+
+        def read_compressed(size):
             while True:
-                c = resp.read(1)
-                if c == '\n':
-                    break
-                length += c
-            length = length.strip()
-            if length.isdigit():
-                length = int(length)
-            else:
-                continue
+                data = read_available(resp, self.buffer_size)
+                if not data:
+                    return decoder.flush()
+                data = decoder.decompress(data)
+                if data:
+                    return data
+        return read_compressed
+
+    def _stall_guard(self, source):
+        # Fail reads once no line arrived for stall_timeout seconds, the
+        # socket timeout only notices a connection going completely quiet.
+        stall_timeout = self.reconnect_policy.stall_timeout
+        def read(size):
+            if time() - self._last_line > stall_timeout:
+                raise _StreamStalled()
+            return source(size)
+        return read
 
-            # read data and pass into listener
-            data = resp.read(length)
-            if self.listener.on_data(data) is False:
-                self.running = False
+    def _read_loop(self, resp):
+        """Read messages until the stream ends, return the reconnect cause"""
+        path = self.path()
+        self._last_line = time()
+        buf = ReadBuffer(self._stall_guard(self._body_source(resp)))
+        try:
+            while self.running:
+                # read length, skipping keep-alive newlines
+                length = buf.read_line()
+                if length is None:
+                    return 'closed'
+                self._last_line = time()
+                length = length.strip()
+                if not length.isdigit():
+                    continue
+
+                # read data and pass into listener
+                data = buf.read(int(length))
+                if data is None:
+                    return 'closed'
+                if self.metrics:
+                    self.metrics.stream_message(path, len(data))
+                if self.listener.on_data(data) is False:
+                    self.running = False
+        except _StreamStalled:
+            return 'stall'
+
+    def path(self):
+        """Return the path of the stream url, without the query"""
+        return self.url.split('?', 1)[0]
 
     def _start(self, async):
         self.running = True
-        if async:
+        if self.manager:
+            self.manager.add(self)
+        elif async:
             Thread(target=self._run).start()
         else:
             self._run()
@@ -194,3 +399,521 @@ class Stream(object):
             return
         self.running = False
 
+
+class StreamStats(object):
+    """Counters for one stream run by a StreamManager.
+
+    bytes_received counts bytes read from the socket, headers included.
+    errors counts failed connections by cause: an HTTP status code,
+    'timeout', 'network', 'stall' or 'exception' (raised while handling
+    data, this stops the stream).
+    """
+
+    def __init__(self):
+        self.connects = 0
+        self.messages = 0
+        self.bytes_received = 0
+        self.keep_alives = 0
+        self.errors = {}
+        self.status = None
+        self.connected = False
+        self.last_message = None
+
+    def record_error(self, cause):
+        self.errors[cause] = self.errors.get(cause, 0) + 1
+
+    def copy(self):
+        stats = StreamStats()
+        stats.__dict__.update(self.__dict__)
+        stats.errors = self.errors.copy()
+        return stats
+
+
+class StreamManager(object):
+    """Runs many streams on a single thread.
+
+    A Stream created with manager=... is handed to the manager when one
+    of its stream methods (filter, sample, ...) is called, which then
+    returns at once. The manager connects each stream with a non-blocking
+    socket and watches all of them in one poll() loop (select() where poll
+    is not available). Responses are decoded (chunked transfer encoding,
+    gzip) as they arrive and messages are passed to the stream's listener
+    on the manager thread. Sockets are read into a single buffer of
+    buffer_size bytes shared by all streams, only incomplete messages are
+    kept per stream.
+
+    Streams keep their timeout, retry_count and reconnect_policy settings
+    and report to their metrics collector. Each stream's StreamStats is
+    kept in its stats attribute, stats() returns copies for the running
+    streams. Only plain HTTP is supported, the stream's transport is not
+    used. New and disconnected streams are picked up within
+    wakeup_interval seconds. Host names are looked up on a separate
+    thread and cached until a connection to the host fails.
+    """
+
+    def __init__(self, buffer_size=65536, wakeup_interval=0.2):
+        self.buffer_size = buffer_size
+        self.wakeup_interval = wakeup_interval
+        self.recv_buffer = bytearray(buffer_size)
+        self.running = False
+        self._poller = _Poller()
+        self._connections = {}
+        self._by_fd = {}
+        self._pending = []
+        self._lock = Lock()
+        self._thread = None
+        # (host, port) -> getaddrinfo() result, the socket.error it
+        # raised or None while the lookup is running
+        self._addresses = {}
+
+    def add(self, stream):
+        """Run stream, called by the stream methods of a Stream with this manager"""
+        stream.auth.apply_auth(None, None, stream.headers, None)
+        self._lock.acquire()
+        self._pending.append(stream)
+        self._lock.release()
+
+    def stats(self):
+        """Return a dict of stream to a copy of its StreamStats"""
+        self._lock.acquire()
+        try:
+            return dict([(stream, conn.stats.copy())
+                    for stream, conn in self._connections.items()])
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """Run the manager loop in a new thread"""
+        self.running = True
+        self._thread = Thread(target=self.run)
+        self._thread.start()
+
+    def stop(self):
+        """Disconnect every stream and end the manager loop"""
+        self.running = False
+        if self._thread and self._thread is not currentThread():
+            self._thread.join()
+        self._finish_pending()
+
+    def _finish_pending(self):
+        # streams added but never picked up by the loop
+        self._lock.acquire()
+        pending, self._pending = self._pending, []
+        self._lock.release()
+        for stream in pending:
+            stream.running = False
+
+    def run(self):
+        """Run the streams until stop() is called"""
+        self.running = True
+        last_check = 0
+        try:
+            while self.running:
+                now = time()
+                if now - last_check >= self.wakeup_interval:
+                    self._check(now)
+                    last_check = now
+                for fd in self._poller.wait(self.wakeup_interval):
+                    conn = self._by_fd.get(fd)
+                    if conn is not None:
+                        self._dispatch(conn, conn.on_ready, time())
+        finally:
+            self.running = False
+            for conn in self._connections.values():
+                conn.finish()
+            self._lock.acquire()
+            self._connections = {}
+            self._lock.release()
+            self._finish_pending()
+
+    def _check(self, now):
+        # start new streams, reconnect and time out connections
+        self._lock.acquire()
+        try:
+            for stream in self._pending:
+                self._connections[stream] = _ManagedConnection(self, stream)
+            self._pending = []
+        finally:
+            self._lock.release()
+
+        finished = []
+        for conn in self._connections.values():
+            if not conn.stream.running:
+                conn.finish()
+            elif conn.state == 'waiting':
+                if now >= conn.retry_at:
+                    self._dispatch(conn, conn.connect, now)
+            elif now - conn.last_activity > conn.stream.timeout:
+                self._dispatch(conn, conn.on_timeout, now)
+            elif conn.state == 'body' and \
+                    now - conn.last_line > conn.stream.reconnect_policy.stall_timeout:
+                conn.fail('stall', now)
+            if conn.state == 'finished':
+                finished.append(conn.stream)
+
+        if finished:
+            self._lock.acquire()
+            for stream in finished:
+                del self._connections[stream]
+            self._lock.release()
+
+    def _dispatch(self, conn, handler, now):
+        try:
+            handler(now)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                conn.fail('network', now)
+        except Exception, e:
+            # like a Stream thread, anything else stops the stream
+            stream = conn.stream
+            conn.stats.record_error('exception')
+            stream.reconnect_policy.stopped('exception')
+            if stream.metrics:
+                stream.metrics.stream_error(stream.path(), 'exception')
+            conn.finish()
+            stream.listener.on_exception(e)
+
+    def resolve(self, host, port):
+        """Return the first getaddrinfo() result for host and port.
+        Returns None while the lookup runs on another thread and raises
+        the socket.error of a failed lookup, once.
+        """
+        key = (host, port)
+        self._lock.acquire()
+        try:
+            if key not in self._addresses:
+                self._addresses[key] = None
+                t = Thread(target=self._lookup, args=(key,))
+                t.setDaemon(True)
+                t.start()
+                return None
+            address = self._addresses[key]
+            if isinstance(address, socket.error):
+                # look it up again on the next attempt
+                del self._addresses[key]
+                raise address
+            return address
+        finally:
+            self._lock.release()
+
+    def forget(self, host, port):
+        """Drop the cached address of host and port"""
+        self._lock.acquire()
+        if self._addresses.get((host, port)) is not None:
+            del self._addresses[(host, port)]
+        self._lock.release()
+
+    def _lookup(self, key):
+        try:
+            address = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)[0]
+        except socket.error, e:
+            address = e
+        self._lock.acquire()
+        self._addresses[key] = address
+        self._lock.release()
+
+    def watch(self, conn, writable=False):
+        fd = conn.sock.fileno()
+        self._by_fd[fd] = conn
+        self._poller.register(fd, writable)
+
+    def unwatch(self, conn):
+        fd = conn.sock.fileno()
+        self._by_fd.pop(fd, None)
+        self._poller.unregister(fd)
+
+
+class _Poller(object):
+    """Waits for socket events with poll(), or select() where poll is missing"""
+
+    def __init__(self):
+        self._fds = {}
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        else:
+            self._poll = None
+
+    def register(self, fd, writable=False):
+        self._fds[fd] = writable
+        if self._poll:
+            if writable:
+                self._poll.register(fd, select.POLLOUT)
+            else:
+                self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        if fd in self._fds:
+            del self._fds[fd]
+            if self._poll:
+                self._poll.unregister(fd)
+
+    def wait(self, timeout):
+        """Return the ready file descriptors, waiting up to timeout seconds"""
+        if self._poll:
+            return [fd for fd, event in self._poll.poll(int(timeout * 1000))]
+        if not self._fds:
+            sleep(timeout)
+            return []
+        readers = [fd for fd, writable in self._fds.items() if not writable]
+        writers = [fd for fd, writable in self._fds.items() if writable]
+        readable, writable, failed = select.select(readers, writers, writers, timeout)
+        return readable + writable + [fd for fd in failed if fd not in writable]
+
+
+class _ChunkedDecoder(object):
+    """Decodes a chunked transfer encoded body fed in pieces"""
+
+    def __init__(self):
+        self.buffer = ''
+        self.remaining = None
+        self.done = False
+
+    def feed(self, data):
+        buf = self.buffer + data
+        decoded = []
+        pos = 0
+        while not self.done:
+            if self.remaining is None:
+                # chunk size line, or the empty line ending a chunk
+                end = buf.find('\r\n', pos)
+                if end < 0:
+                    break
+                size = buf[pos:end].split(';', 1)[0].strip()
+                pos = end + 2
+                if size:
+                    self.remaining = int(size, 16)
+                    self.done = self.remaining == 0
+            else:
+                data = buf[pos:pos + self.remaining]
+                decoded.append(data)
+                pos += len(data)
+                self.remaining -= len(data)
+                if self.remaining == 0:
+                    self.remaining = None
+                elif pos >= len(buf):
+                    break
+        self.buffer = buf[pos:]
+        return ''.join(decoded)
+
+
+class _MessageFramer(object):
+    """Splits length delimited messages fed in pieces, see ReadBuffer"""
+
+    def __init__(self):
+        self.buffer = ''
+        self.length = None
+        self.keep_alives = 0
+
+    def feed(self, data):
+        buf = self.buffer + data
+        messages = []
+        pos = 0
+        while True:
+            if self.length is None:
+                end = buf.find('\n', pos)
+                if end < 0:
+                    break
+                line = buf[pos:end].strip()
+                pos = end + 1
+                if line.isdigit():
+                    self.length = int(line)
+                elif not line:
+                    self.keep_alives += 1
+            elif len(buf) - pos >= self.length:
+                messages.append(buf[pos:pos + self.length])
+                pos += self.length
+                self.length = None
+            else:
+                break
+        self.buffer = buf[pos:]
+        return messages
+
+
+class _ManagedConnection(object):
+    """State of one stream in a StreamManager.
+
+    state goes from waiting (for retry_at) to connecting, sending,
+    headers and body, back to waiting when the connection ends and to
+    finished when the stream stops.
+    """
+
+    def __init__(self, manager, stream):
+        self.manager = manager
+        self.stream = stream
+        self.stats = stream.stats = StreamStats()
+        self.sock = None
+        self.address = None
+        self.state = 'waiting'
+        self.retry_at = 0
+        self.error_counter = 0
+        self.last_activity = None
+
+    def connect(self, now):
+        stream = self.stream
+        if stream.retry_count and self.error_counter > stream.retry_count:
+            self.finish()
+            return
+
+        host, port = stream.host, 80
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
+        self.address = host, port
+        address_info = self.manager.resolve(host, port)
+        if address_info is None:
+            # still looking up the host, try again on the next check
+            return
+        family, socktype, proto, name, address = address_info
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.started = self.last_activity = now
+        self.state = 'connecting'
+        self.manager.watch(self, writable=True)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            raise socket.error(err, os.strerror(err))
+
+        body = stream.body or ''
+        lines = ['POST %s HTTP/1.1' % stream.url, 'Host: %s' % stream.host]
+        lines.extend(['%s: %s' % header for header in stream.headers.items()])
+        lines.append('Content-Length: %i' % len(body))
+        lines.append('Connection: close')
+        self.output = '\r\n'.join(lines) + '\r\n\r\n' + body
+        self.head = ''
+
+    def on_ready(self, now):
+        self.last_activity = now
+        if self.state == 'connecting':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.state = 'sending'
+        if self.state == 'sending':
+            sent = self.sock.send(self.output)
+            self.output = self.output[sent:]
+            if not self.output:
+                self.state = 'headers'
+                self.manager.watch(self)
+            return
+
+        size = self.sock.recv_into(self.manager.recv_buffer)
+        if not size:
+            self.on_eof(now)
+            return
+        self.stats.bytes_received += size
+        # slicing a buffer() copies the received bytes into a str once
+        data = buffer(self.manager.recv_buffer, 0, size)[:]
+
+        if self.state == 'headers':
+            self.head += data
+            end = self.head.find('\r\n\r\n')
+            if end < 0:
+                return
+            data = self.head[end + 4:]
+            self.on_response(self.head[:end], now)
+        if self.state == 'body' and data:
+            self.on_body(data, now)
+
+    def on_response(self, head, now):
+        stream = self.stream
+        lines = head.split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        self.stats.connects += 1
+        self.stats.status = status
+        if stream.metrics:
+            stream.metrics.stream_connected(stream.path(), status, now - self.started)
+        if status != 200:
+            self.close()
+            self.stats.record_error(status)
+            if stream.listener.on_error(status) is False:
+                self.finish()
+                return
+            self.error_counter += 1
+            self.wait(now + stream.reconnect_policy.delay(status))
+            return
+
+        self.error_counter = 0
+        stream.reconnect_policy.connected()
+        self.stats.connected = True
+        self.state = 'body'
+        self.last_line = now
+        self.dechunker = None
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            self.dechunker = _ChunkedDecoder()
+        self.decoder = decompressor(headers.get('content-encoding'))
+        self.framer = _MessageFramer()
+
+    def on_body(self, data, now):
+        stream = self.stream
+        if self.dechunker:
+            data = self.dechunker.feed(data)
+        if self.decoder and data:
+            data = self.decoder.decompress(data)
+        messages = self.framer.feed(data)
+        if messages or self.framer.keep_alives:
+            self.last_line = now
+        self.stats.keep_alives += self.framer.keep_alives
+        self.framer.keep_alives = 0
+
+        for message in messages:
+            self.stats.messages += 1
+            self.stats.last_message = now
+            if stream.metrics:
+                stream.metrics.stream_message(stream.path(), len(message))
+            if stream.listener.on_data(message) is False or not stream.running:
+                self.finish()
+                return
+        if self.dechunker and self.dechunker.done:
+            self.on_eof(now)
+
+    def on_eof(self, now):
+        if self.state == 'body':
+            # the server ended the stream
+            self.close()
+            self.wait(now + self.stream.reconnect_policy.delay('closed'))
+        else:
+            self.fail('network', now)
+
+    def on_timeout(self, now):
+        stream = self.stream
+        self.close()
+        self.stats.record_error('timeout')
+        if stream.metrics:
+            stream.metrics.stream_error(stream.path(), 'timeout')
+        if stream.listener.on_timeout() == False:
+            self.finish()
+        else:
+            self.wait(now + stream.reconnect_policy.delay('timeout'))
+
+    def fail(self, cause, now):
+        self.close()
+        self.stats.record_error(cause)
+        if self.stream.metrics:
+            self.stream.metrics.stream_error(self.stream.path(), cause)
+        if cause == 'network':
+            self.error_counter += 1
+            if self.address:
+                # the host may have moved
+                self.manager.forget(*self.address)
+        self.wait(now + self.stream.reconnect_policy.delay(cause))
+
+    def wait(self, retry_at):
+        self.state = 'waiting'
+        self.retry_at = retry_at
+
+    def close(self):
+        if self.sock is not None:
+            self.manager.unwatch(self)
+            self.sock.close()
+            self.sock = None
+        self.stats.connected = False
+
+    def finish(self):
+        self.close()
+        self.state = 'finished'
+        self.stream.running = False
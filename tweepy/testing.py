@@ -0,0 +1,520 @@
+# Tweepy
+# Copyright 2010 Joshua Roesslein
+# See LICENSE for details.
+
+"""
+Local stand-in servers used to test and benchmark Tweepy offline.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import socket
+import time
+import cgi
+import re
+import zlib
+try:
+    import hashlib
+except ImportError:
+    # python 2.4
+    import md5 as hashlib
+
+from tweepy.api import API
+from tweepy.utils import import_simplejson
+json = import_simplejson()
+
+
+class LocalServer(object):
+    """Mixin to run a SocketServer in a background thread"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def start(self):
+        """Start serving in a background thread, returns 'host:port'"""
+        self._client_threads = []
+        t = threading.Thread(target=self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return '%s:%i' % self.server_address
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.process_request_thread,
+                args=(request, client_address))
+        t.setDaemon(True)
+        t.request = request
+        self._client_threads.append(t)
+        t.start()
+
+    def stop(self):
+        """Stop serving and drop any open client connections"""
+        self.shutdown()
+        self.server_close()
+        for t in self._client_threads:
+            try:
+                t.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            t.join()
+
+
+class MemcachedServer(LocalServer, SocketServer.ThreadingTCPServer):
+    """Tiny memcached server speaking the subset of the text protocol
+    used by MemCacheCache: get, set, delete, flush_all, stats and quit.
+    Like memcached, values larger than item_size_max are refused.
+    """
+
+    item_size_max = 1024 * 1024
+
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), MemcachedHandler)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        # caller must hold lock
+        entry = self.entries.get(key)
+        if entry and entry[1] and entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        return entry
+
+    def live_count(self):
+        self.lock.acquire()
+        try:
+            return len([k for k in self.entries.keys() if self.lookup(k)])
+        finally:
+            self.lock.release()
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+
+    # buffer replies and send each one in a single write
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = line.split()
+            if not args:
+                continue
+            handler = getattr(self, 'cmd_' + args[0], None)
+            if handler is None:
+                self.wfile.write('ERROR\r\n')
+            elif handler(args[1:]) is False:
+                return
+            self.wfile.flush()
+
+    def cmd_get(self, keys):
+        server = self.server
+        server.lock.acquire()
+        try:
+            for key in keys:
+                entry = server.lookup(key)
+                if entry:
+                    self.wfile.write('VALUE %s %i %i\r\n%s\r\n'
+                            % (key, entry[0], len(entry[2]), entry[2]))
+        finally:
+            server.lock.release()
+        self.wfile.write('END\r\n')
+
+    def cmd_set(self, args):
+        key, flags, exptime, length = args[:4]
+        data = self.rfile.read(int(length))
+        self.rfile.read(2)
+        if len(data) > self.server.item_size_max:
+            self.wfile.write('SERVER_ERROR object too large for cache\r\n')
+            return
+        exptime = int(exptime)
+        if exptime and exptime <= 2592000:
+            exptime += time.time()
+        self.server.lock.acquire()
+        self.server.entries[key] = (int(flags), exptime, data)
+        self.server.lock.release()
+        self.wfile.write('STORED\r\n')
+
+    def cmd_delete(self, args):
+        server = self.server
+        server.lock.acquire()
+        try:
+            found = server.lookup(args[0])
+            if found:
+                del server.entries[args[0]]
+        finally:
+            server.lock.release()
+        if found:
+            self.wfile.write('DELETED\r\n')
+        else:
+            self.wfile.write('NOT_FOUND\r\n')
+
+    def cmd_flush_all(self, args):
+        self.server.lock.acquire()
+        self.server.entries.clear()
+        self.server.lock.release()
+        self.wfile.write('OK\r\n')
+
+    def cmd_stats(self, args):
+        self.wfile.write('STAT curr_items %i\r\n' % self.server.live_count())
+        self.wfile.write('END\r\n')
+
+    def cmd_quit(self, args):
+        return False
+
+
+"""Sample payloads"""
+
+
+def sample_user(i):
+    return {
+        'id': i, 'screen_name': 'user%i' % i, 'name': 'Tweepy User %i' % i,
+        'location': 'pytopia', 'description': 'just testing things out',
+        'url': 'http://www.example.com', 'protected': False,
+        'followers_count': 100 + i, 'friends_count': 50 + i,
+        'created_at': 'Wed Mar 03 19:37:35 +0000 2010',
+        'profile_image_url': 'http://a1.twimg.com/profile_images/%i/n.png' % i,
+        'following': None
+    }
+
+
+def sample_status(i):
+    return {
+        'id': 10000 + i, 'text': 'Status update number %i from tweepy' % i,
+        'created_at': 'Wed Mar 03 19:37:35 +0000 2010',
+        'source': '<a href="http://www.example.com" rel="nofollow">Tweepy</a>',
+        'truncated': False, 'favorited': False,
+        'in_reply_to_status_id': None, 'in_reply_to_user_id': None,
+        'user': sample_user(i % 5)
+    }
+
+
+def sample_direct_message(i):
+    return {
+        'id': 20000 + i, 'text': 'Direct message number %i' % i,
+        'created_at': 'Wed Mar 03 19:37:35 +0000 2010',
+        'sender': sample_user(1), 'recipient': sample_user(2),
+        'sender_id': 1, 'recipient_id': 2
+    }
+
+
+def sample_saved_search(i):
+    return {
+        'id': 30000 + i, 'name': 'search %i' % i, 'query': 'tweepy %i' % i,
+        'position': None, 'created_at': 'Wed Mar 03 19:37:35 +0000 2010'
+    }
+
+
+def sample_search_result(i):
+    return {
+        'id': 10000 + i, 'text': 'Search result number %i from tweepy' % i,
+        'created_at': 'Wed, 03 Mar 2010 19:37:35 +0000',
+        'source': '&lt;a href=&quot;http://www.example.com&quot;&gt;Tweepy&lt;/a&gt;',
+        'from_user': 'user%i' % (i % 5), 'from_user_id': i % 5,
+        'to_user_id': None, 'iso_language_code': 'en',
+        'profile_image_url': 'http://a1.twimg.com/profile_images/%i/n.png' % i
+    }
+
+
+def sample_list(i):
+    return {
+        'id': 40000 + i, 'name': 'list%i' % i, 'slug': 'list%i' % i,
+        'full_name': '@user1/list%i' % i, 'uri': '/user1/list%i' % i,
+        'description': 'a list', 'mode': 'public',
+        'member_count': 10, 'subscriber_count': 5, 'user': sample_user(1)
+    }
+
+
+def sample_friendship(i):
+    return {'relationship': {
+        'source': {'id': 1, 'screen_name': 'user1', 'following': True,
+                   'followed_by': False, 'notifications_enabled': False},
+        'target': {'id': 2, 'screen_name': 'user2', 'following': False,
+                   'followed_by': True, 'notifications_enabled': None}
+    }}
+
+
+samples = {
+    'status': sample_status,
+    'user': sample_user,
+    'direct_message': sample_direct_message,
+    'saved_search': sample_saved_search,
+    'search_result': sample_search_result,
+    'list': sample_list,
+    'friendship': sample_friendship,
+    'ids': lambda i: i,
+    'json': lambda i: {'id': i}
+}
+
+
+def sample_payload(payload_type, payload_list=False, count=20, start=0):
+    """Return a response body for payload_type as a json encoded string"""
+    if payload_type is None:
+        return ''
+    sample = samples[payload_type]
+    if not payload_list and payload_type != 'ids':
+        return json.dumps(sample(start))
+    items = [sample(i) for i in range(start, start + count)]
+    if payload_type == 'search_result':
+        return json.dumps({'results': items, 'page': start // (count or 1) + 1})
+    if payload_type == 'list':
+        return json.dumps({'lists': items, 'next_cursor': 0, 'previous_cursor': 0})
+    return json.dumps(items)
+
+
+"""Mock Twitter server"""
+
+
+class TwitterServer(LocalServer, SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the Twitter REST, search and streaming APIs.
+
+    Every endpoint bound in tweepy.api.API answers with a generated
+    fixture matching its payload_type. Paginated endpoints return
+    `pages` pages of `page_size` items, by page or by cursor. Entries in
+    fixtures, keyed by bind_api path (ex: '/statuses/show.json'), override
+    the generated response and are either a (status, body) tuple or a
+    callable taking the request parameters and returning one.
+
+    The streaming endpoints (sample, filter, firehose, retweet) write
+    length delimited stream_messages in a loop until the client goes
+    away, pausing stream_delay seconds after each message if set. Setting
+    stream_chunked sends streams with chunked transfer encoding. REST
+    responses are delayed by response_delay seconds if set.
+
+    Clients sending Accept-Encoding: gzip get gzip compressed responses
+    and streams unless compression is set to False. Successful responses
+    carry an ETag and requests sending a matching If-None-Match get a
+    304 Not Modified.
+
+    Setting rate_limit limits each Authorization header to that many REST
+    calls: responses carry X-RateLimit-Limit, X-RateLimit-Remaining and
+    X-RateLimit-Reset headers and calls over the limit get a 400. calls_made
+    counts the calls per Authorization header.
+
+    The OAuth request_token and access_token endpoints hand out fixed
+    tokens.
+
+    Use with API(host=server.start(), search_host=...) and by setting
+    Stream.host and OAuthHandler.OAUTH_HOST.
+    """
+
+    stream_paths = re.compile(r'^/\d+/statuses/(sample|filter|firehose|retweet)\.json$')
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, pages=3, page_size=20,
+            fixtures=None, stream_messages=None, api_root='/1', search_root=''):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), TwitterHandler)
+        self.pages = pages
+        self.page_size = page_size
+        self.fixtures = fixtures or {}
+        self.stream_messages = stream_messages or \
+                [json.dumps(sample_status(i)) for i in range(20)]
+        self.stream_delay = 0
+        self.stream_chunked = False
+        self.response_delay = 0
+        self.compression = True
+        self.request_count = 0
+        self.rate_limit = None
+        self.calls_made = {}
+        self.lock = threading.Lock()
+        self.routes = self._build_routes(api_root, search_root)
+
+    def _build_routes(self, api_root, search_root):
+        routes = []
+        for func in API.__dict__.values():
+            method = getattr(func, 'api_method', None)
+            if method is None:
+                continue
+            if method.search_api:
+                root = search_root
+            else:
+                root = api_root
+            segments = list(method.path_segments)
+            segments[0] = root + segments[0]
+            parts = [re.escape(segment) for segment in segments]
+            pattern = re.compile('^%s$' % '[^/]+'.join(parts))
+            routes.append((len(parts), method.method, pattern, method))
+        # paths with fewer variables are more specific, match them first
+        routes.sort(key=lambda route: route[:2])
+        return [route[1:] for route in routes]
+
+    def match(self, http_method, path):
+        for method, pattern, api_method in self.routes:
+            if method == http_method and pattern.match(path):
+                return api_method
+
+    def take_call(self, credential):
+        """Count a call against credential's rate limit, return the calls remaining"""
+        self.lock.acquire()
+        try:
+            made = self.calls_made[credential] = self.calls_made.get(credential, 0) + 1
+        finally:
+            self.lock.release()
+        return self.rate_limit - made
+
+    def respond(self, http_method, path, params):
+        """Return the (status, body) response for a REST request"""
+        self.lock.acquire()
+        self.request_count += 1
+        self.lock.release()
+
+        if path in ('/oauth/request_token', '/oauth/access_token'):
+            token = path.split('/')[-1]
+            return 200, 'oauth_token=%s&oauth_token_secret=%s_secret' % (token, token)
+
+        if self.response_delay:
+            time.sleep(self.response_delay)
+
+        api_method = self.match(http_method, path)
+        if api_method is None:
+            return 404, json.dumps({'error': 'Not found', 'request': path})
+
+        fixture = self.fixtures.get(api_method.path)
+        if callable(fixture):
+            return fixture(params)
+        if fixture:
+            return fixture
+
+        payload_type = api_method.payload_type
+        if not (api_method.payload_list or payload_type == 'ids'):
+            return 200, sample_payload(payload_type)
+
+        if 'cursor' in params:
+            page = int(params['cursor'])
+            if page < 1:
+                page = 1
+        else:
+            page = int(params.get('page', 1))
+        if page > self.pages:
+            count = 0
+        else:
+            count = self.page_size
+        body = sample_payload(payload_type, True, count, (page - 1) * self.page_size)
+
+        if 'cursor' in params and payload_type in ('user', 'ids', 'list'):
+            key = {'user': 'users', 'ids': 'ids', 'list': 'lists'}[payload_type]
+            items = json.loads(body)
+            if isinstance(items, dict):
+                items = items[key]
+            next_cursor = page < self.pages and page + 1 or 0
+            body = json.dumps({key: items, 'next_cursor': next_cursor,
+                               'previous_cursor': page > 1 and page - 1 or 0})
+        return 200, body
+
+
+class TwitterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if '?' in self.path:
+            path, query = self.path.split('?', 1)
+        else:
+            path, query = self.path, ''
+        params = dict(cgi.parse_qsl(query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                params.update(dict(cgi.parse_qsl(body)))
+
+        if self.server.stream_paths.match(path):
+            self.stream()
+            return
+
+        rate_limit_headers = []
+        if self.server.rate_limit is not None:
+            remaining = self.server.take_call(self.headers.get('Authorization'))
+            rate_limit_headers = [
+                ('X-RateLimit-Limit', self.server.rate_limit),
+                ('X-RateLimit-Remaining', max(remaining, 0)),
+                ('X-RateLimit-Reset', int(time.time()) + 3600),
+            ]
+        if rate_limit_headers and remaining < 0:
+            status, body = 400, json.dumps({'error': 'Rate limit exceeded.'})
+        else:
+            status, body = self.server.respond(self.command, path, params)
+        if status == 200:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                for header in rate_limit_headers:
+                    self.send_header(*header)
+                self.end_headers()
+                return
+        compressor = self.compressor()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for header in rate_limit_headers:
+            self.send_header(*header)
+        if status == 200:
+            self.send_header('ETag', etag)
+        if compressor:
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def compressor(self):
+        if self.server.compression and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def stream(self):
+        compressor = self.compressor()
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if compressor:
+            self.send_header('Content-Encoding', 'gzip')
+        chunked = self.server.stream_chunked and self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        messages = self.server.stream_messages
+        delay = self.server.stream_delay
+        i = 0
+        try:
+            while True:
+                message = messages[i % len(messages)]
+                frame = '%i\r\n%s\r\n' % (len(message) + 2, message)
+                i += 1
+                flush = delay or i % 64 == 0
+                if compressor:
+                    frame = compressor.compress(frame)
+                    if flush:
+                        frame += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if chunked and frame:
+                    frame = '%x\r\n%s\r\n' % (len(frame), frame)
+                self.wfile.write(frame)
+                if flush:
+                    self.wfile.flush()
+                if delay:
+                    time.sleep(delay)
+        except socket.error:
+            pass
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # client went away with a stream response still buffered
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,520 @@
+# Tweepy
+# Copyright 2010 Joshua Roesslein
+# See LICENSE for details.
+
+"""
+Transports open the HTTP connections used by API, Stream and
+OAuthHandler.
+
+A transport has a single method, connection(host, secure, timeout),
+returning an object with the httplib.HTTPConnection interface used by
+Tweepy: connect(), request(method, url, body, headers), getresponse()
+and close(). Responses must provide status, reason, read([amt]),
+getheader(name[, default]), getheaders(), isclosed() and close().
+Responses may also provide read1(amt), returning as soon as any part of
+the body arrives, see read_available().
+
+The timeout given to connection() applies to connecting. Once connected,
+the connection's sock attribute (if it has one) gets the read timeout,
+see set_read_timeout().
+"""
+
+import httplib
+import socket
+import threading
+import time
+import gzip
+import cPickle
+
+from tweepy.error import TweepError
+
+
+def set_read_timeout(conn, timeout):
+    """Apply timeout to socket operations on a connected connection"""
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def read_available(resp, amt):
+    """Read up to amt bytes of a response body, without waiting for amt
+
+    Returns whatever a single socket read yields, '' at the end of the
+    body. Uses the response's read1() if it has one and reads httplib
+    responses from their socket, other responses fall back to read(amt).
+    """
+    read1 = getattr(resp, 'read1', None)
+    if read1 is not None:
+        return read1(amt)
+    if not isinstance(resp, httplib.HTTPResponse):
+        return resp.read(amt)
+    if resp.fp is None:
+        return ''
+    if resp.chunked:
+        # chunks are sent whole, so read the rest of the current chunk or
+        # the next chunk's size line and first byte
+        return resp.read(resp.chunk_left or 1)
+    if resp.length is not None:
+        amt = min(amt, resp.length)
+        if not amt:
+            resp.close()
+            return ''
+    fp = resp.fp
+    buffered = getattr(fp, '_rbuf', None)
+    if buffered is not None and buffered.tell():
+        data = fp.read(min(amt, buffered.tell()))
+    else:
+        data = fp._sock.recv(amt)
+    if not data:
+        resp.close()
+    elif resp.length is not None:
+        resp.length -= len(data)
+    return data
+
+
+class HTTPTransport(object):
+    """Default transport, a new httplib connection per request"""
+
+    def connection(self, host, secure=False, timeout=None):
+        if secure:
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if timeout is None:
+            return connection_class(host)
+        return connection_class(host, timeout=timeout)
+
+
+class PooledTransport(HTTPTransport):
+    """Reuses connections to a host across requests (HTTP keep-alive).
+
+    A connection goes back to the pool when it is closed after its
+    response was read to the end and the server did not ask to close it.
+    Up to max_idle connections per host are kept for idle_timeout
+    seconds. A request failing on a reused connection, which the server
+    may have closed in the meantime, is retried once on a new one.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=15):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def connection(self, host, secure=False, timeout=None):
+        return PooledConnection(self, (host, secure), timeout)
+
+    def new_connection(self, key, timeout):
+        return HTTPTransport.connection(self, key[0], key[1], timeout)
+
+    def checkout(self, key):
+        """Return an idle connection for key or None"""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            while idle:
+                conn, released = idle.pop()
+                if time.time() - released < self.idle_timeout:
+                    return conn
+                conn.close()
+        finally:
+            self._lock.release()
+
+    def release(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def idle_count(self):
+        return sum([len(idle) for idle in self._idle.values()])
+
+    def close(self):
+        """Close all idle connections"""
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn, released in idle:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+
+class PooledConnection(object):
+
+    def __init__(self, transport, key, timeout):
+        self.transport = transport
+        self.key = key
+        self.timeout = timeout
+        self.conn = None
+        self.reused = False
+        self.response = None
+        self._request = None
+
+    def connect(self):
+        if self.conn is not None:
+            return
+        self.conn = self.transport.checkout(self.key)
+        self.reused = self.conn is not None
+        if self.conn is None:
+            self.conn = self.transport.new_connection(self.key, self.timeout)
+            self.conn.connect()
+
+    @property
+    def sock(self):
+        return self.conn and self.conn.sock
+
+    def _reconnect(self):
+        read_timeout = self.timeout
+        if self.conn.sock:
+            read_timeout = self.conn.sock.gettimeout()
+        self.conn.close()
+        self.conn = self.transport.new_connection(self.key, self.timeout)
+        self.conn.connect()
+        set_read_timeout(self.conn, read_timeout)
+        self.reused = False
+
+    def request(self, method, url, body=None, headers={}):
+        self.connect()
+        self._request = (method, url, body, headers)
+        try:
+            self.conn.request(method, url, body, headers)
+        except (socket.error, httplib.HTTPException):
+            if not self.reused:
+                raise
+            self._reconnect()
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            self.conn.request(method, url, body, headers)
+
+    def getresponse(self):
+        try:
+            self.response = self.conn.getresponse()
+        except (socket.error, httplib.BadStatusLine):
+            if not self.reused:
+                raise
+            # the server closed the idle connection, retry on a new one
+            self._reconnect()
+            if hasattr(self._request[2], 'seek'):
+                self._request[2].seek(0)
+            self.conn.request(*self._request)
+            self.response = self.conn.getresponse()
+        return self.response
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        resp = self.response
+        if resp is not None and resp.isclosed() and not resp.will_close:
+            self.transport.release(self.key, conn)
+        else:
+            conn.close()
+
+
+"""Record and replay"""
+
+
+class RecordingTransport(object):
+    """Records every request and response made through another transport.
+
+    Records are appended to a gzip compressed file as they happen. Reads
+    of a response body are stored with their arrival time, grouping reads
+    made less than resolution seconds apart, so streams can be replayed at
+    their original pace. Request headers listed in hidden_headers are not
+    recorded. Call close() when done to finish the file.
+    """
+
+    def __init__(self, filename, transport=None, resolution=0.01,
+            hidden_headers=('Authorization', 'Cookie')):
+        self.transport = transport or HTTPTransport()
+        self.resolution = resolution
+        self.hidden_headers = [h.lower() for h in hidden_headers]
+        self._file = gzip.open(filename, 'wb')
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def connection(self, host, secure=False, timeout=None):
+        return RecordingConnection(self, self.transport.connection(host, secure, timeout), host)
+
+    def new_id(self):
+        self._lock.acquire()
+        try:
+            self._next_id += 1
+            return self._next_id
+        finally:
+            self._lock.release()
+
+    def write(self, record):
+        self._lock.acquire()
+        try:
+            cPickle.dump(record, self._file, 2)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._file.close()
+        finally:
+            self._lock.release()
+
+
+class RecordingConnection(object):
+
+    def __init__(self, recorder, conn, host):
+        self.recorder = recorder
+        self.conn = conn
+        self.host = host
+        self.id = None
+        self.response = None
+
+    @property
+    def sock(self):
+        return getattr(self.conn, 'sock', None)
+
+    def connect(self):
+        self.conn.connect()
+
+    def request(self, method, url, body=None, headers={}):
+        self.id = self.recorder.new_id()
+        recorded_headers = dict([(k, v) for k, v in headers.items()
+                if k.lower() not in self.recorder.hidden_headers])
+        if hasattr(body, 'read'):
+            # streamed bodies are not recorded
+            recorded_body = None
+        else:
+            recorded_body = body
+        self.recorder.write(('request', self.id, time.time(),
+                method, self.host, url, recorded_headers, recorded_body))
+        self.conn.request(method, url, body, headers)
+
+    def getresponse(self):
+        resp = self.conn.getresponse()
+        self.recorder.write(('response', self.id, time.time(),
+                resp.status, resp.reason, resp.getheaders()))
+        self.response = RecordingResponse(self.recorder, self.id, resp)
+        return self.response
+
+    def close(self):
+        if self.response:
+            self.response.flush()
+        self.conn.close()
+
+
+class RecordingResponse(object):
+
+    def __init__(self, recorder, id, resp):
+        self.recorder = recorder
+        self.id = id
+        self.resp = resp
+        self.status = resp.status
+        self.reason = resp.reason
+        self._pending = []
+        self._pending_since = None
+
+    def read(self, amt=None):
+        return self._record(self.resp.read(amt), amt is None)
+
+    def read1(self, amt):
+        return self._record(read_available(self.resp, amt), False)
+
+    def _record(self, data, complete):
+        now = time.time()
+        if self._pending and now - self._pending_since > self.recorder.resolution:
+            self.flush()
+        if data:
+            if not self._pending:
+                self._pending_since = now
+            self._pending.append(data)
+        if not data or complete:
+            self.flush()
+        return data
+
+    def flush(self):
+        if self._pending:
+            self.recorder.write(('data', self.id, self._pending_since, ''.join(self._pending)))
+            self._pending = []
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def getheaders(self):
+        return self.resp.getheaders()
+
+    def isclosed(self):
+        return self.resp.isclosed()
+
+    def close(self):
+        self.flush()
+        self.resp.close()
+
+
+class ReplayTransport(object):
+    """Serves responses from a file written by RecordingTransport.
+
+    Each request is answered by the first unused recorded exchange with
+    the same method and url, the host is ignored. Timing is reproduced
+    divided by speed: 1.0 replays at the original pace, 10 ten times
+    faster and 0 as fast as possible. A request with no recorded
+    response raises TweepError. rewind() makes every exchange available
+    again.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self.speed = speed
+        self.exchanges = []
+        self._lock = threading.Lock()
+
+        by_id = {}
+        f = gzip.open(filename, 'rb')
+        try:
+            while True:
+                try:
+                    record = cPickle.load(f)
+                except EOFError:
+                    break
+                kind, id, timestamp = record[:3]
+                if kind == 'request':
+                    exchange = by_id[id] = _Exchange(timestamp, *record[3:])
+                    self.exchanges.append(exchange)
+                elif kind == 'response':
+                    by_id[id].set_response(timestamp, *record[3:])
+                elif kind == 'data':
+                    by_id[id].chunks.append((timestamp, record[3]))
+        finally:
+            f.close()
+        self._unused = list(self.exchanges)
+
+    def connection(self, host, secure=False, timeout=None):
+        return ReplayConnection(self)
+
+    def take(self, method, url):
+        self._lock.acquire()
+        try:
+            for exchange in self._unused:
+                if exchange.method == method and exchange.url == url:
+                    self._unused.remove(exchange)
+                    return exchange
+        finally:
+            self._lock.release()
+        raise TweepError('No recorded response for %s %s' % (method, url))
+
+    def rewind(self):
+        self._lock.acquire()
+        self._unused = list(self.exchanges)
+        self._lock.release()
+
+    def wait(self, start, delay):
+        """Sleep until delay recorded seconds after start, scaled by speed"""
+        if self.speed > 0:
+            remaining = start + delay / self.speed - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+class _Exchange(object):
+
+    def __init__(self, sent, method, host, url, headers, body):
+        self.sent = sent
+        self.method = method
+        self.host = host
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.received = None
+        self.status = None
+        self.reason = None
+        self.response_headers = []
+        self.chunks = []
+
+    def set_response(self, received, status, reason, headers):
+        self.received = received
+        self.status = status
+        self.reason = reason
+        self.response_headers = headers
+
+
+class ReplayConnection(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.exchange = None
+        self.sent = None
+
+    def connect(self):
+        pass
+
+    def request(self, method, url, body=None, headers={}):
+        self.exchange = self.transport.take(method, url)
+        self.sent = time.time()
+
+    def getresponse(self):
+        exchange = self.exchange
+        if exchange.status is None:
+            raise TweepError('No recorded response for %s %s' % (exchange.method, exchange.url))
+        self.transport.wait(self.sent, exchange.received - exchange.sent)
+        return ReplayResponse(self.transport, exchange)
+
+    def close(self):
+        pass
+
+
+class ReplayResponse(object):
+
+    def __init__(self, transport, exchange):
+        self.transport = transport
+        self.exchange = exchange
+        self.status = exchange.status
+        self.reason = exchange.reason
+        self._opened = time.time()
+        self._chunks = list(exchange.chunks)
+        self._buffer = ''
+        self._pos = 0
+
+    def read(self, amt=None):
+        while self._chunks and (amt is None or len(self._buffer) - self._pos < amt):
+            received, data = self._chunks.pop(0)
+            self.transport.wait(self._opened, received - self.exchange.received)
+            self._buffer = self._buffer[self._pos:] + data
+            self._pos = 0
+        if amt is None:
+            data = self._buffer[self._pos:]
+        else:
+            data = self._buffer[self._pos:self._pos + amt]
+        self._pos += len(data)
+        return data
+
+    def read1(self, amt):
+        if self._pos >= len(self._buffer) and self._chunks:
+            # wait for the next recorded chunk only
+            received, data = self._chunks.pop(0)
+            self.transport.wait(self._opened, received - self.exchange.received)
+            self._buffer, self._pos = data, 0
+        data = self._buffer[self._pos:self._pos + amt]
+        self._pos += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for k, v in self.exchange.response_headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def getheaders(self):
+        return list(self.exchange.response_headers)
+
+    def isclosed(self):
+        return not self._chunks and self._pos >= len(self._buffer)
+
+    def close(self):
+        self._chunks = []
+        self._buffer = ''
+        self._pos = 0
@@ -3,9 +3,15 @@
 # See LICENSE for details.
 
 from datetime import datetime
+import os
 import time
+import threading
+import sys
 import htmlentitydefs
 import re
+import zlib
+
+from tweepy.error import TweepError
 
 
 def parse_datetime(str):
@@ -64,6 +70,23 @@ def convert_to_utf8_str(arg):
     return arg
 
 
+def decompress_body(body, encoding):
+    """Decode a body sent with Content-Encoding gzip or deflate"""
+    if encoding not in ('gzip', 'deflate'):
+        return body
+    try:
+        # detects gzip or zlib headers
+        return zlib.decompress(body, 32 + zlib.MAX_WBITS)
+    except zlib.error:
+        # some servers send raw deflate data
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+def decompressor(encoding):
+    """Return a zlib decompress object for a Content-Encoding or None"""
+    if encoding in ('gzip', 'deflate'):
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+
 
 def import_simplejson():
     try:
@@ -79,3 +102,135 @@ def import_simplejson():
 
     return json
 
+
+class SingleFlight(object):
+    """Collapses concurrent calls sharing a key into one call.
+
+    The first caller for a key runs the function, any caller arriving
+    while it is running waits for and shares its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, args=(), timeout=None):
+        """Return func(*args), sharing a call for key in progress
+            timeout: seconds to wait for a call in progress before
+                     raising TweepError [optional]
+        """
+        self._lock.acquire()
+        call = self._calls.get(key)
+        if call:
+            self._lock.release()
+            call.done.wait(timeout)
+            if not call.done.isSet():
+                raise TweepError('Request deadline exceeded')
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        call = _FlightCall()
+        self._calls[key] = call
+        self._lock.release()
+        return self._run(key, call, func, args)
+
+    def do_async(self, key, func, args=()):
+        """Run func in a background thread unless a call for key is in
+        progress. Callers of do() arriving meanwhile share its result.
+        Returns True if the thread was started.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._calls:
+                return False
+            call = self._calls[key] = _FlightCall()
+        finally:
+            self._lock.release()
+        t = threading.Thread(target=self._run, args=(key, call, func, args))
+        t.setDaemon(True)
+        t.start()
+        return True
+
+    def _run(self, key, call, func, args):
+        try:
+            try:
+                call.result = func(*args)
+            except:
+                call.error = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            del self._calls[key]
+            self._lock.release()
+            call.done.set()
+        return call.result
+
+
+class _FlightCall(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MultipartBody(object):
+    """multipart/form-data body holding one file, read from disk as sent.
+
+    A file-like object for httplib: read() returns the part headers, the
+    file content (read from disk only as far as requested) and the closing
+    boundary. len() is the full body length, known up front for the
+    Content-Length header. seek(0) rewinds the body to send it again.
+    """
+
+    def __init__(self, name, filename, content_type, boundary):
+        self.filename = filename
+        self.head = '\r\n'.join([
+            '--' + boundary,
+            'Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename),
+            'Content-Type: %s' % content_type,
+            '', ''
+        ])
+        self.tail = '\r\n--%s--\r\n' % boundary
+        self.length = len(self.head) + os.path.getsize(filename) + len(self.tail)
+        self._fp = None
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError('MultipartBody can only be rewound')
+        self.close()
+        # parts left to send, None stands for the file content
+        self._parts = [self.head, None, self.tail]
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            part = self._parts[0]
+            if part is None:
+                if self._fp is None:
+                    self._fp = open(self.filename, 'rb')
+                data = self._fp.read(size)
+                if not data:
+                    self.close()
+                    self._parts.pop(0)
+                    continue
+            elif 0 <= size < len(part):
+                data = part[:size]
+                self._parts[0] = part[size:]
+            else:
+                data = part
+                self._parts.pop(0)
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None